@@ -0,0 +1,219 @@
+"""基于本地模拟站点的端到端耗时测试
+
+启动 mock_site.py 中的模拟站点, 生成一份指向它的临时 config, 然后用 Booker 从登录到付款完整地跑若干次,
+统计整体和每个阶段耗时的 p50/p95/最大值。可以给页面、接口和验证码识别注入延迟, 用来比较不同改动的效果:
+
+    python bench.py --runs 10 --browser chrome
+    python bench.py --runs 10 --api-delay 0.1 --captcha-delay 0.5 --http-poll
+
+--profiles 会分别用每个浏览器启动配置进入预约界面, 反复 refresh 并统计从 refresh 到场地表格可见的耗时:
+
+    python bench.py --runs 0 --profiles default,eager,blocked,fast --asset-delay 0.2
+"""
+import argparse
+import datetime
+import logging
+import os
+import tempfile
+import time
+
+from selenium.webdriver.common.by import By
+
+from booker import Booker
+from browser import LAUNCH_PROFILES
+from captcha_eval import percentile
+from mock_site import MockSite, MockVenue
+from utils import wait_loading_complete
+
+BENCH_CONFIG = """[enabled]
+enabled=True
+
+[login]
+user_name=bench
+password=bench
+portal_url=%(url)s/portal2017
+session_cache=False
+
+[tt]
+tt_usr=bench
+tt_pwd=bench
+base_url=%(url)s
+
+[captcha]
+backends=ttshitu
+
+[type]
+venue=%(venue)s
+venue_num=-1
+
+[time]
+start_time=%(date)s-%(start)s
+end_time=%(date)s-%(end)s
+
+[wechat]
+wechat_notice=False
+SCKEY=
+
+[browser]
+profile=%(profile)s
+
+[http]
+http_poll=%(http_poll)s
+base_url=%(url)s
+venue_site_id=%(site_id)s
+poll_interval=0.05
+
+[poll]
+; 模拟站点不会限流, 不需要等到放场时刻才加快
+min_interval=0.1
+base_interval=0.1
+quiet_interval=0.1
+
+[metrics]
+metrics_dir=%(metrics_dir)s
+"""
+
+
+def write_config(path: str, site: MockSite, metrics_dir: str, http_poll: bool = False,
+                 start: str = '1900', end: str = '2000', profile: str = 'default') -> None:
+    """写出指向模拟站点的 config, 预约明天的场地, 这样不需要等到 12 点"""
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(BENCH_CONFIG % {
+            'url': site.url, 'venue': site.VENUES[0], 'site_id': site.SITE_ID,
+            'date': tomorrow.strftime("%Y%m%d"), 'start': start, 'end': end,
+            'http_poll': http_poll, 'metrics_dir': metrics_dir, 'profile': profile})
+
+
+def run_once(config_path: str, browser: str, logger: logging.Logger) -> tuple:
+    """完整运行一次 Booker
+
+    Returns:
+        tuple: (是否预约成功, 总耗时, {阶段: 耗时}), 耗时单位为秒
+    """
+    booker = Booker(config_path, logger, browser)
+    start = time.perf_counter()
+    try:
+        booker.single_run()
+        elapsed = time.perf_counter() - start
+        ok = booker.court_locked and booker.status
+        stages = {}
+        for (name, labels), histogram in booker.metrics.histograms.items():
+            if name == 'booker_stage_duration_seconds':
+                stage = dict(labels)['stage']
+                stages[stage] = stages.get(stage, 0) + histogram.sum
+        return ok, elapsed, stages
+    except Exception as e:
+        logger.error("运行失败: %s" % e)
+        logger.debug(e, exc_info=True, stack_info=True)
+        return False, time.perf_counter() - start, {}
+    finally:
+        booker.close()
+
+
+def summarize(values: list) -> str:
+    return "p50 %7.0f ms  p95 %7.0f ms  最大 %7.0f ms" % (
+        percentile(values, 0.5) * 1000, percentile(values, 0.95) * 1000, max(values) * 1000)
+
+
+def bench(runs: int, browser: str, delays: dict, http_poll: bool = False, free_ratio: float = 0.5,
+          profile: str = 'default', logger: logging.Logger = None) -> dict:
+    """启动模拟站点并运行 runs 次
+
+    Returns:
+        dict: success, total (每次的总耗时列表), stages ({阶段: 耗时列表})
+    """
+    logger = logger if logger is not None else logging.getLogger()
+    site = MockSite(venue=MockVenue(free_ratio=free_ratio), delays=delays).start()
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    config_path = os.path.join(work_dir, 'config_bench.ini')
+    write_config(config_path, site, os.path.join(work_dir, 'metrics'), http_poll, profile=profile)
+
+    result = {'success': 0, 'total': [], 'stages': {}}
+    try:
+        for i in range(runs):
+            # 每次运行换一个种子并清空订单, 场地空闲情况各不相同
+            site.venue.seed = i
+            site.venue.reset()
+            ok, elapsed, stages = run_once(config_path, browser, logger)
+            logger.info("第 %d 次: %s, 耗时 %.0f ms" % (i + 1, '成功' if ok else '失败', elapsed * 1000))
+            result['success'] += ok
+            result['total'].append(elapsed)
+            for stage, value in stages.items():
+                result['stages'].setdefault(stage, []).append(value)
+    finally:
+        site.stop()
+    return result
+
+
+def bench_refresh(profiles: list, browser: str, refreshes: int, delays: dict,
+                  logger: logging.Logger = None) -> dict:
+    """用每个启动配置进入预约界面后反复 refresh
+
+    Returns:
+        dict: {启动配置: 每次从 refresh 到场地表格可见的耗时列表}
+    """
+    logger = logger if logger is not None else logging.getLogger()
+    site = MockSite(delays=delays).start()
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    result = {}
+    try:
+        for profile in profiles:
+            config_path = os.path.join(work_dir, 'config_%s.ini' % profile)
+            write_config(config_path, site, os.path.join(work_dir, 'metrics'), profile=profile)
+            booker = Booker(config_path, logger, browser)
+            try:
+                booker.page_init()
+                result[profile] = []
+                for _ in range(refreshes):
+                    start = time.perf_counter()
+                    booker.driver.refresh()
+                    wait_loading_complete(booker.driver, (By.CLASS_NAME, 'tableWrap'))
+                    result[profile].append(time.perf_counter() - start)
+            except Exception as e:
+                logger.error("启动配置 %s 运行失败: %s" % (profile, e))
+                logger.debug(e, exc_info=True, stack_info=True)
+            finally:
+                booker.close()
+    finally:
+        site.stop()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='基于本地模拟站点的端到端耗时测试')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--browser', default='chrome', choices=['chrome', 'firefox', 'edge'])
+    parser.add_argument('--page-delay', type=float, default=0, help='页面加载的延迟, 单位为秒')
+    parser.add_argument('--asset-delay', type=float, default=0, help='图片、字体等静态资源的延迟')
+    parser.add_argument('--api-delay', type=float, default=0, help='day/info 接口的延迟')
+    parser.add_argument('--order-delay', type=float, default=0, help='提交订单的延迟')
+    parser.add_argument('--captcha-delay', type=float, default=0, help='验证码识别的延迟')
+    parser.add_argument('--free-ratio', type=float, default=0.5, help='每个时间段空闲的概率')
+    parser.add_argument('--http-poll', action='store_true', help='开启 HTTP 轮询')
+    parser.add_argument('--profile', default='default', choices=list(LAUNCH_PROFILES), help='端到端测试使用的浏览器启动配置')
+    parser.add_argument('--profiles', default='', help='逗号分隔的启动配置, 分别测试 refresh 到表格可见的耗时')
+    parser.add_argument('--refreshes', type=int, default=10, help='每个启动配置 refresh 的次数')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('bench')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    delays = {'page': args.page_delay, 'asset': args.asset_delay, 'api': args.api_delay,
+              'order': args.order_delay, 'captcha': args.captcha_delay}
+
+    if args.runs > 0:
+        result = bench(args.runs, args.browser, delays, args.http_poll, args.free_ratio, args.profile, logger)
+        print("成功 %d/%d" % (result['success'], args.runs))
+        if result['total']:
+            print("%-12s %s" % ('端到端', summarize(result['total'])))
+        for stage, values in result['stages'].items():
+            print("%-12s %s" % (stage, summarize(values)))
+
+    profiles = [x.strip() for x in args.profiles.split(',') if x.strip()]
+    if profiles:
+        print("refresh 到场地表格可见:")
+        for profile, values in bench_refresh(profiles, args.browser, args.refreshes, delays, logger).items():
+            if values:
+                print("%-12s %s" % (profile, summarize(values)))
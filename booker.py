@@ -1,29 +1,41 @@
 import logging
-import random
-from configparser import ConfigParser
-import sys
-import os
-from os import stat
 import time
 from functools import wraps
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options as Chrome_Options
-from selenium.webdriver.chrome.service import Service as Chrome_Service
-from selenium.webdriver.edge.options import Options as Edge_Options
-from selenium.webdriver.edge.service import Service as Edge_Service
-from selenium.webdriver.firefox.options import Options as Firefox_Options
-from selenium.webdriver.firefox.service import Service as Firefox_Service
-from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.common.action_chains import ActionChains
-from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException
-
-from utils import verify, get_size, check_element_exist, wait_loading_complete, element_click
-from log import setup_logger
-from notice import wechat_push
+from selenium.common.exceptions import TimeoutException, NoSuchWindowException
+
+from browser import create_driver, is_driver_alive, reset_driver, quit_driver, block_urls, LAUNCH_PROFILES, DEFAULT_BLOCKED_URLS
+from utils import get_size, check_element_exist, wait_loading_complete, element_click, count_webdriver_commands
+from waits import click_and_wait, click_nowait, wait_clicked, reload_nowait, wait_for_change, wait_for_windows
+from venue_client import VenueClient, DEFAULT_BASE_URL
+from watcher import CancellationWatcher, WatchTarget
+from scheduler import PollScheduler, get_budget, is_throttled
+from history import HistoryStore, HISTORY_DB
+from coordination import get_coordinator, cell_keys, COORDINATION_DB, CLAIM_TTL
+from session_cache import SessionCache
+from metrics import MetricsRegistry, export_run, process_start_time, METRICS_DIR
+from captcha import CaptchaSolver, TTShituBackend, save_capture
+from release_timer import ServerClock, ReleaseTrigger
+from config_registry import load_config, resolve_slots
+from court_table import CourtTable, COURTS_PER_TABLE, snapshot_court_table, find_cells, estimate_legacy_commands
+from selection import Window, candidates_in_table, best_candidate, is_unbeatable, court_ranks, backup_candidates, \
+    MAX_SLOTS_PER_DAY
+from log import setup_logger, set_log_context
+from notice import get_dispatcher
+
+PORTAL_URL = "https://portal.pku.edu.cn/portal2017"
+
+# 放场前最后多少秒不再做保持会话的操作, 让页面在触发时处于稳定状态
+STANDBY_QUIET_SECONDS = 10
+# 待命状态触发后, 停在放场日期上的表格在多少秒内可以直接使用, 之后要重新刷新
+STANDBY_FRESH_SECONDS = 2
+
+# 这个进程是否已经统计过从启动到进入预约界面的耗时, 只统计第一次
+_cold_start_reported = False
 
 
 class Booker:
@@ -39,44 +51,275 @@ class Booker:
         # 场地锁定状态
         self.court_locked = False
 
+        # 是否已经登录并进入了预约界面
+        self.page_ready = False
+
+        self.driver = None
+
+        # 预约界面所在的标签页, 以及多标签页模式下每个日期对应的标签页
+        self.venue_handle = None
+        self.scan_tabs = {}
+        # 每个标签页的场地表格当前停在第几页
+        self.table_page = {}
+
+        # 待命状态触发后停在哪一天以及触发的时刻, 放场触发的时刻和方式, 用于统计触发到第一次读到表格的耗时
+        self.standby_day = None
+        self.trigger_at = None
+        self.trigger_mode = None
+        # 累计等待放场的秒数, 查找的耗时要扣掉这一段, 否则轮询间隔会按几分钟的"耗时"放慢
+        self.release_waited = 0.0
+
+        # 各阶段的耗时统计, close 时导出
+        self.metrics = MetricsRegistry()
+        self.started_at = datetime.datetime.now()
+
         # 读取配置文件
         self.__load_config(config_path)
+        set_log_context(self.logger, account=self.user_name)
 
         # 预约场地的时间列表
         self.venue_time_list = []
 
+        # 上一次判断预约日期的结果, 没有变化时不再打日志
+        self.last_days_limit = None
+
+        # 验证码识别
+        self.captcha_solver = CaptchaSolver(
+            self.__captcha_backends_init(), self.captcha_duplicates, self.captcha_deadline, self.logger)
+
+        # 直接请求场馆接口的客户端, 只有开启 http_poll 时才会创建
+        self.venue_client = None
+
+        # 浏览器查找的轮询调度, 每次开始查找空闲场地时创建
+        self.scan_scheduler = None
+
+        # 每次扫描到的空闲情况都写入历史记录
+        self.history = HistoryStore(self.history_path, logger=self.logger) if self.history_enabled else None
+
+        # 与同一台机器上的其他账号协调, 避免抢同一个场地
+        self.coordinator = get_coordinator(
+            self.coordination_backend, self.coordination_path, self.logger) if self.coordination else None
+        # 当前认领的格子, 点击失败时放弃
+        self.claimed_keys = []
+
+        # 推测模式下等待在其他标签页中提交的后备候选, 以及选择时预约界面的地址
+        self.backups = []
+        self.backup_url = None
+
+        # 微信推送在后台线程中发送
+        self.notifier = get_dispatcher() if self.wechat_notice else None
+
+        # 按场馆服务器的时钟触发放场时刻, 第一次等待时才会同步时钟
+        self.release_trigger = ReleaseTrigger(
+            ServerClock(self.http_base_url, logger=self.logger), logger=self.logger)
+
     def __load_config(self, config_path: str) -> None:
-        conf = ConfigParser()
-        conf.read(config_path, encoding='utf8')
+        # 启动前已经校验过, 这里直接取缓存
+        booking = load_config(config_path)
+        conf = booking.parser
 
         self.user_name = conf['login']['user_name']
         self.password = conf['login']['password']
         self.tt_usr = conf['tt']['tt_usr']
         self.tt_pwd = conf['tt']['tt_pwd']
+        self.tt_base_url = conf.get('tt', 'base_url', fallback=TTShituBackend.BASE_URL)
+        self.portal_url = conf.get('login', 'portal_url', fallback=PORTAL_URL)
+        self.metrics_dir = conf.get('metrics', 'metrics_dir', fallback=METRICS_DIR)
         self.venue = conf['type']['venue']
         self.venue_num = int(conf['type']['venue_num'])
-        self.start_time = conf['time']['start_time']
-        self.end_time = conf['time']['end_time']
+        self.court_ranks = court_ranks([int(x) for x in conf.get(
+            'type', 'preferred_courts', fallback='').split(',') if x.strip()])
+        self.slots = booking.slots
         self.wechat_notice = conf.getboolean('wechat', 'wechat_notice')
         self.sckey = conf['wechat']['SCKEY']
+        self.http_poll = conf.getboolean('http', 'http_poll', fallback=False)
+        self.http_base_url = conf.get('http', 'base_url', fallback=DEFAULT_BASE_URL)
+        self.venue_site_id = conf.get('http', 'venue_site_id', fallback='')
+        self.poll_interval = conf.getfloat('http', 'poll_interval', fallback=0.5)
+        self.watch = conf.getboolean('watch', 'watch', fallback=False)
+        self.watch_interval = conf.getfloat('watch', 'interval', fallback=3)
+        self.watch_cpu_budget = conf.getfloat('watch', 'cpu_budget', fallback=0.05)
+        self.poll_min_interval = conf.getfloat('poll', 'min_interval', fallback=0.5)
+        self.poll_base_interval = conf.getfloat('poll', 'base_interval', fallback=2.5)
+        self.poll_quiet_interval = conf.getfloat('poll', 'quiet_interval', fallback=10)
+        self.poll_max_interval = conf.getfloat('poll', 'max_interval', fallback=60)
+        self.poll_budget = conf.getfloat('poll', 'max_requests_per_hour', fallback=0)
+        self.history_enabled = conf.getboolean('history', 'history', fallback=False)
+        self.history_path = conf.get('history', 'path', fallback=HISTORY_DB)
+        self.coordination = conf.getboolean('coordination', 'coordination', fallback=False)
+        self.coordination_backend = conf.get('coordination', 'backend', fallback='auto')
+        self.coordination_path = conf.get('coordination', 'path', fallback=COORDINATION_DB)
+        self.claim_ttl = conf.getfloat('coordination', 'ttl', fallback=CLAIM_TTL)
+        self.speculative = conf.getboolean('speculative', 'speculative', fallback=False)
+        self.speculative_candidates = max(1, conf.getint('speculative', 'candidates', fallback=2))
+        self.standby = conf.getboolean('standby', 'standby', fallback=False)
+        self.standby_lead = conf.getfloat('standby', 'lead', fallback=300)
+        self.standby_keepalive = conf.getfloat('standby', 'keepalive', fallback=120)
+        self.captcha_backends = [x.strip() for x in conf.get(
+            'captcha', 'backends', fallback='ttshitu').split(',') if x.strip()]
+        self.captcha_duplicates = conf.getint('captcha', 'duplicates', fallback=1)
+        self.captcha_deadline = conf.getfloat('captcha', 'deadline', fallback=8)
+        self.captcha_capture_dir = conf.get('captcha', 'capture_dir', fallback='')
+        self.browser_profile = conf.get('browser', 'profile', fallback='default')
+        if self.browser_profile not in LAUNCH_PROFILES:
+            raise Exception("不支持的启动配置: %s" % self.browser_profile)
+        extra_blocked_urls = [x.strip() for x in conf.get('browser', 'blocked_urls', fallback='').split(',') if x.strip()]
+        self.blocked_urls = DEFAULT_BLOCKED_URLS + extra_blocked_urls if extra_blocked_urls else None
+        self.multi_tab = conf.getboolean('browser', 'multi_tab', fallback=False)
+        self.session_cache = SessionCache(
+            self.user_name, max_age=conf.getint('login', 'session_max_age', fallback=120) * 60,
+            logger=self.logger) if conf.getboolean('login', 'session_cache', fallback=True) else None
     
-    def page_init(self) -> None:
+    def __captcha_backends_init(self) -> list:
+        """按配置创建验证码识别后端"""
+        backends = []
+        for name in self.captcha_backends:
+            if name == TTShituBackend.name:
+                backends.append(TTShituBackend(self.tt_usr, self.tt_pwd, base_url=self.tt_base_url))
+            elif name == 'local':
+                # ddddocr 是可选依赖, 只有用到时才导入
+                from captcha_local import LocalBackend
+                backends.append(LocalBackend())
+            else:
+                raise Exception("不支持的验证码识别后端: %s" % name)
+        return backends
+
+    def page_init(self, driver=None) -> None:
+        """初始化浏览器, 登录并进入预约界面
+
+        Args:
+            driver (WebDriver, optional): 使用已经启动的浏览器, 例如由 DriverPool 提供. Defaults to None.
+        """
         self.status = True
-        # 初始化浏览器
-        self.__driver_init()
+        self.page_ready = False
+        self.venue_handle = None
+        self.scan_tabs = {}
+        self.table_page = {}
+        # 初始化浏览器, 已有的浏览器还能用的话就清理一下接着用
+        if driver is not None:
+            self.driver = driver
+        elif self.driver is not None and is_driver_alive(self.driver):
+            reset_driver(self.driver)
+        else:
+            self.__driver_init()
+        self.__block_urls()
 
-        # 登录
-        self.__login()
+        # 优先使用缓存的登录状态, 缓存不可用或被拒绝时再完整登录
+        if not self.__restore_session():
+            # 登录
+            self.__login()
+
+            # 进入预约界面
+            self.__go_to_venue_page()
+
+            if self.status:
+                self.__save_session()
+
+        # 复用浏览器的登录状态创建 HTTP 客户端
+        if self.http_poll and self.status:
+            self.__http_client_init()
+
+        self.page_ready = self.status
+        if self.page_ready:
+            self.__report_cold_start()
+
+    def __report_cold_start(self) -> None:
+        """统计进程启动到第一次进入预约界面的耗时, 包括 import、env_check、启动浏览器和登录"""
+        global _cold_start_reported
+        if _cold_start_reported:
+            return
+        _cold_start_reported = True
+        elapsed = time.time() - process_start_time()
+        self.logger.info("进程启动到进入预约界面耗时 %.2f s" % elapsed)
+        self.metrics.observe('booker_cold_start_seconds', elapsed)
+
+    def __export_metrics(self) -> None:
+        if not self.metrics.histograms and not self.metrics.counters:
+            return
+        try:
+            path = export_run(self.metrics, {
+                'config': self.config_path,
+                'account': self.user_name,
+                'started_at': self.started_at.isoformat(timespec='seconds'),
+                'court_locked': self.court_locked,
+            }, self.metrics_dir)
+            self.logger.info("本次运行的统计已写入 %s" % path)
+        except Exception as e:
+            self.logger.warn("导出统计失败")
+            self.logger.debug(e, exc_info=True, stack_info=True)
+        # 同一个 Booker 再次 close 时不重复导出
+        self.metrics = MetricsRegistry()
+
+    def __restore_session(self) -> bool:
+        """恢复缓存的登录状态并直接进入预约界面
+
+        Returns:
+            bool: 是否成功进入了预约界面
+        """
+        if self.session_cache is None:
+            return False
+        try:
+            if not self.session_cache.restore(self.driver):
+                return False
+            self.driver.switch_to.window(self.driver.window_handles[-1])
+            self.venue_handle = self.driver.current_window_handle
+            self.__wait()
+            # 缓存的地址可能停在场馆列表上, 此时再点一下对应的场馆
+            venue_locator = (By.XPATH, '//div [contains(text(),\'%s\')]' % self.venue)
+            if not check_element_exist(self.driver, By.CLASS_NAME, 'ivu-form-item-content') and \
+                    check_element_exist(self.driver, *venue_locator):
+                element_click(self.driver, self.driver.find_element(*venue_locator))
+            self.__wait((By.CLASS_NAME, 'ivu-form-item-content'), wait_seconds=5)
+            self.logger.info("使用缓存的登录状态进入预约界面")
+            return True
+        except Exception as e:
+            self.logger.info("缓存的登录状态已失效, 重新登录")
+            self.logger.debug(e, exc_info=True, stack_info=True)
+            self.session_cache.clear()
+            return False
+
+    def __save_session(self) -> None:
+        if self.session_cache is None:
+            return
+        try:
+            self.session_cache.save(self.driver)
+        except Exception as e:
+            self.logger.warn("缓存登录状态失败")
+            self.logger.debug(e, exc_info=True, stack_info=True)
+
+    def detach_driver(self):
+        """交出浏览器的控制权, 之后这个 Booker 需要重新 page_init 才能使用"""
+        driver = self.driver
+        self.driver = None
+        self.page_ready = False
+        return driver
+
+    def close(self) -> None:
+        """退出浏览器并关闭 HTTP 客户端, 导出本次运行的统计, 等待微信推送发送完"""
+        self.__export_metrics()
+        if self.driver is not None:
+            quit_driver(self.detach_driver())
+        if self.venue_client is not None:
+            self.venue_client.close()
+            self.venue_client = None
+        if self.history is not None:
+            self.history.close()
+        if self.coordinator is not None:
+            try:
+                self.coordinator.release(self.user_name)
+                self.coordinator.close()
+            except Exception as e:
+                self.logger.debug(e, exc_info=True, stack_info=True)
+            self.coordinator = None
+        # 并行预约的子进程退出时不会执行 atexit, 这里先把推送发完
+        if self.notifier is not None:
+            self.notifier.flush(logger=self.logger)
 
-        # 进入预约界面
-        self.__go_to_venue_page()
-        
     def book(self) -> None:
-        self.start_time_list, self.end_time_list, self.delta_day_list = self.__judge_exceeds_days_limit(
-            self.start_time, self.end_time)
+        self.slot_list, self.delta_day_list = self.__judge_exceeds_days_limit()
 
         # 如果没有有效的预约日期, 则退出
-        if len(self.start_time_list) == 0:
+        if len(self.slot_list) == 0:
             self.logger.warn("没有可用的预约日期, 一分钟后重试")
             self.status = False
             time.sleep(60)
@@ -86,8 +329,7 @@ class Booker:
 
         # 从这里直到付款，任意一次刷新都会回到查找空闲场地
         # 查找空闲场地
-        self.__find_available_court(
-            self.start_time_list, self.end_time_list, self.delta_day_list)
+        self.__find_available_court(self.slot_list, self.delta_day_list)
 
         # 确认预约
         self.__confirm_booking()
@@ -108,7 +350,7 @@ class Booker:
         if self.status:
             self.logger.info("预约成功")
             if self.wechat_notice:
-                wechat_push(self.sckey, '预定成功', '锁定的场地已成功自动付款', self.logger)
+                self.__notify('预定成功', '锁定的场地已成功自动付款')
 
     def single_run(self) -> None:
         self.page_init()
@@ -116,7 +358,9 @@ class Booker:
 
     def keep_run(self):
         retry_times = 0
-        self.page_init()
+        # 由 DriverPool 预热过的 Booker 已经在预约界面了
+        if not self.page_ready:
+            self.page_init()
         while not self.status:
             retry_times += 1
             self.logger.info("第 %d 次登陆重试" % retry_times)
@@ -136,155 +380,89 @@ class Booker:
         if self.court_locked and (not self.status):
             self.logger.warn("场地已锁定，但是预约付款失败")
 
-    def __judge_exceeds_days_limit(self, start_time: str, end_time: str) -> tuple:
+    def __judge_exceeds_days_limit(self) -> tuple:
         """判断预约日期是否超过3天
 
-        Args:
-            start_time (`str`): 场地开始时间
-
-            end_time (`str`): 场地结束时间
+        结果和上一次相同时不再重复打日志
 
         Returns:
-            tuple: 可用的时间列表
-
-            (start_time_list_valid, end_time_list_valid, delta_day_list_valid): `list`, `list`, `list`
+            tuple: 可用的时间段
 
-            start_time_list_valid: 可用的开始时间列表
+            (slot_list, delta_day_list): `list`, `list`
 
-            end_time_list_valid: 可用的结束时间列表
+            slot_list: 可用的 SlotSpec 列表
 
-            delta_day_list_valid: 可用的距今天数列表
+            delta_day_list: 可用的距今天数列表
         """
-        start_time_list = start_time.split('/')
-        end_time_list = end_time.split('/')
-        self.logger.info("start_time_list: %s" % start_time_list)
-        self.logger.info("end_time_list: %s" % end_time_list)
-
-        # 获取当前时间
-        now = datetime.datetime.today()
-        today = datetime.datetime.strptime(str(now)[:10], "%Y-%m-%d")
-
-        # 当前时间的小时
-        time_hour = datetime.datetime.strptime(
-            str(now).split()[1][:-7], "%H:%M:%S")
-        # 11:55 的时间戳
-        time_11_55 = datetime.datetime.strptime(
-            "11:55:00", "%H:%M:%S")
-
-        start_time_list_valid = []
-        end_time_list_valid = []
-        delta_day_list_valid = []
-
-        for i in range(len(start_time_list)):
-            start_time = start_time_list[i]
-            end_time = end_time_list[i]
-
-            if len(start_time) > 8:
-                # 支持 20230909-1500 这种格式
-                date = datetime.datetime.strptime(
-                    start_time.split('-')[0], "%Y%m%d")
-                delta_day = (date-today).days
-            else:
-                # 正常情况下是 5-1500 这种格式
-                delta_day = (int(start_time[0])+6-today.weekday()) % 7
-                date = today+datetime.timedelta(days=delta_day)
-
-            if delta_day > 3 or (delta_day == 3 and (time_hour < time_11_55)):
-                self.logger.warn("预定日期: %s 无效" % str(date).split()[0])
-                self.logger.warn("只能在当天中午11:55后预约未来3天以内的场馆")
-                break
-            else:
-                start_time_list_valid.append(start_time)
-                end_time_list_valid.append(end_time)
-                delta_day_list_valid.append(delta_day)
-                self.logger.info("预定日期: %s 有效" % str(date).split()[0])
+        slot_list, delta_day_list, invalid = resolve_slots(self.slots)
+
+        result = (tuple(delta_day_list), invalid)
+        if result != self.last_days_limit:
+            self.last_days_limit = result
+            today = datetime.date.today()
+            for slot in slot_list:
+                self.logger.info("预定日期: %s 有效" % slot.date_on(today))
+            if slot_list:
                 self.logger.info("在预约可预约日期范围内")
+            if invalid is not None:
+                self.logger.warn("预定日期: %s 无效" % invalid.date_on(today))
+                self.logger.warn("只能在当天中午11:55后预约未来3天以内的场馆")
 
-        return start_time_list_valid, end_time_list_valid, delta_day_list_valid
+        return slot_list, delta_day_list
 
     def __driver_init(self) -> None:
         """初始化浏览器
         """
+        if self.driver is not None:
+            quit_driver(self.driver)
+        self.driver = create_driver(self.browser_name, self.logger, self.browser_profile, self.blocked_urls)
 
-        def get_driver_path(browser: str) -> str:
-            """获取驱动路径"""
-            path = 'driver'
-            if browser == "chrome":
-                if sys.platform.startswith('win'):
-                    return os.path.join(path, 'chromedriver.exe')
-                elif sys.platform.startswith('linux'):
-                    return os.path.join(path, 'chromedriver.bin')
-                else:
-                    raise Exception('不支持该系统')
-            elif browser == "firefox":
-                if sys.platform.startswith('win'):
-                    return os.path.join(path, 'geckodriver.exe')
-                elif sys.platform.startswith('linux'):
-                    return os.path.join(path, 'geckodriver.bin')
-                else:
-                    raise Exception('不支持该系统')
-            elif browser == "edge":
-                if sys.platform.startswith('win'):
-                    return os.path.join(path, 'msedgedriver.exe')
-                elif sys.platform.startswith('linux'):
-                    return os.path.join(path, 'msedgedriver.bin')
-                else:
-                    raise Exception('不支持该系统')
-            else:
-                raise Exception('不支持该浏览器')
-
-        if self.browser_name == "chrome":
-            chrome_options = Chrome_Options()
-            chrome_options.add_argument("--headless")
-            # 下面这两个option 用来解决 ssl error code 1, net_error -101 问题
-            chrome_options.add_argument('-ignore-certificate-errors')
-            chrome_options.add_argument('-ignore -ssl-errors')
-            # 忽略selenium自带的报警日志，让日志变得清爽
-            # 如:[1017/143755.402:INFO:CONSOLE(84)] "pascalprecht.translate.$translateSanitization: No sanitization strategy has been configured. This can have serious security implications. See http://angular-translate.github.io/docs/#/guide/19_security for details.", source: https://portal.pku.edu.cn/portal2017/js/angular.min.js (84)
-            chrome_options.add_experimental_option('excludeSwitches', ['enable-logging'])
-
-            chrome_service = Chrome_Service(executable_path=get_driver_path(browser="chrome")) 
-            self.driver = webdriver.Chrome(
-                options=chrome_options,
-                service=chrome_service)
-
-            self.logger.info('Chrome launched\n')
-        elif self.browser_name == "firefox":
-            firefox_options = Firefox_Options()
-            firefox_options.add_argument("--headless")
-
-            firefox_service = Firefox_Service(executable_path=get_driver_path(browser="firefox")) 
-            self.driver = webdriver.Firefox(
-                options=firefox_options,
-                service=firefox_service)
-            self.logger.info('Firefox launched\n')
-        elif self.browser_name == 'edge':
-            edge_options = Edge_Options()
-            edge_options.add_argument("--headless")
-
-            edge_service = Edge_Service(executable_path=get_driver_path(browser="edge"))
-            self.driver = webdriver.Edge(
-                options=edge_options,
-                service=edge_service)
-            self.logger.info('Edge launched\n')
-        else:
-            raise Exception("不支持此类浏览器")
+    def __switch_to_venue(self) -> None:
+        """切换到预约界面所在的标签页"""
+        if self.venue_handle is not None:
+            try:
+                self.driver.switch_to.window(self.venue_handle)
+                return
+            except NoSuchWindowException:
+                self.venue_handle = None
+        self.driver.switch_to.window(self.driver.window_handles[-1])
+
+    def __wait(self, locator: tuple = None, wait_seconds: float = 10) -> None:
+        """等待加载完成, 耗时记录在 metrics 中"""
+        wait_loading_complete(self.driver, locator, wait_seconds, self.metrics)
+
+    def __block_urls(self) -> None:
+        """在当前标签页屏蔽图片、字体等资源, 新打开的标签页需要重新调用"""
+        if LAUNCH_PROFILES[self.browser_profile]['block']:
+            block_urls(self.driver, self.blocked_urls, self.logger)
 
     def stage(stage_name):
         def decorate(func):
             @wraps(func)
             def wrapper(self, *args, **kwargs):
                 if not self.status:
+                    self.metrics.inc('booker_stage_skipped_total', stage=stage_name)
                     return
+                start = time.perf_counter()
+                outcome = 'success'
+                set_log_context(self.logger, stage=stage_name)
                 try:
                     self.logger.info("开始执行 %s" % stage_name)
                     func(self, *args, **kwargs)
                     self.logger.info("执行 %s 完成" % stage_name)
                 except Exception as e:
+                    outcome = 'failure'
                     self.logger.error("执行 %s 失败" % stage_name)
                     self.logger.error(e)
                     self.logger.debug(e, exc_info=True, stack_info=True)
                     self.status = False
+                finally:
+                    # 阶段内部也可能直接把 status 置为 False, 例如付款失败
+                    if not self.status:
+                        outcome = 'failure'
+                    self.metrics.observe('booker_stage_duration_seconds', time.perf_counter() - start,
+                                         stage=stage_name, outcome=outcome)
+                    set_log_context(self.logger, stage='')
             return wrapper
         return decorate
     
@@ -294,17 +472,26 @@ class Booker:
             def wrapper(self, *args, **kwargs):
                 if not self.status:
                     return
-                for i in range(max_retry+1):
-                    if i > 0:
-                        self.logger.info(f'Retrying {i} / {max_retry}.')
-                    try:
-                        func(self, *args, **kwargs)
-                        break
-                    except Exception as e:
-                        if i == max_retry:
-                            raise e
-                        self.logger.debug(e)
-                        self.logger.debug(e, exc_info=True, stack_info=True)
+                step = func.__name__.lstrip('_').replace('Booker__', '')
+                start = time.perf_counter()
+                outcome = 'failure'
+                try:
+                    for i in range(max_retry+1):
+                        if i > 0:
+                            self.logger.info(f'Retrying {i} / {max_retry}.')
+                            self.metrics.inc('booker_retries_total', step=step)
+                        try:
+                            func(self, *args, **kwargs)
+                            outcome = 'success'
+                            break
+                        except Exception as e:
+                            if i == max_retry:
+                                raise e
+                            self.logger.debug(e)
+                            self.logger.debug(e, exc_info=True, stack_info=True)
+                finally:
+                    self.metrics.observe('booker_step_duration_seconds', time.perf_counter() - start,
+                                         step=step, outcome=outcome)
             return wrapper
         return decorate
 
@@ -317,12 +504,9 @@ class Booker:
             max_retry (int, optional): 最大重试次数. Defaults to 3.
         """
 
-        portalURL = "https://portal.pku.edu.cn/portal2017"
-        self.driver.get(portalURL)
-        time.sleep(1)
+        self.driver.get(self.portal_url)
         # 等待界面出现
-        WebDriverWait(self.driver, 10).until(
-            EC.presence_of_all_elements_located((By.CLASS_NAME, "mainWrap02")))
+        self.__wait((By.CLASS_NAME, "mainWrap02"))
 
         # 跳转到登陆界面
         # 找到 '请登录' 按钮
@@ -333,23 +517,17 @@ class Booker:
         # 不能在 --headless 的情况下使用以下方式寻找元素，原因不明
         # mainWindow.find_element(By.PARTIAL_LINK_TEXT, '请登录').click()
         self.logger.info("门户登陆中...")
-        WebDriverWait(self.driver, 10).until(
-            EC.presence_of_element_located((By.ID, "user_name")))
-        # 所有的 time.sleep都是防止被识别，这里多留一点时间sleep也没什么影响，这里应该是在抢票时间到之前就已经登录好了
+        self.__wait((By.ID, "user_name"))
         self.driver.find_element(
             By.ID, "user_name").send_keys(self.user_name)
-        time.sleep(0.5)
         self.driver.find_element(
             By.ID, "password").send_keys(self.password)
-        time.sleep(0.5)
         # self.driver.find_element(By.ID, "logon_button").click()
         element_click(self.driver, self.driver.find_element(By.ID, "logon_button"))
 
         # 检测有没有加载到下一个页面，这里检测门户对应的表格和'全部'按钮
-        WebDriverWait(self.driver,
-                        10).until(EC.visibility_of_element_located((By.CLASS_NAME, 'no-border-table')))
-        WebDriverWait(self.driver,
-                        10).until(EC.visibility_of_element_located((By.ID, 'all')))
+        self.__wait((By.CLASS_NAME, 'no-border-table'))
+        self.__wait((By.ID, 'all'))
 
         # 检测有没有弹窗
         # 疫情防控期间的弹窗逻辑，现在好像没有这个了，或许 deprecated
@@ -360,7 +538,6 @@ class Booker:
                 .click()\
                 .perform()
 
-        time.sleep(0.2)
         self.logger.info("门户登录成功")
 
     @stage(stage_name="进入预约界面")
@@ -371,19 +548,19 @@ class Booker:
         butt_all = self.driver.find_element(By.ID, 'all')
         element_click(self.driver, butt_all)
 
-        wait_loading_complete(self.driver, (By.ID, 'venues'))
-        time.sleep(0.5)
+        self.__wait((By.ID, 'venues'))
 
         # 点击智慧场馆按钮
         element_click(self.driver, self.driver.find_element(By.ID, 'venues'))
         # 打开智慧场馆会新跳出一个界面，通过判断窗口数量来判断是否打开了新界面
-        while len(self.driver.window_handles) < 2:
-            time.sleep(0.5)
+        wait_for_windows(self.driver, 2, metrics=self.metrics)
         self.driver.switch_to.window(self.driver.window_handles[-1])
+        self.venue_handle = self.driver.current_window_handle
+        self.__block_urls()
 
         # 这个 funModuleItem 应该是场馆预定页面独有的，用来判断是否进入了场馆预定页面
-        wait_loading_complete(
-            self.driver, (By.CLASS_NAME, 'funModule'))
+        self.__wait(
+            (By.CLASS_NAME, 'funModule'))
 
         # 找到场地预约按钮并点击
         items = self.driver.find_element(By.CLASS_NAME, 'funModule').find_elements(
@@ -394,37 +571,78 @@ class Booker:
                 break
 
         # '//div [contains(text(),\'%s\')]' 这个是对应羽毛球场/羽毛球馆的按钮的xpath
-        wait_loading_complete(
-            self.driver, (By.XPATH, '//div [contains(text(),\'%s\')]' % self.venue))
-        time.sleep(0.5)
+        self.__wait(
+            (By.XPATH, '//div [contains(text(),\'%s\')]' % self.venue))
 
         element_click(self.driver, self.driver.find_element(By.XPATH, '//div [contains(text(),\'%s\')]' % self.venue))
-        wait_loading_complete(
-            self.driver, (By.CLASS_NAME, 'ivu-form-item-content'))
+        self.__wait(
+            (By.CLASS_NAME, 'ivu-form-item-content'))
 
         self.logger.info("进入预约界面成功")
         # TODO: 这里要加一个判断有没有载入成功的逻辑
 
+    def __http_client_init(self) -> None:
+        """复制浏览器中的 cookie 和 token, 创建直接查询场地的客户端
+
+        失败时不影响后续流程, 只是退回到用浏览器轮询
+        """
+        if self.venue_client is not None:
+            self.venue_client.close()
+        try:
+            self.venue_client = VenueClient(
+                self.http_base_url, self.venue_site_id, logger=self.logger)
+            self.venue_client.load_driver_session(self.driver)
+            self.logger.info("HTTP 轮询已开启")
+        except Exception as e:
+            self.venue_client = None
+            self.logger.warn("HTTP 客户端初始化失败, 使用浏览器轮询")
+            self.logger.debug(e, exc_info=True, stack_info=True)
+
     @stage(stage_name="查找空闲场地")
-    def __find_available_court(self, start_time_list: list, end_time_list: list, delta_day_list: list) -> None:
+    def __find_available_court(self, slot_list: list, delta_day_list: list) -> None:
         """自旋查找空闲场地
 
         Args:
-            start_time_list (`list`): 开始日期列表
-            end_time_list (`list`): 结束日期列表
+            slot_list (`list`): 备选时间段 `SlotSpec` 列表
             delta_day_list (`list`): 距离今天的天数列表
         """
+        # 放场前先进入待命状态, 到点后表格已经停在放场的那一天
+        if self.standby and 3 in delta_day_list and not (self.multi_tab and len(set(delta_day_list)) > 1):
+            self.__standby(3)
+
+        # 浏览器和 HTTP 轮询共用这个账号的请求预算
+        budget = get_budget(self.user_name, self.poll_budget)
+        self.scan_scheduler = PollScheduler(
+            self.release_trigger, self.poll_min_interval, self.poll_base_interval, self.poll_quiet_interval,
+            self.poll_max_interval, budget, name='browser', logger=self.logger, metrics=self.metrics)
+
+        # 先用 HTTP 接口轮询, 直到有空闲场地时再交给浏览器点击
+        if self.venue_client is not None:
+            self.__poll_available_court(slot_list, delta_day_list, budget)
+
         is_find = False
         times = 0
         timeout_count = 0
+        # 每一趟查找都要为每个时间段刷新一次页面
+        cost = len(slot_list)
         while not is_find:
             times += 1
             self.logger.info("查找空闲场地, 第 %d 次尝试" % times)
+            scan_start = time.perf_counter()
+            waited = self.release_waited
             try:
-                is_find = self.__find_available_court_single(
-                    start_time_list, end_time_list, delta_day_list)
-                time.sleep(2 + random.random())  # 防止封号
+                is_find = self.__find_available_court_single(slot_list, delta_day_list)
+                self.scan_scheduler.record(self.__elapsed_since(scan_start, waited) / cost)
+                if is_find:
+                    break
+                if self.watch and self.venue_client is not None:
+                    # 已经没有空闲场地了, 之后只能等退订, 用接口监视代替反复刷新页面
+                    self.__watch_cancellations(slot_list, delta_day_list)
+                    continue
+                self.scan_scheduler.sleep(cost)  # 防止封号
             except  Exception as e:
+                self.scan_scheduler.record(self.__elapsed_since(scan_start, waited) / cost,
+                                           ok=False, throttled=is_throttled(e))
                 timeout_count += 1
                 if timeout_count > 3:
                     self.logger.error("连续失败3次，退出")
@@ -432,232 +650,761 @@ class Booker:
                 else:
                     self.logger.error("加载失败，重试中")
                     self.logger.debug(e, exc_info=True, stack_info=True)
+                    self.scan_scheduler.sleep(cost)
                     continue
 
 
-    def __find_available_court_single(self, start_time_list: list, end_time_list: list, delta_day_list: list) -> bool:
-        """ 完成单趟的查找空闲场地 """
-        self.driver.switch_to.window(self.driver.window_handles[-1])
-        wait_loading_complete(self.driver)
+    def __elapsed_since(self, start: float, waited: float) -> float:
+        """从 start 到现在的耗时, 扣掉期间等待放场的时间
 
-        is_find = False
-        for k in range(len(start_time_list)):
-            self.driver.refresh()
-            wait_loading_complete(self.driver)
-            start_time = start_time_list[k]
-            end_time = end_time_list[k]
-            delta_day = delta_day_list[k]
-            # 若接近但是没到12点，停留在此页面
+        Args:
+            start (`float`): time.perf_counter() 的读数
+
+            waited (`float`): start 时的 release_waited
+        """
+        return time.perf_counter() - start - (self.release_waited - waited)
+
+    def __poll_available_court(self, slot_list: list, delta_day_list: list, budget=None) -> None:
+        """通过 HTTP 接口轮询, 直到某个时间段出现空闲场地
+
+        放场前后按 poll_interval 轮询, 其他时段和出错、限流时由 PollScheduler 放慢。
+        连续失败 3 次说明会话可能已经失效, 此时直接返回, 退回到浏览器轮询
+        """
+        scheduler = PollScheduler(
+            self.release_trigger, self.poll_interval, max(self.poll_interval, self.poll_base_interval / 2),
+            max(self.poll_interval, self.poll_quiet_interval / 2), self.poll_max_interval, budget,
+            name='http', logger=self.logger, metrics=self.metrics)
+        times = 0
+        fail_count = 0
+        while True:
+            times += 1
+            poll_start = time.perf_counter()
+            waited = self.release_waited
+            try:
+                for slot, delta_day in zip(slot_list, delta_day_list):
+                    if delta_day == 3:
+                        self.__wait_for_release()
+                    date = datetime.date.today() + datetime.timedelta(days=delta_day)
+                    table = self.venue_client.fetch_table(date)
+                    if self.history is not None:
+                        self.history.record_table(self.venue, date, table, source='http')
+                    rows = [i for i, venue_time in enumerate(table.labels) if slot.covers(venue_time)]
+                    courts = table.free_courts(rows)
+                    if self.venue_num != -1:
+                        courts = [x for x in courts if x == self.venue_num]
+                    if courts:
+                        self.logger.info("HTTP 轮询第 %d 次发现空闲场地: %s, 耗时 %.1f ms" % (
+                            times, courts, self.venue_client.last_latency * 1000))
+                        return
+                fail_count = 0
+                scheduler.record(self.venue_client.last_latency)
+                self.logger.debug("HTTP 轮询第 %d 次未发现空闲场地, 耗时 %.1f ms" % (
+                    times, self.venue_client.last_latency * 1000))
+            except Exception as e:
+                throttled = is_throttled(e)
+                scheduler.record(self.__elapsed_since(poll_start, waited) / len(slot_list),
+                                 ok=False, throttled=throttled)
+                self.logger.debug(e, exc_info=True, stack_info=True)
+                # 被限流时退避就好, 不算会话失效
+                if not throttled:
+                    fail_count += 1
+                if fail_count >= 3:
+                    self.logger.warn("HTTP 轮询连续失败 3 次, 改用浏览器轮询")
+                    return
+            scheduler.sleep(len(slot_list))
+
+    def __watch_cancellations(self, slot_list: list, delta_day_list: list) -> None:
+        """通过 day/info 接口监视退订, 直到目标时间段空出来
+
+        只在空闲情况发生变化时才匹配目标, 返回后再交给浏览器查找和点击。
+        连续失败时重新复制浏览器的登录状态, 仍然失败则退回到浏览器轮询
+        """
+        today = datetime.date.today()
+        targets = [WatchTarget(today + datetime.timedelta(days=delta_day), slot.start, slot.end, self.venue_num)
+                   for slot, delta_day in zip(slot_list, delta_day_list)]
+        self.logger.info("开始监视退订: %s" % ', '.join(str(t) for t in targets))
+        watcher = CancellationWatcher(
+            self.venue_client, targets, self.watch_interval, self.watch_cpu_budget,
+            logger=self.logger, metrics=self.metrics, history=self.history, venue=self.venue)
+        if watcher.watch():
+            return
+        if not watcher.targets:
+            # 所有时间段都已经开始了, 没有可监视的了
+            self.watch = False
+            return
+        self.__http_client_init()
+        if self.venue_client is None:
+            self.watch = False
+
+    def __find_available_court_single(self, slot_list: list, delta_day_list: list) -> bool:
+        """ 完成单趟的查找空闲场地 """
+        if self.multi_tab and len(set(delta_day_list)) > 1:
+            return self.__find_available_court_tabs(slot_list, delta_day_list)
+
+        self.__switch_to_venue()
+        self.__wait()
+
+        opened = []
+
+        def open_date(delta_day: int) -> None:
+            # 只有一个标签页, 换日期时要刷新后重新切换
+            if opened and opened[-1] == delta_day:
+                return
+            if self.standby_day is not None:
+                standby_day, fired_at = self.standby_day
+                self.standby_day = None
+                if standby_day == delta_day and time.perf_counter() - fired_at < STANDBY_FRESH_SECONDS:
+                    # 待命状态刚刚切换到这一天, 不需要刷新
+                    opened.append(delta_day)
+                    return
+            # 若接近但是没到12点，停留在此页面, 到点后立刻刷新
             if delta_day == 3:
-                self.__spin_wait_until_12()
+                self.__wait_for_release()
+            self.driver.refresh()
+            self.__wait()
+            self.table_page[self.driver.current_window_handle] = 0
 
             # 移动到对应的日期
             self.__move_to_date(delta_day)
+            opened.append(delta_day)
+
+        return self.__select_and_lock(slot_list, delta_day_list, open_date)
 
-            start_hour = datetime.datetime.strptime(
-                start_time.split('-')[1], "%H%M")
-            end_hour = datetime.datetime.strptime(
-                end_time.split('-')[1], "%H%M")
-            day = datetime.datetime.today() + datetime.timedelta(days=delta_day)
-            start_time = datetime.datetime(
-                day.year, day.month, day.day, start_hour.hour, start_hour.minute)
-            end_time = datetime.datetime(
-                day.year, day.month, day.day, end_hour.hour, end_hour.minute)
-
-            self.logger.info("场地开始时间: %s -- 结束时间: %s" % (start_time, end_time))
-
-            table_num = 0
-            is_find = False
-            while not is_find:
-                # 等待加载完成
-                wait_loading_complete(self.driver, (By.CLASS_NAME, 'tableWrap'))
-
-                is_find = self.__click_available_court(
-                    start_hour, end_hour, delta_day, table_num)
-                table_num += 1
-                # 找有没有下一个表
-                table_div = self.driver.find_element(
-                    By.CLASS_NAME, 'tableWrap')
-                forward_arrow = table_div.find_elements(
-                    By.CLASS_NAME, 'ivu-icon-ios-arrow-forward')
-                if forward_arrow:
-                    element_click(self.driver, forward_arrow[0])
+    def __find_available_court_tabs(self, slot_list: list, delta_day_list: list) -> bool:
+        """每个日期一个标签页, 到点后同时刷新, 再按配置的先后顺序扫描
+
+        标签页打不开时退回到单个标签页依次查找
+        """
+        if not self.__open_scan_tabs(delta_day_list):
+            self.multi_tab = False
+            return self.__find_available_court_single(slot_list, delta_day_list)
+
+        if 3 in delta_day_list:
+            self.__wait_for_release('tabs')
+
+        # 到点后依次发出刷新, 各个标签页在浏览器中同时加载
+        start = time.perf_counter()
+        for handle in self.scan_tabs.values():
+            self.driver.switch_to.window(handle)
+            reload_nowait(self.driver)
+            self.table_page[handle] = 0
+
+        # 轮流给每个标签页点下一次 '后一天', 一个标签页加载时去处理其他标签页
+        form = (By.CLASS_NAME, 'ivu-form-item-content')
+        progress = {delta_day: 0 for delta_day in self.scan_tabs}
+        while any(progress[d] <= d for d in progress):
+            for delta_day, handle in self.scan_tabs.items():
+                if progress[delta_day] > delta_day:
+                    continue
+                self.driver.switch_to.window(handle)
+                if progress[delta_day] == 0:
+                    self.__wait(form)
                 else:
+                    wait_clicked(self.driver, form, metrics=self.metrics)
+                if progress[delta_day] < delta_day:
+                    click_nowait(self.driver, self.__date_buttons()[1])
+                progress[delta_day] += 1
+        self.logger.info("%d 个标签页刷新并切换到对应日期, 耗时 %.0f ms" % (
+            len(self.scan_tabs), (time.perf_counter() - start) * 1000))
+        self.metrics.observe('booker_tabs_ready_seconds', time.perf_counter() - start)
+
+        def open_date(delta_day: int) -> None:
+            self.venue_handle = self.scan_tabs[delta_day]
+            self.driver.switch_to.window(self.venue_handle)
+
+        return self.__select_and_lock(slot_list, delta_day_list, open_date)
+
+    def __open_scan_tabs(self, delta_day_list: list) -> bool:
+        """为每个不同的日期准备一个停在该日期的标签页, 已经打开的标签页会被复用
+
+        Returns:
+            bool: 是否全部打开成功
+        """
+        delta_days = list(dict.fromkeys(delta_day_list))
+        handles = self.driver.window_handles
+        if self.scan_tabs and sorted(self.scan_tabs) == sorted(delta_days) and \
+                all(h in handles for h in self.scan_tabs.values()):
+            return True
+
+        self.__switch_to_venue()
+        url = self.driver.current_url
+        # 第一个日期使用原来的预约界面, 其他日期新开标签页
+        scan_tabs = {delta_days[0]: self.venue_handle}
+        try:
+            for delta_day in delta_days[1:]:
+                self.driver.switch_to.new_window('tab')
+                self.__block_urls()
+                self.driver.get(url)
+                self.__wait((By.CLASS_NAME, 'ivu-form-item-content'))
+                scan_tabs[delta_day] = self.driver.current_window_handle
+            for delta_day, handle in scan_tabs.items():
+                self.driver.switch_to.window(handle)
+                self.__move_to_date(delta_day)
+        except Exception as e:
+            self.logger.warn("打开多个标签页失败, 改为在一个标签页中依次查找")
+            self.logger.debug(e, exc_info=True, stack_info=True)
+            for handle in scan_tabs.values():
+                if handle != self.venue_handle and handle in self.driver.window_handles:
+                    self.driver.switch_to.window(handle)
+                    self.driver.close()
+            self.__switch_to_venue()
+            return False
+        self.scan_tabs = scan_tabs
+        self.logger.info("已为 %d 个日期各打开一个标签页" % len(scan_tabs))
+        return True
+
+    def __select_and_lock(self, slot_list: list, delta_day_list: list,
+                          open_date) -> bool:
+        """读取各个备选时间段的场地表格, 选出最好的候选场地并点击
+
+        按先后顺序读取每个备选时间段所在日期的所有页, 已经找到完整覆盖的候选时不再看后面的备选时间段,
+        找到不可能被超过的候选时不再往后翻页。
+
+        Args:
+            open_date (`callable`): open_date(delta_day) 让当前标签页停在对应的日期
+
+        Returns:
+            bool: 是否点击了空闲场地
+        """
+        windows = [Window(k, delta_day, slot.start, slot.end)
+                   for k, (slot, delta_day) in enumerate(zip(slot_list, delta_day_list))]
+        scan_start = time.time()
+        snapshots = {}
+        candidates = []
+        for window in windows:
+            self.logger.info("备选时间段: %s" % slot_list[window.index])
+            if window.delta_day in snapshots:
+                # 与前面的备选时间段在同一天, 直接用读过的表格
+                for table in snapshots[window.delta_day]:
+                    candidates.extend(candidates_in_table(window, table, self.venue_num, self.court_ranks))
+            else:
+                def on_table(table: CourtTable, window: Window = window) -> bool:
+                    candidates.extend(candidates_in_table(window, table, self.venue_num, self.court_ranks))
+                    return is_unbeatable(best_candidate(candidates), window)
+
+                open_date(window.delta_day)
+                snapshots[window.delta_day] = self.__snapshot_date(window.delta_day, on_table)
+            best = best_candidate(candidates)
+            # 完整覆盖的候选不会被后面的备选时间段超过
+            if best is not None and best.full:
+                break
+
+        # 点击之前表格可能已经变了, 用最新的那一页重新选择
+        # 已经被其他账号认领的候选放到最后, 没有别的候选时才去抢
+        self.backups = []
+        contested = []
+        clicks = 0
+        while clicks < 3:
+            start = time.perf_counter()
+            best = best_candidate(candidates)
+            self.metrics.observe('booker_selection_seconds', time.perf_counter() - start)
+            if best is None:
+                if not contested:
                     break
-            if is_find:
+                best = best_candidate(contested)
+                contested.remove(best)
+                self.logger.info("剩下的候选都已被其他账号认领, 仍然尝试 %s" % best)
+            elif not self.__claim(best, snapshots[best.window.delta_day][best.table_num].labels, scan_start):
+                candidates.remove(best)
+                contested.append(best)
+                continue
+            self.logger.info("从 %d 个候选中选中 %s" % (len(candidates), best))
+            clicks += 1
+            delta_day = best.window.delta_day
+            open_date(delta_day)
+            table = self.__go_to_page(delta_day, best.table_num)
+            if self.__click_candidate(best, table):
                 self.logger.info("找到空闲场地")
-                break
-            else:
-                self.logger.info("未找到空闲场地")
-        return is_find
+                if self.speculative:
+                    # 后备候选等到识别验证码时再在其他标签页中提交
+                    self.backups = backup_candidates(best, candidates, self.speculative_candidates)
+                    self.backup_url = self.driver.current_url
+                    if not self.backups and self.speculative_candidates > 1:
+                        # 例如两小时的时间段, 主候选已经占满了当天的 2 个时段, 推测模式不起作用
+                        self.logger.info("没有可以同时提交的后备候选 (同一天最多 %d 个时段, 选中的场地占了 %d 个)" % (
+                            MAX_SLOTS_PER_DAY, len(best.rows)))
+                        self.metrics.inc('booker_speculative_total', outcome='no_backup')
+                return True
+            self.__release_claim()
+            candidates = [c for c in candidates
+                          if c.window.delta_day != delta_day or c.table_num != best.table_num]
+            for window in windows:
+                if window.delta_day == delta_day:
+                    candidates.extend(candidates_in_table(window, table, self.venue_num, self.court_ranks))
+        self.logger.info("未找到空闲场地")
+        return False
 
-    def __spin_wait_until_12(self) -> None:
-        """循环等待到12点 """
-        # 等待到12点
-        while True:
-            now = datetime.datetime.now()
-            if now.hour >= 12:
-                break
-            else:
-                self.logger.info("抢场时间未到，等待中...")
-                time.sleep(0.1)
+    def __claim(self, candidate, labels: list, since: float) -> bool:
+        """认领候选的格子
 
-    def __move_to_date(self, delta_day: int) -> None:
-        """移动表格页面到对应的日期"""
-        for i in range(delta_day):
-            WebDriverWait(self.driver, 10).until(
-                EC.visibility_of_element_located((By.CLASS_NAME, 'ivu-form-item-content')))
-            head = self.driver.find_element(
-                By.CLASS_NAME, 'ivu-form-item-content')
-            btn = head.find_elements(By.CLASS_NAME, 'ivu-btn')
-            # btn0是向前的按钮，btn1是向后的按钮
-            element_click(self.driver, btn[1])
-            time.sleep(0.1)
-
-    def __click_available_court(self, start_time: datetime.datetime, end_time: datetime.datetime, delta_day: int, table_num: int) -> bool:
-        """点击空闲场地
+        其他账号已经认领, 或者在 since 之后看到这些格子已经被占用时返回 False。
+        协调出错时不影响抢场, 当作认领成功
 
         Args:
-            start_time (`datetime`): 场地开始时间 
+            candidate (`Candidate`): 候选
 
-            end_time (`datetime`): 场地结束时间 
+            labels (`list`): 候选所在页表格的时间段
 
-            delta_day (`int`): 距离今天的天数
+            since (`float`): 这一轮读取表格开始的时间戳
+        """
+        if self.coordinator is None:
+            return True
+        # 上一次认领的场地没有锁定 (确认或验证码失败), 先放弃, 其他账号不用等到过期
+        self.__release_claim()
+        date = datetime.date.today() + datetime.timedelta(days=candidate.window.delta_day)
+        keys = cell_keys(self.venue, date, candidate.court, [labels[row] for row in candidate.rows])
+        try:
+            if self.coordinator.taken_since(keys, since):
+                self.logger.info("%d号场地已被其他账号看到被占用, 换一个" % candidate.court)
+                self.metrics.inc('booker_coordination_total', outcome='taken')
+                return False
+            if not self.coordinator.claim(self.user_name, keys, self.claim_ttl):
+                self.logger.info("%d号场地已被其他账号认领, 换一个" % candidate.court)
+                self.metrics.inc('booker_coordination_total', outcome='contested')
+                return False
+        except Exception as e:
+            self.logger.warn("账号协调失败, 直接点击")
+            self.logger.debug(e, exc_info=True, stack_info=True)
+            return True
+        self.metrics.inc('booker_coordination_total', outcome='claimed')
+        self.claimed_keys = keys
+        return True
+
+    def __release_claim(self) -> None:
+        if self.coordinator is None or not self.claimed_keys:
+            return
+        try:
+            self.coordinator.release(self.user_name, self.claimed_keys)
+        except Exception as e:
+            self.logger.debug(e, exc_info=True, stack_info=True)
+        self.claimed_keys = []
+
+    def __publish_table(self, delta_day: int, table: CourtTable) -> None:
+        """把读到的一页表格发布给其他账号"""
+        date = (datetime.date.today() + datetime.timedelta(days=delta_day)).strftime("%Y-%m-%d")
+        try:
+            self.coordinator.publish(self.venue, date, [
+                (table.court_num(col), label, table.is_free(row, col))
+                for row, label in enumerate(table.labels) for col in table.col_index_list])
+        except Exception as e:
+            self.logger.debug(e, exc_info=True, stack_info=True)
+
+    def __snapshot_date(self, delta_day: int, on_table=None) -> list:
+        """在已经切换到对应日期的页面上逐页读取场地表格
 
-            table_num (`int`): 表格编号
+        Args:
+            on_table (`callable`, optional): 每读到一页调用一次, 返回 True 时不再往后翻页. Defaults to None.
 
         Returns:
-            bool: 是否找到空闲场地
+            list: 每一页的 CourtTable, 结束时停在最后读到的那一页
         """
+        tables = []
+        while True:
+            # 等待加载完成
+            self.__wait((By.CLASS_NAME, 'tableWrap'))
+            table = self.__get_table_snapshot(delta_day, len(tables))
+            if self.history is not None:
+                self.history.record_table(
+                    self.venue, datetime.date.today() + datetime.timedelta(days=delta_day), table)
+            if self.coordinator is not None:
+                self.__publish_table(delta_day, table)
+            tables.append(table)
+            if self.trigger_at is not None:
+                elapsed = time.perf_counter() - self.trigger_at
+                self.trigger_at = None
+                self.logger.info("放场触发到第一次读到表格耗时 %.0f ms (%s)" % (elapsed * 1000, self.trigger_mode))
+                self.metrics.observe('booker_trigger_to_scan_seconds', elapsed, mode=self.trigger_mode)
+            if on_table is not None and on_table(table):
+                break
+            # 找有没有下一个表
+            if not self.__turn_page(1):
+                break
+        self.table_page[self.driver.current_window_handle] = len(tables) - 1
+        return tables
 
-        def judge_in_time_range(start_time: datetime.datetime, end_time: datetime.datetime, venue_time_range: str) -> bool:
-            vt = venue_time_range.split('-')
-            vt_start_time = datetime.datetime.strptime(vt[0], "%H:%M")
-            vt_end_time = datetime.datetime.strptime(vt[1], "%H:%M")
-            if start_time <= vt_start_time and vt_end_time <= end_time:
-                return True
-            else:
-                return False
+    def __turn_page(self, step: int) -> bool:
+        """表格向后 (step 为 1) 或向前 (step 为 -1) 翻一页
 
-        def check_if_court_available(available_rows_list: list, col_index: int) -> bool:
-            """检查场地是否可用
-            """
-            for tr in available_rows_list:
-                cell_classes = tr[col_index].find_element(
-                    By.TAG_NAME, 'div').get_attribute('class')
-                if 'free' in cell_classes.split():
-                    return True
+        Returns:
+            bool: 是否有可以翻的页
+        """
+        arrow = 'ivu-icon-ios-arrow-forward' if step > 0 else 'ivu-icon-ios-arrow-back'
+        table_div = self.driver.find_element(By.CLASS_NAME, 'tableWrap')
+        arrows = table_div.find_elements(By.CLASS_NAME, arrow)
+        if not arrows:
             return False
+        # 等到表格换成另一页的场地
+        try:
+            click_and_wait(self.driver, arrows[0], (By.CLASS_NAME, 'tableWrap'),
+                           watch='.tableWrap', metrics=self.metrics)
+        except TimeoutException:
+            self.logger.debug("翻页后表格没有变化")
+        return True
+
+    def __go_to_page(self, delta_day: int, table_num: int) -> CourtTable:
+        """翻到第 table_num 页, 返回这一页最新的表格"""
+        handle = self.driver.current_window_handle
+        page = self.table_page.get(handle, 0)
+        while page != table_num:
+            step = 1 if table_num > page else -1
+            if not self.__turn_page(step):
+                raise Exception("无法翻到第 %d 页场地" % (table_num + 1))
+            page += step
+            self.table_page[handle] = page
+        return self.__get_table_snapshot(delta_day, table_num)
+
+    def __wait_for_release(self, mode: str = 'refresh') -> None:
+        """按服务器时间等待到12点放场
 
-        # 找到对应的表格
-        rows = self.__get_table_rows(delta_day)
-        # 筛选有效行
-        valid_rows_list = []
-        venue_time_list = []
-        for i in range(1, len(rows) - 2):
-            venue_time = rows[i].find_elements(By.TAG_NAME,
-                                               'td')[0].find_element(By.TAG_NAME, 'div').text
-            if judge_in_time_range(start_time, end_time, venue_time):
-                valid_rows_list.append(
-                    rows[i].find_elements(By.TAG_NAME, 'td'))
-                venue_time_list.append(venue_time)
-        if len(valid_rows_list) == 0:
+        Args:
+            mode (`str`): 触发后的处理方式, 只用于统计触发到第一次读到表格的耗时. Defaults to 'refresh'.
+        """
+        if not self.release_trigger.released():
+            start = time.perf_counter()
+            self.release_trigger.wait()
+            self.trigger_at = time.perf_counter()
+            self.trigger_mode = mode
+            self.release_waited += self.trigger_at - start
+
+    def __standby(self, delta_day: int) -> None:
+        """放场前的待命状态
+
+        放场前 standby_lead 秒确认登录状态并同步服务器时钟, 把表格停在放场日期的前一天,
+        确认 '后一天' 按钮可用, 之后每隔 standby_keepalive 秒前后切换一次日期保持会话。
+        到点后只点一次 '后一天', 页面不刷新, 只重新请求这一天的场地数据。
+        待命失败时什么也不做, 到点后照常刷新并切换日期。
+        """
+        trigger = self.release_trigger
+        if trigger.released():
+            return
+        remain = trigger.release_timestamp() - trigger.clock.now()
+        if remain > self.standby_lead:
+            self.logger.info("距离放场还有 %.0f s, %.0f s 后进入待命状态" % (remain, remain - self.standby_lead))
+            time.sleep(remain - self.standby_lead)
+
+        try:
+            self.__arm_standby(delta_day)
+            while True:
+                remain = trigger.release_timestamp() - trigger.clock.now()
+                if remain <= STANDBY_QUIET_SECONDS:
+                    break
+                time.sleep(min(self.standby_keepalive, remain - STANDBY_QUIET_SECONDS))
+                if trigger.release_timestamp() - trigger.clock.now() > STANDBY_QUIET_SECONDS:
+                    self.__keep_alive(delta_day)
+
+            self.__wait_for_release('standby')
+            # 表格由前一天换成放场这一天即可开始查找
+            self.__click_date_button(1, (By.CLASS_NAME, 'tableWrap'), watch='.tableWrap')
+            self.table_page[self.driver.current_window_handle] = 0
+            self.standby_day = (delta_day, time.perf_counter())
+        except Exception as e:
+            self.logger.warn("待命状态失败, 到点后刷新页面")
+            self.logger.debug(e, exc_info=True, stack_info=True)
+
+    def __arm_standby(self, delta_day: int) -> None:
+        """确认登录状态, 把表格停在 delta_day 的前一天"""
+        if not self.release_trigger.clock.synced:
+            try:
+                self.release_trigger.clock.sync()
+            except Exception as e:
+                self.logger.warn("服务器时钟同步失败, 使用本机时间")
+                self.logger.debug(e, exc_info=True, stack_info=True)
+
+        self.__switch_to_venue()
+        self.driver.refresh()
+        try:
+            self.__wait((By.CLASS_NAME, 'ivu-form-item-content'))
+        except TimeoutException:
+            self.logger.info("登录状态已失效, 重新登录")
+            self.page_init(self.driver)
+            if not self.status:
+                raise Exception("重新登录失败")
+        self.table_page[self.driver.current_window_handle] = 0
+        self.__move_to_date(delta_day - 1)
+        self.__wait((By.CLASS_NAME, 'tableWrap'))
+        if not self.__date_buttons()[1].is_enabled():
+            raise Exception("'后一天' 按钮不可用")
+        self.logger.info("已进入待命状态, 表格停在 %d 天后" % (delta_day - 1))
+
+    def __keep_alive(self, delta_day: int) -> None:
+        """前后切换一次日期, 让场馆后端收到带登录状态的请求, 失败时重新进入待命状态"""
+        try:
+            self.__click_date_button(0)
+            self.__click_date_button(1)
+            self.__wait((By.CLASS_NAME, 'tableWrap'))
+            self.logger.debug("保持会话")
+        except Exception as e:
+            self.logger.info("保持会话失败, 重新进入待命状态")
+            self.logger.debug(e, exc_info=True, stack_info=True)
+            self.__arm_standby(delta_day)
+
+    def __date_buttons(self) -> list:
+        """btn0是向前的按钮，btn1是向后的按钮"""
+        head = self.driver.find_element(By.CLASS_NAME, 'ivu-form-item-content')
+        return head.find_elements(By.CLASS_NAME, 'ivu-btn')
+
+    def __click_date_button(self, index: int, locator: tuple = (By.CLASS_NAME, 'ivu-form-item-content'),
+                            watch: str = None) -> None:
+        """点击前一天 (index 为 0) 或后一天 (index 为 1), 等这一次切换日期的加载完成"""
+        self.__wait((By.CLASS_NAME, 'ivu-form-item-content'))
+        try:
+            click_and_wait(self.driver, self.__date_buttons()[index], locator, watch=watch, metrics=self.metrics)
+        except TimeoutException:
+            self.logger.debug("切换日期后页面没有变化")
+
+    def __move_to_date(self, delta_day: int) -> None:
+        """移动表格页面到对应的日期"""
+        for i in range(delta_day):
+            self.__click_date_button(1)
+
+    def __click_candidate(self, candidate, table: CourtTable) -> bool:
+        """确认候选的格子在最新的表格中仍然空闲, 再点击
+
+        Args:
+            candidate (`Candidate`): 选中的候选
+
+            table (`CourtTable`): 候选所在页最新的表格
+
+        Returns:
+            bool: 是否点击了
+        """
+        col_index = candidate.court - table.table_num * COURTS_PER_TABLE
+        if col_index not in table.col_index_list or \
+                len(table.free_rows(candidate.rows, col_index)) != len(candidate.rows):
+            self.logger.info("%d号场地已经被占用, 重新选择" % candidate.court)
             return False
 
-        # 筛选有效场地
-        col_index_list = [x for x in range(1, len(valid_rows_list[0]))]
-        has_checked_num = table_num * 5
-        self.logger.debug("当前场地号: %d" % self.venue_num)
-        self.logger.debug("当前表格号: %d" % table_num)
-        self.logger.debug("当前表格中场地号: %s" %
-                          [x + has_checked_num for x in col_index_list])
-
-        col_index = None
-        if self.venue_num != -1:
-            # 如果指定了场地号，就只检查指定的场地号
-            if self.venue_num - has_checked_num in col_index_list:
-                col_index = self.venue_num - has_checked_num
-                is_available = check_if_court_available(
-                    valid_rows_list, col_index)
-            else:
-                return False
-        else:
-            # shuffle一下index_list，防止每次都点第一列
-            random.shuffle(col_index_list)
-            self.logger.debug("随机后当前表格中场地号: %s" %
-                              [x + has_checked_num for x in col_index_list])
-            for col_index in col_index_list:
-                is_available = check_if_court_available(
-                    valid_rows_list, col_index)
-                if is_available:
-                    self.venue_num = col_index + has_checked_num  # 更新场地号
-                    break
-        if is_available:
-            for i in range(len(valid_rows_list)):
-                cell = valid_rows_list[i][col_index].find_element(
-                    By.TAG_NAME, 'div')
-                if 'free' in cell.get_attribute('class').split():
-                    element_click(self.driver, cell)
-                    self.venue_time_list.append(venue_time_list[i])
-            return True
-        return False
+        # 一次 execute_script 取回所有要点击的单元格
+        with count_webdriver_commands(self.driver) as counter:
+            for row, cell in zip(candidate.rows, find_cells(self.driver, table, candidate.rows, col_index)):
+                element_click(self.driver, cell)
+                self.venue_time_list.append(table.labels[row])
+        self.venue_num = candidate.court  # 更新场地号
+        self.logger.debug("点击场地使用 webdriver 指令 %d 次" % counter.count)
+        return True
 
-    def __get_table_rows(self, delta_day) -> list:
-        """ 获取预定场地表的行
+    def __get_table_snapshot(self, delta_day: int, table_num: int) -> CourtTable:
+        """ 获取预定场地表的快照
 
         这里使用delta_day是为了防止表格加载不出来, 实在加载不出来就重新move一下
         """
-        rows = self.driver.find_elements(By.TAG_NAME, 'tr')
+        with count_webdriver_commands(self.driver) as counter:
+            table = snapshot_court_table(self.driver, table_num)
+        if table.is_loaded:
+            # 全局排序要看这一页所有场地的所有时间段
+            self.logger.debug("读取表格使用 webdriver 指令 %d 次, 逐个元素查找约需 %d 次" % (
+                counter.count, estimate_legacy_commands(table, len(table.labels), len(table.col_index_list))))
         # 如果表格没有加载出来，就刷新一下
         no_table_count = 0
-        while rows[1].find_elements(By.TAG_NAME,
-                                    'td')[0].find_element(By.TAG_NAME, 'div').text == "时间段":
+        while not table.is_loaded:
             no_table_count += 1
-            time.sleep(0.2)
-            rows = self.driver.find_elements(By.TAG_NAME, 'tr')
+            wait_for_change(self.driver, '.tableWrap', timeout=0.2, metrics=self.metrics)
+            table = snapshot_court_table(self.driver, table_num)
             if no_table_count > 10:
                 self.driver.refresh()
-                wait_loading_complete(self.driver, (By.CLASS_NAME, 'tableWrap'))
+                self.__wait((By.CLASS_NAME, 'tableWrap'))
                 no_table_count = 0
                 self.__move_to_date(delta_day)
-        return rows
+        return table
 
     @stage(stage_name="确认预约")
     def __confirm_booking(self) -> None:
         """确认预定
         """
-        self.driver.switch_to.window(self.driver.window_handles[-1])
+        self.__switch_to_venue()
+        self.__click_confirm()
 
+    def __click_confirm(self) -> None:
+        """在当前标签页同意预约须知并点击'我要预约'"""
         # 同意预约须知
         self.logger.info("同意预约须知")
-        wait_loading_complete(
-            self.driver, (By.CLASS_NAME, 'ivu-checkbox-wrapper'))
+        self.__wait(
+            (By.CLASS_NAME, 'ivu-checkbox-wrapper'))
         element_click(self.driver, self.driver.find_element(By.CLASS_NAME, 'ivu-checkbox-wrapper'))
 
         # 点击'我要预约'
         self.logger.info("点击'我要预约'")
-        wait_loading_complete(self.driver, (By.CLASS_NAME, 'payHandle'))
+        self.__wait((By.CLASS_NAME, 'payHandle'))
         payBtns = self.driver.find_element(
             By.CLASS_NAME, 'reservationStep1').find_elements(By.CLASS_NAME, 'payHandleItem')
         element_click(self.driver, payBtns[1])
 
     @stage(stage_name="提交订单")
     def __submit_order(self) -> None:
-        self.driver.switch_to.window(self.driver.window_handles[-1])
-        # 点击提交订单按钮
-        wait_loading_complete(self.driver, (By.CLASS_NAME, 'payHandleItem'))
+        self.__switch_to_venue()
+        self.__click_submit()
+
+    def __click_submit(self) -> None:
+        """在当前标签页点击提交订单按钮"""
+        self.__wait((By.CLASS_NAME, 'payHandleItem'))
         submitBtns = self.driver.find_element(
             By.CLASS_NAME, 'reservation-step-two').find_elements(By.CLASS_NAME, 'payHandleItem')
         element_click(self.driver, submitBtns[1])
 
     @stage(stage_name="填写验证码")
     def __complete_captcha(self, max_retry=3) -> None:
-        wait_loading_complete(self.driver, (By.CLASS_NAME, 'verify-img-out'))
+        if not self.backups:
+            self.__solve_captcha(max_retry)
+            return
+
+        # 推测模式: 识别验证码的同时在其他标签页中提交后备候选, 都停在验证码界面。
+        # 验证码依次填写, 第一个进入付款界面的候选胜出, 其余的标签页直接关闭。
+        # 订单在填完验证码后才会生成, 关闭停在验证码界面的标签页不会占着场地
+        backups, self.backups = self.backups, []
+        attempts = [(self.venue_handle, self.venue_num, list(self.venue_time_list))]
+        # 所有打开过的后备标签页, 包括还没有提交完的
+        opened = []
+        steps = None
+
+        def prepare_backup() -> bool:
+            """把后备候选的提交往前推进一步, 没有可以提交的了返回 False"""
+            nonlocal steps
+            while True:
+                if steps is None:
+                    if not backups:
+                        return False
+                    steps = self.__backup_steps(backups.pop(0), opened)
+                try:
+                    next(steps)
+                    return True
+                except StopIteration as stop:
+                    steps = None
+                    if stop.value is not None:
+                        attempts.append(stop.value)
+                        return True
+
+        def submitted(index: int) -> bool:
+            """推进后备候选, 直到第 index 个候选已经停在验证码界面"""
+            while index >= len(attempts):
+                if not prepare_backup():
+                    return False
+            return True
+
+        error = None
+        index = 0
+        while submitted(index):
+            self.venue_handle, self.venue_num, time_list = attempts[index]
+            self.venue_time_list = list(time_list)
+            self.__switch_to_venue()
+            try:
+                self.__solve_captcha(max_retry, prepare_backup if backups or steps is not None else None)
+                if self.court_locked:
+                    break
+                error = Exception("%d号场地没有进入付款界面" % self.venue_num)
+            except Exception as e:
+                error = e
+            self.logger.warn("%d号场地的验证码没有通过, 换下一个已提交的候选" % self.venue_num)
+            self.logger.debug(error, exc_info=True, stack_info=True)
+            index += 1
+
+        if steps is not None:
+            steps.close()
+        winner = index if self.court_locked else 0
+        winner_handle = attempts[winner][0]
+        for handle in [attempt[0] for attempt in attempts] + opened:
+            if handle != winner_handle:
+                self.__close_backup(handle)
+        self.venue_handle, self.venue_num, time_list = attempts[winner]
+        self.venue_time_list = list(time_list)
+        self.__switch_to_venue()
+        self.metrics.inc('booker_speculative_total', outcome=(
+            'failure' if not self.court_locked else 'primary' if winner == 0 else 'backup'))
+        if not self.court_locked:
+            raise error
+        if winner > 0:
+            self.logger.info("后备候选 %d号场地先进入付款界面" % self.venue_num)
+
+    def __backup_steps(self, candidate, opened: list):
+        """新开一个标签页点击后备候选并提交订单, 停在验证码界面
+
+        生成器, 每条 webdriver 指令或一次短轮询之后 yield 一次, 调用方可以在两次之间切回主候选的标签页,
+        例如验证码识别结果已经回来; 继续执行时先切回这个标签页。页面加载和等待验证码都用轮询, 不会长时间阻塞
+
+        Args:
+            candidate (`Candidate`): 后备候选
+
+            opened (`list`): 打开的标签页会加入这个列表, 由调用方最后关闭
+
+        Returns:
+            tuple: 生成器的返回值, (标签页, 场地号, 时间段列表), 提交失败时关闭标签页并返回 None
+        """
+        start = time.perf_counter()
+        handle = None
+        try:
+            self.driver.switch_to.new_window('tab')
+            handle = self.driver.current_window_handle
+            opened.append(handle)
+            self.__block_urls()
+            # 不等页面加载完就返回, 之后轮询表单是否出现
+            self.driver.execute_script("window.location.href = arguments[0];", self.backup_url)
+            yield from self.__backup_poll(handle, 'ivu-form-item-content')
+            delta_day = candidate.window.delta_day
+            for _ in range(delta_day):
+                self.__click_date_button(1)
+                yield
+                self.driver.switch_to.window(handle)
+            self.table_page[handle] = 0
+            table = self.__go_to_page(delta_day, candidate.table_num)
+            yield
+            self.driver.switch_to.window(handle)
+
+            # 点击会修改主候选的场地号和时间段, 这一步中间不能 yield
+            venue_num, time_list = self.venue_num, self.venue_time_list
+            self.venue_time_list = []
+            try:
+                if not self.__click_candidate(candidate, table):
+                    self.__close_backup(handle)
+                    return None
+                attempt = (handle, self.venue_num, self.venue_time_list)
+            finally:
+                self.venue_num, self.venue_time_list = venue_num, time_list
+            yield
+            self.driver.switch_to.window(handle)
+
+            self.__click_confirm()
+            yield
+            self.driver.switch_to.window(handle)
+            self.__click_submit()
+            yield from self.__backup_poll(handle, 'verify-img-out')
+            self.logger.info("后备候选 %s 已提交, 耗时 %.0f ms" % (candidate, (time.perf_counter() - start) * 1000))
+            self.metrics.observe('booker_backup_prepare_seconds', time.perf_counter() - start)
+            return attempt
+        except Exception as e:
+            self.logger.info("提交后备候选 %s 失败" % candidate)
+            self.logger.debug(e, exc_info=True, stack_info=True)
+            self.__close_backup(handle)
+            return None
+
+    def __backup_poll(self, handle: str, class_name: str, timeout: float = 10):
+        """在后备标签页中轮询元素出现, 每次没找到时 yield 一次, 供 __backup_steps 使用"""
+        deadline = time.perf_counter() + timeout
+        while not check_element_exist(self.driver, By.CLASS_NAME, class_name):
+            if time.perf_counter() > deadline:
+                raise TimeoutException("等待 %s 超时" % class_name)
+            time.sleep(0.05)
+            yield
+            self.driver.switch_to.window(handle)
+        self.__wait((By.CLASS_NAME, class_name))
+
+    def __close_backup(self, handle: str) -> None:
+        if handle is not None and handle in self.driver.window_handles:
+            self.driver.switch_to.window(handle)
+            self.driver.close()
+        self.table_page.pop(handle, None)
+
+    def __solve_captcha(self, max_retry: int = 3, prepare=None) -> None:
+        """在当前标签页识别并填写验证码, 进入付款界面后置 court_locked
+
+        Args:
+            prepare (`callable`, optional): 等待识别结果的同时反复调用, 返回 False 时停止. Defaults to None.
+        """
+        self.__wait((By.CLASS_NAME, 'verify-img-out'))
         """
         20231019 线上测试在这里有问题
         FIXME:
         错误路径：在识别完成后疑似没有跳转到付款界面，失败后重试时也找不到验证码图片的元素
         """
+        handle = self.driver.current_window_handle
         for i in range(max_retry+1):
             if i > 0:
                 self.logger.info(f'Retrying {i} / {max_retry}.')
@@ -678,10 +1425,20 @@ class Booker:
             verify_msg = verify_msg_element.text.replace(',', '')
             content = verify_msg[verify_msg.find('【')+1:verify_msg.find('】')]
 
+            result = None
             try:
-                points = verify(base_img, content, self.tt_usr, self.tt_pwd)
+                if prepare is None:
+                    result = self.captcha_solver.solve(base_img, content)
+                else:
+                    # 识别结果回来之前去其他标签页提交后备候选, 回来后立即点击
+                    with ThreadPoolExecutor(max_workers=1) as executor:
+                        future = executor.submit(self.captcha_solver.solve, base_img, content)
+                        while not future.done() and prepare():
+                            pass
+                        self.driver.switch_to.window(handle)
+                        result = future.result()
                 action = ActionChains(self.driver)
-                for point in points:
+                for point in result.points:
                     # 这里需要先移入中心，再移入左上角，再移入目标点，不然会出现偏移
                     action.move_to_element(base_img_element).move_by_offset(
                         -base_img_element.size['width']/2, -
@@ -689,22 +1446,40 @@ class Booker:
                     ).move_by_offset(
                         point[0]*scale[0], point[1]*scale[1]).click().perform()
                 # FIXME: wait to short?
-                wait_loading_complete(
-                    self.driver, (By.CLASS_NAME, 'payMent'), wait_seconds=5)
-                if check_element_exist(self.driver, By.CLASS_NAME, 'payMent'):
+                self.__wait((By.CLASS_NAME, 'payMent'), wait_seconds=5)
+                locked = check_element_exist(self.driver, By.CLASS_NAME, 'payMent')
+                self.__report_captcha(base_img, content, result, locked)
+                result = None
+                if locked:
                     self.court_locked = True
                     break
             except Exception as e:
+                # 点击之后没有进入付款界面, 说明识别结果是错的
+                if result is not None:
+                    self.__report_captcha(base_img, content, result, False)
                 if i == max_retry:
                     # 达到最大重试次数，抛出异常
                     raise e
                 self.logger.error(f"验证码识别失败")
                 self.logger.debug(e, exc_info=True, stack_info=True)
+            finally:
+                self.logger.debug("验证码识别统计: %s" % self.captcha_solver.summary())
+
+    def __report_captcha(self, base_img: str, content: str, result, correct: bool) -> None:
+        """记录识别结果是否正确, 开启了 capture_dir 时保存验证码图片"""
+        self.captcha_solver.report(result, correct)
+        self.metrics.observe('booker_captcha_seconds', result.latency,
+                             backend=result.backend, outcome='success' if correct else 'failure')
+        if self.captcha_capture_dir:
+            try:
+                save_capture(self.captcha_capture_dir, base_img, content, result, correct)
+            except Exception as e:
+                self.logger.debug(e, exc_info=True, stack_info=True)
 
     @stage(stage_name="付款")
     def __pay(self) -> None:
         self.logger.info("使用校园卡进行快速支付")
-        self.driver.switch_to.window(self.driver.window_handles[-1])
+        self.__switch_to_venue()
         # 选择使用校园卡
         payMent = self.driver.find_element(By.CLASS_NAME, 'payMent')
         payMentItems = payMent.find_elements(By.CLASS_NAME, 'payMentItem')
@@ -715,7 +1490,7 @@ class Booker:
         element_click(self.driver, payBtns[1])
 
         # 检查是否成功
-        wait_loading_complete(self.driver, (By.CLASS_NAME, 'promoptCon'))
+        self.__wait((By.CLASS_NAME, 'promoptCon'))
         self.status = check_element_exist(
             self.driver, By.CLASS_NAME, 'promoptCon')
 
@@ -733,7 +1508,11 @@ class Booker:
         for time_range in self.venue_time_list:
             content += f"学号: {self.user_name} 成功预约: {place} {self.venue_num}号场地 {time_range}\n"
         content += "\n付款应该自动完成并推送付款信息，如果没有完成请及时手动付款"
-        wechat_push(self.sckey, title, content, self.logger)
+        self.__notify(title, content)
+
+    def __notify(self, title: str, content: str) -> None:
+        """把微信推送交给后台线程, 不阻塞预约流程"""
+        self.notifier.notify(self.sckey, title, content, key=(self.config_path, self.started_at), logger=self.logger)
 
 
 if __name__ == "__main__":
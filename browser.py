@@ -0,0 +1,298 @@
+"""浏览器的启动与回收
+
+抢场时每次 refresh 都会重新下载页面上的图片、字体和统计脚本, 而程序只关心场地表格。
+启动时可以选择不同的配置 (LAUNCH_PROFILES): chromium 内核通过 CDP 的 Network.setBlockedURLs 屏蔽这些资源,
+Firefox 没有按 URL 屏蔽的接口, 改用关闭网络字体和开启跟踪保护的 prefs;
+eager 的页面加载策略让 get/refresh 在 DOMContentLoaded 时就返回, 不再等待所有资源加载完。
+各个浏览器的 selenium 模块只在启动对应的浏览器时才导入。
+"""
+import logging
+import os
+import shutil
+import sys
+
+from selenium import webdriver
+
+# 默认屏蔽的资源, 验证码图片是 data: URL, 不受影响
+DEFAULT_BLOCKED_URLS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.ico', '*.webp',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot', '*.mp4', '*.mp3',
+    '*google-analytics.com*', '*googletagmanager.com*', '*hm.baidu.com*', '*cnzz.com*',
+]
+
+# 启动配置: page_load_strategy 为 get/refresh 返回的时机, block 为是否屏蔽资源, tuned 为是否使用下面的低延迟参数
+LAUNCH_PROFILES = {
+    'default': {'page_load_strategy': 'normal', 'block': False, 'tuned': False},
+    'eager': {'page_load_strategy': 'eager', 'block': False, 'tuned': True},
+    'blocked': {'page_load_strategy': 'normal', 'block': True, 'tuned': False},
+    'fast': {'page_load_strategy': 'eager', 'block': True, 'tuned': True},
+}
+
+# chromium 内核的低延迟参数, 关掉与抢场无关的后台任务, 避免后台标签页被降频
+CHROMIUM_FAST_ARGS = [
+    '--disable-extensions',
+    '--disable-gpu',
+    '--no-first-run',
+    '--disable-default-apps',
+    '--disable-sync',
+    '--disable-background-networking',
+    '--disable-background-timer-throttling',
+    '--disable-backgrounding-occluded-windows',
+    '--disable-renderer-backgrounding',
+    '--mute-audio',
+]
+
+FIREFOX_FAST_PREFS = {
+    'app.update.auto': False,
+    'browser.shell.checkDefaultBrowser': False,
+    'datareporting.healthreport.uploadEnabled': False,
+    'dom.min_background_timeout_value': 4,
+    'toolkit.telemetry.enabled': False,
+}
+
+FIREFOX_BLOCK_PREFS = {
+    'gfx.downloadable_fonts.enabled': False,
+    'privacy.trackingprotection.enabled': True,
+    'media.autoplay.default': 5,
+}
+
+# 在 PATH 中查找浏览器的可执行文件名
+BROWSER_BINARIES = {
+    'chrome': ['google-chrome', 'google-chrome-stable', 'chromium', 'chromium-browser', 'chrome'],
+    'firefox': ['firefox'],
+    'edge': ['microsoft-edge', 'microsoft-edge-stable', 'msedge'],
+}
+
+# Windows 上浏览器一般不在 PATH 中, 相对于 Program Files 的安装路径
+WINDOWS_BROWSER_PATHS = {
+    'chrome': os.path.join('Google', 'Chrome', 'Application', 'chrome.exe'),
+    'firefox': os.path.join('Mozilla Firefox', 'firefox.exe'),
+    'edge': os.path.join('Microsoft', 'Edge', 'Application', 'msedge.exe'),
+}
+
+
+def get_driver_path(browser: str) -> str:
+    """获取驱动路径"""
+    path = 'driver'
+    if browser == "chrome":
+        if sys.platform.startswith('win'):
+            return os.path.join(path, 'chromedriver.exe')
+        elif sys.platform.startswith('linux'):
+            return os.path.join(path, 'chromedriver.bin')
+        else:
+            raise Exception('不支持该系统')
+    elif browser == "firefox":
+        if sys.platform.startswith('win'):
+            return os.path.join(path, 'geckodriver.exe')
+        elif sys.platform.startswith('linux'):
+            return os.path.join(path, 'geckodriver.bin')
+        else:
+            raise Exception('不支持该系统')
+    elif browser == "edge":
+        if sys.platform.startswith('win'):
+            return os.path.join(path, 'msedgedriver.exe')
+        elif sys.platform.startswith('linux'):
+            return os.path.join(path, 'msedgedriver.bin')
+        else:
+            raise Exception('不支持该系统')
+    else:
+        raise Exception('不支持该浏览器')
+
+
+def find_browser_binary(browser: str) -> str:
+    """浏览器可执行文件的真实路径, 找不到时返回 None"""
+    for name in BROWSER_BINARIES.get(browser, []):
+        path = shutil.which(name)
+        if path is not None:
+            return os.path.realpath(path)
+    if sys.platform.startswith('win') and browser in WINDOWS_BROWSER_PATHS:
+        for base in ('ProgramFiles', 'ProgramFiles(x86)', 'LOCALAPPDATA'):
+            path = os.path.join(os.environ.get(base, ''), WINDOWS_BROWSER_PATHS[browser])
+            if os.path.exists(path):
+                return path
+    return None
+
+
+def create_driver(browser_name: str, logger: logging.Logger = None, profile: str = 'default',
+                  blocked_urls: list = None):
+    """启动一个 headless 浏览器
+
+    Args:
+        browser_name (`str`): chrome, firefox 或 edge
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+
+        profile (`str`): LAUNCH_PROFILES 中的启动配置. Defaults to 'default'.
+
+        blocked_urls (`list`, optional): 屏蔽的 URL 模式, 只对 chromium 内核有效. Defaults to `DEFAULT_BLOCKED_URLS`.
+
+    Returns:
+        WebDriver: webdriver
+    """
+    if logger is None:
+        logger = logging.getLogger()
+    if profile not in LAUNCH_PROFILES:
+        raise Exception("不支持的启动配置: %s" % profile)
+    settings = LAUNCH_PROFILES[profile]
+
+    if browser_name == "chrome":
+        from selenium.webdriver.chrome.options import Options as Chrome_Options
+        from selenium.webdriver.chrome.service import Service as Chrome_Service
+
+        chrome_options = Chrome_Options()
+        chrome_options.add_argument("--headless")
+        # 下面这两个option 用来解决 ssl error code 1, net_error -101 问题
+        chrome_options.add_argument('-ignore-certificate-errors')
+        chrome_options.add_argument('-ignore -ssl-errors')
+        # 忽略selenium自带的报警日志，让日志变得清爽
+        # 如:[1017/143755.402:INFO:CONSOLE(84)] "pascalprecht.translate.$translateSanitization: No sanitization strategy has been configured. This can have serious security implications. See http://angular-translate.github.io/docs/#/guide/19_security for details.", source: https://portal.pku.edu.cn/portal2017/js/angular.min.js (84)
+        chrome_options.add_experimental_option('excludeSwitches', ['enable-logging'])
+        _tune_chromium(chrome_options, settings)
+
+        chrome_service = Chrome_Service(executable_path=get_driver_path(browser="chrome"))
+        driver = webdriver.Chrome(
+            options=chrome_options,
+            service=chrome_service)
+
+        logger.info('Chrome launched\n')
+    elif browser_name == "firefox":
+        from selenium.webdriver.firefox.options import Options as Firefox_Options
+        from selenium.webdriver.firefox.service import Service as Firefox_Service
+
+        firefox_options = Firefox_Options()
+        firefox_options.add_argument("--headless")
+        firefox_options.page_load_strategy = settings['page_load_strategy']
+        if settings['tuned']:
+            for key, value in FIREFOX_FAST_PREFS.items():
+                firefox_options.set_preference(key, value)
+        if settings['block']:
+            for key, value in FIREFOX_BLOCK_PREFS.items():
+                firefox_options.set_preference(key, value)
+            if blocked_urls:
+                logger.warn("Firefox 不支持按 URL 屏蔽资源, 只关闭了网络字体和跟踪脚本")
+
+        firefox_service = Firefox_Service(executable_path=get_driver_path(browser="firefox"))
+        driver = webdriver.Firefox(
+            options=firefox_options,
+            service=firefox_service)
+        logger.info('Firefox launched\n')
+    elif browser_name == 'edge':
+        from selenium.webdriver.edge.options import Options as Edge_Options
+        from selenium.webdriver.edge.service import Service as Edge_Service
+
+        edge_options = Edge_Options()
+        edge_options.add_argument("--headless")
+        _tune_chromium(edge_options, settings)
+
+        edge_service = Edge_Service(executable_path=get_driver_path(browser="edge"))
+        driver = webdriver.Edge(
+            options=edge_options,
+            service=edge_service)
+        logger.info('Edge launched\n')
+    else:
+        raise Exception("不支持此类浏览器")
+
+    if settings['block']:
+        block_urls(driver, blocked_urls, logger)
+    return driver
+
+
+def _tune_chromium(options, settings: dict) -> None:
+    options.page_load_strategy = settings['page_load_strategy']
+    if settings['tuned']:
+        for arg in CHROMIUM_FAST_ARGS:
+            options.add_argument(arg)
+
+
+def block_urls(driver, blocked_urls: list = None, logger: logging.Logger = None) -> bool:
+    """在当前标签页屏蔽匹配的请求
+
+    CDP 的设置只对当前标签页有效, window.open 打开的新标签页需要再调用一次。
+
+    Args:
+        blocked_urls (`list`, optional): URL 模式, 支持 * 通配. Defaults to `DEFAULT_BLOCKED_URLS`.
+
+    Returns:
+        bool: 是否设置成功, 非 chromium 内核返回 False
+    """
+    if not hasattr(driver, 'execute_cdp_cmd'):
+        return False
+    try:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {
+            'urls': blocked_urls if blocked_urls is not None else DEFAULT_BLOCKED_URLS})
+        return True
+    except Exception as e:
+        if logger is not None:
+            logger.debug(e, exc_info=True, stack_info=True)
+        return False
+
+
+def is_driver_alive(driver) -> bool:
+    """浏览器进程和会话是否还可用"""
+    try:
+        driver.window_handles
+        return True
+    except Exception:
+        return False
+
+
+# 登录和预约会用到的域名, 回收浏览器时清空这些域名下的所有存储
+SESSION_ORIGINS = (
+    'https://iaaa.pku.edu.cn',
+    'https://portal.pku.edu.cn',
+    'https://epe.pku.edu.cn',
+)
+
+
+def _origin(url: str) -> str:
+    """地址的 scheme://host[:port], about:blank 等没有域名的地址返回 None"""
+    scheme, sep, rest = url.partition('://')
+    if not sep or scheme not in ('http', 'https'):
+        return None
+    return "%s://%s" % (scheme, rest.split('/', 1)[0])
+
+
+def reset_driver(driver, origins: tuple = SESSION_ORIGINS) -> None:
+    """清理浏览器状态, 使其可以交给下一个账号使用
+
+    关掉多余的窗口, 清空 cookie 以及 origins 和各个窗口当前域名下的 localStorage、sessionStorage,
+    场馆的 token 放在 localStorage 里, 不清空的话下一个账号会用上一个账号的身份查询和预约。最后停在空白页
+
+    Args:
+        origins (`tuple`): 需要清空存储的域名. Defaults to `SESSION_ORIGINS`.
+    """
+    handles = driver.window_handles
+    visited = list(origins)
+    for handle in reversed(handles):
+        driver.switch_to.window(handle)
+        origin = _origin(driver.current_url)
+        if origin is not None and origin not in visited:
+            visited.append(origin)
+        if handle != handles[0]:
+            driver.close()
+    driver.switch_to.window(handles[0])
+    try:
+        # chromium 内核可以通过 CDP 一次清空所有域名下的 cookie, 按域名清空所有存储
+        driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        for origin in visited:
+            driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+    except Exception:
+        # 其他浏览器只能打开每个域名, 在页面中清空
+        for origin in visited:
+            try:
+                driver.get(origin)
+                driver.delete_all_cookies()
+                driver.execute_script("window.localStorage.clear(); window.sessionStorage.clear();")
+            except Exception:
+                pass
+        driver.delete_all_cookies()
+    driver.get('about:blank')
+
+
+def quit_driver(driver) -> None:
+    """退出浏览器, 忽略浏览器已经崩溃等情况下的异常"""
+    try:
+        driver.quit()
+    except Exception:
+        pass
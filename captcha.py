@@ -0,0 +1,251 @@
+"""点选验证码的识别服务
+
+验证码识别处在锁定场地和付款之间, 它的耗时直接决定能不能抢到场地。
+CaptchaSolver 把同一张图片同时交给多个后端 (或同一个后端的多个重复请求), 取最先返回的合法结果,
+每个请求都有严格的超时, 识别的耗时和最终是否通过会被记录下来。
+"""
+import base64
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 点选验证码需要点击的点数
+EXPECTED_POINTS = 3
+
+
+class CaptchaError(Exception):
+    """验证码识别失败"""
+
+
+class CaptchaResult:
+    """一次识别的结果
+
+    Attributes:
+        points (`list`): 点击坐标, [[x, y], ...], 坐标以图片原始尺寸为准
+
+        backend (`str`): 给出结果的后端
+
+        latency (`float`): 从提交到得到结果的耗时, 单位为秒
+
+        extra (`dict`): 后端的附加信息, 例如用于报错的识别 id
+    """
+
+    def __init__(self, points: list, backend: str, latency: float, extra: dict = None) -> None:
+        self.points = points
+        self.backend = backend
+        self.latency = latency
+        self.extra = extra or {}
+
+
+class CaptchaBackend:
+    """识别后端的接口, 子类实现 solve"""
+
+    name = 'base'
+
+    def solve(self, image: str, content: str, timeout: float) -> CaptchaResult:
+        """识别验证码
+
+        Args:
+            image (`str`): png 图片的 base64, 不带 data:image/png;base64, 前缀
+
+            content (`str`): 需要依次点击的文字
+
+            timeout (`float`): 超时时间, 单位为秒
+
+        Returns:
+            CaptchaResult: 识别结果, latency 由 CaptchaSolver 填写
+        """
+        raise NotImplementedError
+
+    def report_error(self, result: CaptchaResult) -> None:
+        """识别结果没有通过验证时调用, 默认什么都不做"""
+
+
+class TTShituBackend(CaptchaBackend):
+    """tt识图, typeid 43 为点选文字
+
+    Args:
+        username (`str`): tt识图用户名
+
+        password (`str`): tt识图密码
+
+        pool_size (`int`): 连接池大小, 同一时刻最多的并发请求数. Defaults to 4.
+
+        base_url (`str`): 接口地址, 测试时可以指向 mock_site.py. Defaults to `BASE_URL`.
+    """
+
+    name = 'ttshitu'
+    BASE_URL = "http://api.ttshitu.com"
+
+    def __init__(self, username: str, password: str, pool_size: int = 4, base_url: str = BASE_URL) -> None:
+        self.username = username
+        self.password = password
+        self.api_url = base_url.rstrip('/') + '/predict'
+        self.report_url = base_url.rstrip('/') + '/reporterror.json'
+        # 保持长连接, 省去每次识别时建立连接的时间
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def solve(self, image: str, content: str, timeout: float) -> CaptchaResult:
+        data = {"username": self.username, "password": self.password,
+                "typeid": 43, "image": image, "content": content}
+        result = self.session.post(self.api_url, json=data, timeout=timeout).json()
+        if not result['success']:
+            raise CaptchaError(result['message'])
+        result_str = result['data']['result'].split('|')
+        points = [list(map(int, p.split(','))) for p in result_str]
+        return CaptchaResult(points, self.name, 0, {'id': result['data'].get('id')})
+
+    def report_error(self, result: CaptchaResult) -> None:
+        # 报错后 tt识图 会退还这次识别的费用
+        if result.extra.get('id'):
+            self.session.post(self.report_url, json={"id": result.extra['id']}, timeout=2)
+
+
+class BackendStats:
+    """单个后端的统计"""
+
+    def __init__(self, window: int = 200) -> None:
+        self.requests = 0
+        self.wins = 0
+        self.correct = 0
+        self.wrong = 0
+        self.latencies = deque(maxlen=window)
+
+    def summary(self) -> str:
+        latencies = sorted(self.latencies)
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        judged = self.correct + self.wrong
+        accuracy = self.correct / judged * 100 if judged else 0
+        return "请求 %d, 采用 %d, 正确率 %.0f%% (%d/%d), 耗时 p50 %.0f ms" % (
+            self.requests, self.wins, accuracy, self.correct, judged, p50)
+
+
+def is_valid_points(points) -> bool:
+    return isinstance(points, list) and len(points) == EXPECTED_POINTS and \
+        all(len(p) == 2 for p in points)
+
+
+class CaptchaSolver:
+    """并发地向多个后端请求识别, 取最先返回的合法结果
+
+    Args:
+        backends (`list`): CaptchaBackend 列表
+
+        duplicates (`int`): 每个后端同时发出的重复请求数. Defaults to 1.
+
+        deadline (`float`): 一次识别的总时限, 单位为秒. Defaults to 8.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+    """
+
+    def __init__(self, backends: list, duplicates: int = 1, deadline: float = 8,
+                 logger: logging.Logger = None) -> None:
+        if not backends:
+            raise ValueError("至少需要一个验证码识别后端")
+        self.backends = backends
+        self.duplicates = max(1, duplicates)
+        self.deadline = deadline
+        self.logger = logger if logger is not None else logging.getLogger()
+
+        self.stats = {backend.name: BackendStats() for backend in backends}
+        # 报错请求单独一个线程, 不能占用重试识别的线程
+        self._report_executor = ThreadPoolExecutor(max_workers=1)
+
+    def _run(self, backend: CaptchaBackend, image: str, content: str, start: float) -> CaptchaResult:
+        result = backend.solve(image, content, max(0.1, self.deadline - (time.perf_counter() - start)))
+        result.latency = time.perf_counter() - start
+        return result
+
+    def solve(self, image: str, content: str) -> CaptchaResult:
+        """识别验证码
+
+        Raises:
+            CaptchaError: 所有请求都失败, 或在时限内没有得到合法结果
+        """
+        start = time.perf_counter()
+        # 每次识别使用自己的线程: 上一次没被采用的慢请求无法取消, 会一直占着线程直到超时,
+        # 共用线程池的话, 验证码点错后的重试要排在这些请求后面
+        executor = ThreadPoolExecutor(max_workers=len(self.backends) * self.duplicates,
+                                      thread_name_prefix='captcha')
+        try:
+            return self._collect(executor, image, content, start)
+        finally:
+            executor.shutdown(wait=False)
+
+    def _collect(self, executor: ThreadPoolExecutor, image: str, content: str, start: float) -> CaptchaResult:
+        futures = {}
+        for backend in self.backends:
+            for _ in range(self.duplicates):
+                futures[executor.submit(self._run, backend, image, content, start)] = backend
+                self.stats[backend.name].requests += 1
+
+        pending = set(futures)
+        errors = []
+        while pending:
+            remain = self.deadline - (time.perf_counter() - start)
+            if remain <= 0:
+                break
+            done, pending = wait(pending, timeout=remain, return_when=FIRST_COMPLETED)
+            for future in done:
+                backend = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append("%s: %s" % (backend.name, e))
+                    continue
+                if not is_valid_points(result.points):
+                    errors.append("%s: 结果不合法 %s" % (backend.name, result.points))
+                    continue
+                stats = self.stats[backend.name]
+                stats.latencies.append(result.latency)
+                stats.wins += 1
+                # 剩下的请求不再等待, 还没开始的直接取消
+                for other in pending:
+                    other.cancel()
+                self.logger.info("验证码由 %s 识别, 耗时 %.0f ms" % (backend.name, result.latency * 1000))
+                return result
+
+        for future in pending:
+            future.cancel()
+        raise CaptchaError("验证码识别失败 (%.1f s): %s" % (
+            time.perf_counter() - start, '; '.join(errors) or '超时'))
+
+    def report(self, result: CaptchaResult, correct: bool) -> None:
+        """记录识别结果是否通过了验证"""
+        stats = self.stats[result.backend]
+        if correct:
+            stats.correct += 1
+        else:
+            stats.wrong += 1
+            backend = next(b for b in self.backends if b.name == result.backend)
+            # 报错请求不能占用重试的时间
+            self._report_executor.submit(backend.report_error, result)
+
+    def summary(self) -> str:
+        return '; '.join("%s: %s" % (name, stats.summary()) for name, stats in self.stats.items())
+
+
+def save_capture(capture_dir: str, image: str, content: str, result: CaptchaResult, correct: bool) -> str:
+    """保存一张验证码及其识别结果, 供 captcha_eval.py 离线评估
+
+    通过验证的结果会作为这张图片的标注
+
+    Returns:
+        str: 保存的文件名, 不带扩展名
+    """
+    os.makedirs(capture_dir, exist_ok=True)
+    name = "%s_%s" % (time.strftime("%Y%m%d_%H%M%S"), uuid.uuid4().hex[:6])
+    with open(os.path.join(capture_dir, name + '.png'), 'wb') as f:
+        f.write(base64.b64decode(image))
+    with open(os.path.join(capture_dir, name + '.json'), 'w', encoding='utf-8') as f:
+        json.dump({'content': content, 'points': result.points, 'backend': result.backend,
+                   'correct': correct}, f, ensure_ascii=False)
+    return name
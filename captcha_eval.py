@@ -0,0 +1,96 @@
+"""验证码识别后端的离线评估
+
+在 config 的 [captcha] 中设置 capture_dir 后, 每次识别的验证码图片和结果都会保存下来,
+通过了验证的结果就是这张图片的标注。这个脚本用某个后端重新识别这些图片, 统计正确率和耗时:
+
+    python captcha_eval.py captures --backend local
+    python captcha_eval.py captures --backend ttshitu --tt-usr xxx --tt-pwd xxx
+"""
+import argparse
+import base64
+import json
+import os
+import time
+
+from captcha import TTShituBackend, is_valid_points
+
+
+def load_captures(capture_dir: str) -> list:
+    """读取保存的验证码, 返回 (图片 base64, 标注) 的列表"""
+    captures = []
+    for file_name in sorted(os.listdir(capture_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        with open(os.path.join(capture_dir, file_name), encoding='utf-8') as f:
+            label = json.load(f)
+        with open(os.path.join(capture_dir, file_name[:-len('.json')] + '.png'), 'rb') as f:
+            image = base64.b64encode(f.read()).decode()
+        captures.append((image, label))
+    return captures
+
+
+def is_match(points: list, expected: list, tolerance: float) -> bool:
+    """每个点都落在标注点 tolerance 像素以内才算识别正确, 点击的顺序也要一致"""
+    if len(points) != len(expected):
+        return False
+    return all((p[0] - e[0]) ** 2 + (p[1] - e[1]) ** 2 <= tolerance ** 2 for p, e in zip(points, expected))
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0
+
+
+def evaluate(backend, captures: list, tolerance: float) -> dict:
+    """逐张识别并统计
+
+    Returns:
+        dict: total, labeled, correct, failed, p50, p99, 耗时单位为秒
+    """
+    latencies = []
+    labeled = correct = failed = 0
+    for image, label in captures:
+        start = time.perf_counter()
+        try:
+            points = backend.solve(image, label['content'], timeout=10).points
+        except Exception:
+            points = None
+        latencies.append(time.perf_counter() - start)
+
+        if not is_valid_points(points):
+            failed += 1
+        if label.get('correct'):
+            labeled += 1
+            if points is not None and is_match(points, label['points'], tolerance):
+                correct += 1
+    return {
+        'total': len(captures),
+        'labeled': labeled,
+        'correct': correct,
+        'failed': failed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='验证码识别后端的离线评估')
+    parser.add_argument('capture_dir', help='config 中 capture_dir 指定的目录')
+    parser.add_argument('--backend', default='local', choices=['local', 'ttshitu'])
+    parser.add_argument('--tt-usr', default='')
+    parser.add_argument('--tt-pwd', default='')
+    parser.add_argument('--tolerance', type=float, default=15, help='与标注点的最大距离, 单位为像素')
+    args = parser.parse_args()
+
+    if args.backend == 'local':
+        from captcha_local import LocalBackend
+        backend = LocalBackend()
+    else:
+        backend = TTShituBackend(args.tt_usr, args.tt_pwd)
+
+    captures = load_captures(args.capture_dir)
+    report = evaluate(backend, captures, args.tolerance)
+    accuracy = report['correct'] / report['labeled'] * 100 if report['labeled'] else 0
+    print("共 %d 张, 有标注 %d 张, 正确率 %.1f%% (%d/%d), 无合法结果 %d 张" % (
+        report['total'], report['labeled'], accuracy, report['correct'], report['labeled'], report['failed']))
+    print("识别耗时 p50 %.0f ms, p99 %.0f ms" % (report['p50'] * 1000, report['p99'] * 1000))
@@ -0,0 +1,72 @@
+"""本地 CPU 上运行的点选验证码识别后端
+
+使用 ddddocr 的目标检测模型找出图片中所有文字的位置, 再用分类模型给每个文字打分,
+最后把需要点击的文字和检测到的文字做一次总分最高的匹配。整个过程不需要网络。
+
+ddddocr 是可选依赖, 只有在配置中使用 local 后端时才需要安装:
+
+    pip3 install ddddocr
+"""
+import base64
+import io
+from itertools import permutations
+
+from PIL import Image
+
+from captcha import CaptchaBackend, CaptchaResult, CaptchaError
+
+
+class LocalBackend(CaptchaBackend):
+    """基于 ddddocr 的本地识别后端
+
+    模型在构造时加载, 大约需要一秒, 所以应该在抢场之前就创建好
+    """
+
+    name = 'local'
+
+    def __init__(self) -> None:
+        try:
+            import ddddocr
+        except ImportError:
+            raise ImportError('没有找到ddddocr包，使用本地验证码识别需要先安装～ pip3 install ddddocr')
+        self.detector = ddddocr.DdddOcr(det=True, show_ad=False)
+        self.classifier = ddddocr.DdddOcr(show_ad=False)
+        self._char_index = None
+
+    def _char_scores(self, crop: Image.Image, targets: str) -> list:
+        """分类模型认为 crop 是 targets 中每个字的概率"""
+        result = self.classifier.classification(crop, probability=True)
+        # 不同版本的 ddddocr 返回的字段名不同
+        charset = result.get('charset') or result.get('charsets')
+        probabilities = result.get('probabilities') or result.get('probability')
+        if self._char_index is None:
+            self._char_index = {c: i for i, c in enumerate(charset)}
+
+        scores = [0.0] * len(targets)
+        for step in probabilities:
+            if step and isinstance(step[0], list):
+                step = step[0]
+            for k, c in enumerate(targets):
+                index = self._char_index.get(c)
+                if index is not None and step[index] > scores[k]:
+                    scores[k] = step[index]
+        return scores
+
+    def solve(self, image: str, content: str, timeout: float) -> CaptchaResult:
+        img = Image.open(io.BytesIO(base64.b64decode(image))).convert('RGB')
+        boxes = self.detector.detection(img)
+        if len(boxes) < len(content):
+            raise CaptchaError("只检测到 %d 个文字, 需要 %d 个" % (len(boxes), len(content)))
+
+        # scores[b][k]: 第 b 个框是第 k 个目标文字的概率
+        scores = [self._char_scores(img.crop(tuple(box)), content) for box in boxes]
+
+        # 框的数量很少 (一般不超过 6 个), 直接枚举所有分配方式
+        best, best_score = None, -1.0
+        for assignment in permutations(range(len(boxes)), len(content)):
+            score = sum(scores[b][k] for k, b in enumerate(assignment))
+            if score > best_score:
+                best, best_score = assignment, score
+
+        points = [[(boxes[b][0] + boxes[b][2]) // 2, (boxes[b][1] + boxes[b][3]) // 2] for b in best]
+        return CaptchaResult(points, self.name, 0, {'score': best_score / len(content)})
@@ -0,0 +1,276 @@
+"""config 文件的统一加载和校验
+
+原先 env_check 为了判断 enabled 读一遍 ini, Booker 再读一遍, 每次 book() 还要把 [time] 中的
+start_time/end_time 重新 split 一遍、用 strptime 解析一遍, 扫描表格时又对每一行的时间段 strptime。
+这里在启动时把所有 config*.ini 读一次并校验, [time] 解析成不可变的 SlotSpec:
+开始和结束时间都是从 0 点开始的分钟数, 星期几或具体日期也已经解析好,
+之后换算距离今天的天数和判断时间段是否落在范围内都只需要整数比较。
+文件的修改时间变了才会重新读取。
+
+    python config_registry.py
+"""
+import datetime
+import os
+import re
+import threading
+from configparser import ConfigParser
+from typing import NamedTuple
+
+from court_table import label_minutes, format_minutes
+
+CONFIG_PATTERN = r'^config[_0-9a-zA-Z]*.ini$'
+
+# 最多预约几天后的场地, 只能在当天 11:55 以后预约 3 天后的场地
+BOOKING_DAYS = 3
+RELEASE_OPEN_MINUTE = 11 * 60 + 55
+
+# 20230909-1500 或 5-1500
+_SLOT_PATTERN = re.compile(r'^(?:(\d{8})|([1-7]))-(\d{2})(\d{2})$')
+
+
+class ConfigError(ValueError):
+    """config 文件缺少字段或格式不正确"""
+
+
+class SlotSpec(NamedTuple):
+    """[time] 中的一个备选时间段
+
+    Attributes:
+        index (`int`): 在 [time] 中的先后顺序
+
+        start (`int`): 开始时间, 从 0 点开始的分钟数
+
+        end (`int`): 结束时间, 从 0 点开始的分钟数
+
+        weekday (`int`): 星期几, 0 表示星期一, 使用日期格式时为 None
+
+        date (`datetime.date`): 具体日期, 使用星期几格式时为 None
+
+        text (`str`): 原始的 "开始/结束", 用于日志
+    """
+    index: int
+    start: int
+    end: int
+    weekday: int
+    date: datetime.date
+    text: str
+
+    def delta_day(self, today: datetime.date) -> int:
+        """距离 today 的天数, 星期几格式总是落在今天到 6 天后之间"""
+        if self.date is not None:
+            return (self.date - today).days
+        return (self.weekday - today.weekday()) % 7
+
+    def date_on(self, today: datetime.date) -> datetime.date:
+        return today + datetime.timedelta(days=self.delta_day(today))
+
+    def covers(self, label: str) -> bool:
+        """"15:00-16:00" 这样的时间段是否落在这个备选时间段内"""
+        start, end = label_minutes(label)
+        return self.start <= start and end <= self.end
+
+    def __str__(self) -> str:
+        day = self.date.strftime("%Y-%m-%d") if self.date is not None else "星期%d" % (self.weekday + 1)
+        return "%s %s-%s" % (day, format_minutes(self.start), format_minutes(self.end))
+
+
+def _parse_point(text: str) -> tuple:
+    match = _SLOT_PATTERN.match(text.strip())
+    if match is None:
+        raise ConfigError("时间格式不正确: %s, 应为 年月日-时分 或 星期几-时分" % text)
+    date_text, weekday_text, hour, minute = match.groups()
+    hour, minute = int(hour), int(minute)
+    if hour > 24 or minute >= 60 or hour * 60 + minute > 24 * 60:
+        raise ConfigError("时间不正确: %s" % text)
+    if date_text is not None:
+        try:
+            date = datetime.datetime.strptime(date_text, "%Y%m%d").date()
+        except ValueError:
+            raise ConfigError("日期不正确: %s" % text)
+        return date, None, hour * 60 + minute
+    return None, int(weekday_text) - 1, hour * 60 + minute
+
+
+def parse_slots(start_time: str, end_time: str) -> tuple:
+    """把 [time] 的 start_time 和 end_time 解析成 SlotSpec 的元组
+
+    Raises:
+        ConfigError: 格式不正确, 个数不一致, 或开始和结束不在同一天
+    """
+    starts = [x for x in start_time.split('/') if x.strip()]
+    ends = [x for x in end_time.split('/') if x.strip()]
+    if not starts:
+        raise ConfigError("start_time 不能为空")
+    if len(starts) != len(ends):
+        raise ConfigError("start_time 和 end_time 的个数不一致")
+    slots = []
+    for index, (start_text, end_text) in enumerate(zip(starts, ends)):
+        date, weekday, start = _parse_point(start_text)
+        end_date, end_weekday, end = _parse_point(end_text)
+        if (date, weekday) != (end_date, end_weekday):
+            raise ConfigError("开始和结束时间不在同一天: %s/%s" % (start_text, end_text))
+        if end <= start:
+            raise ConfigError("结束时间要晚于开始时间: %s/%s" % (start_text, end_text))
+        slots.append(SlotSpec(index, start, end, weekday, date, "%s/%s" % (start_text.strip(), end_text.strip())))
+    return tuple(slots)
+
+
+def resolve_slots(slots: tuple, now: datetime.datetime = None) -> tuple:
+    """按当前时间筛选可以预约的备选时间段
+
+    与原先一样, 遇到第一个超出范围的时间段就停止
+
+    Returns:
+        tuple: (可以预约的 SlotSpec 列表, 对应的距今天数列表, 第一个超出范围的 SlotSpec 或 None)
+    """
+    now = now if now is not None else datetime.datetime.now()
+    today = now.date()
+    before_open = now.hour * 60 + now.minute < RELEASE_OPEN_MINUTE
+    valid, delta_days = [], []
+    for slot in slots:
+        delta_day = slot.delta_day(today)
+        if delta_day > BOOKING_DAYS or (delta_day == BOOKING_DAYS and before_open):
+            return valid, delta_days, slot
+        valid.append(slot)
+        delta_days.append(delta_day)
+    return valid, delta_days, None
+
+
+class BookingConfig(NamedTuple):
+    """校验过的一个 config 文件
+
+    Attributes:
+        path (`str`): 文件路径
+
+        mtime (`float`): 读取时文件的修改时间
+
+        enabled (`bool`): [enabled] enabled
+
+        slots (`tuple`): [time] 解析得到的 SlotSpec
+
+        parser (`ConfigParser`): 其余字段仍然从这里读取, 不要修改
+    """
+    path: str
+    mtime: float
+    enabled: bool
+    slots: tuple
+    parser: ConfigParser
+
+
+# 缺少时无法运行的字段
+REQUIRED_KEYS = (
+    ('login', 'user_name'), ('login', 'password'), ('tt', 'tt_usr'), ('tt', 'tt_pwd'),
+    ('type', 'venue'), ('type', 'venue_num'), ('time', 'start_time'), ('time', 'end_time'),
+    ('wechat', 'wechat_notice'), ('wechat', 'SCKEY'),
+)
+
+
+def parse_config(path: str) -> BookingConfig:
+    """读取并校验一个 config 文件
+
+    Raises:
+        ConfigError: 文件不存在, 缺少字段或字段格式不正确
+    """
+    if not os.path.exists(path):
+        raise ConfigError("找不到 config 文件: %s" % path)
+    mtime = os.path.getmtime(path)
+    parser = ConfigParser()
+    parser.read(path, encoding='utf8')
+
+    missing = ["[%s] %s" % (section, key) for section, key in REQUIRED_KEYS if not parser.has_option(section, key)]
+    if missing:
+        raise ConfigError("%s 缺少 %s" % (path, ', '.join(missing)))
+    try:
+        # config.sample.ini 中 enabled 留空, 视为未启用
+        enabled = bool(parser.get('enabled', 'enabled', fallback='').strip()) and \
+            parser.getboolean('enabled', 'enabled')
+        parser.getint('type', 'venue_num')
+        parser.getboolean('wechat', 'wechat_notice')
+        slots = parse_slots(parser['time']['start_time'], parser['time']['end_time'])
+    except ValueError as e:
+        raise ConfigError("%s: %s" % (path, e))
+    return BookingConfig(path, mtime, enabled, slots, parser)
+
+
+class ConfigRegistry:
+    """所有 config 文件的缓存, 修改时间不变时不重新读取
+
+    Args:
+        directory (`str`): config 所在的目录. Defaults to '.'.
+
+        pattern (`str`): config 文件名的正则. Defaults to `CONFIG_PATTERN`.
+    """
+
+    def __init__(self, directory: str = '.', pattern: str = CONFIG_PATTERN) -> None:
+        self.directory = directory
+        self.pattern = re.compile(pattern)
+        self.configs = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> BookingConfig:
+        """读取一个 config, 已经读过并且没有修改过时直接返回缓存
+
+        Raises:
+            ConfigError: 文件不存在或校验失败
+        """
+        with self._lock:
+            cached = self.configs.get(path)
+            if cached is not None and os.path.exists(path) and os.path.getmtime(path) == cached.mtime:
+                return cached
+            config = parse_config(path)
+            self.configs[path] = config
+            return config
+
+    def clear(self) -> None:
+        """丢弃缓存, 下一次读取时重新解析所有 config"""
+        with self._lock:
+            self.configs.clear()
+
+    def discover(self) -> list:
+        """目录中所有符合命名规则的 config 文件名"""
+        return sorted(name if self.directory == '.' else os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory) if self.pattern.match(name))
+
+    def load_all(self) -> tuple:
+        """读取目录中所有的 config
+
+        Returns:
+            tuple: ({文件名: BookingConfig}, {文件名: 错误信息})
+        """
+        configs, errors = {}, {}
+        for path in self.discover():
+            try:
+                configs[path] = self.get(path)
+            except ConfigError as e:
+                errors[path] = str(e)
+        return configs, errors
+
+    def enabled(self) -> list:
+        """所有校验通过并且 enabled 的 config 文件名, 校验失败的不会被启用"""
+        configs, _ = self.load_all()
+        return [path for path, config in configs.items() if config.enabled]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ConfigRegistry:
+    """当前目录的 ConfigRegistry, 进程内共用一个"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ConfigRegistry()
+        return _registry
+
+
+def load_config(path: str) -> BookingConfig:
+    return get_registry().get(path)
+
+
+if __name__ == '__main__':
+    configs, errors = get_registry().load_all()
+    for path, config in configs.items():
+        print("%s  %s  %s" % (path, '启用' if config.enabled else '未启用', ', '.join(str(s) for s in config.slots)))
+    for path, error in errors.items():
+        print("%s  校验失败: %s" % (path, error))
@@ -0,0 +1,289 @@
+"""同一台机器上多个账号之间的协调
+
+几个 config 抢同一个场馆的同一个时间段时, 每个 Booker 各自选出的最好候选往往是同一个场地,
+只有一个账号能抢到, 其他账号白白浪费了放场的那一刻。这里让各个账号:
+
+1. 发布自己读到的空闲情况, 其他账号点击之前可以发现格子已经被别人看到被占用了
+2. 点击之前原子地认领候选的格子, 已经被其他账号认领的候选直接跳过, 换下一个
+
+并行预约时由主进程启动一个内存中的 broker (multiprocessing 的 Manager), 子进程通过环境变量找到它;
+找不到 broker 时 (例如几个 main.py 分别运行) 退回到 SQLite 文件, 由 SQLite 的文件锁保证认领的原子性。
+认领有过期时间, 进程崩溃后不会一直占着。
+
+    python coordination.py
+"""
+import datetime
+import logging
+import multiprocessing as mp
+import os
+import sqlite3
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+COORDINATION_DB = './history/coordination.db'
+
+# 并行预约的子进程通过这个环境变量找到 broker 的地址
+BROKER_ENV = 'PKU_BOOKING_BROKER'
+
+# 认领的有效期, 单位为秒
+CLAIM_TTL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS claims (
+    venue TEXT NOT NULL, date TEXT NOT NULL, court INTEGER NOT NULL, slot TEXT NOT NULL,
+    owner TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (venue, date, court, slot)
+);
+CREATE TABLE IF NOT EXISTS observations (
+    venue TEXT NOT NULL, date TEXT NOT NULL, court INTEGER NOT NULL, slot TEXT NOT NULL,
+    free INTEGER NOT NULL, ts REAL NOT NULL, PRIMARY KEY (venue, date, court, slot)
+);
+"""
+
+
+def cell_keys(venue: str, date: datetime.date, court: int, labels: list) -> list:
+    """一个场地上若干时间段的格子, 作为认领的键"""
+    date = date.strftime("%Y-%m-%d")
+    return [(venue, date, court, label) for label in labels]
+
+
+class Coordinator:
+    """协调后端的接口"""
+
+    def claim(self, owner: str, keys: list, ttl: float = CLAIM_TTL) -> bool:
+        """原子地认领 keys 中所有的格子
+
+        Args:
+            owner (`str`): 认领者, 一般是学号
+
+            keys (`list`): cell_keys 生成的格子
+
+            ttl (`float`): 有效期, 单位为秒, 重复认领时会续期. Defaults to `CLAIM_TTL`.
+
+        Returns:
+            bool: 是否认领成功, 有任何一个格子已经被其他人认领时全部不认领
+        """
+        raise NotImplementedError
+
+    def release(self, owner: str, keys: list = None) -> None:
+        """放弃认领, keys 为 None 时放弃 owner 的所有认领"""
+        raise NotImplementedError
+
+    def publish(self, venue: str, date: str, cells: list, ts: float = None) -> None:
+        """发布读到的空闲情况
+
+        Args:
+            date (`str`): "%Y-%m-%d" 格式的日期
+
+            cells (`list`): [(场地号, 时间段, 是否空闲), ...]
+
+            ts (`float`, optional): 读到的时间戳. Defaults to 当前时间.
+        """
+        raise NotImplementedError
+
+    def taken_since(self, keys: list, since: float) -> list:
+        """keys 中在 since 之后被其他账号看到已经被占用的格子"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryBroker(Coordinator):
+    """内存中的协调状态, 由 broker 进程持有, 各个账号通过代理调用"""
+
+    def __init__(self) -> None:
+        # key -> (owner, 过期时间)
+        self.claims = {}
+        # key -> (是否空闲, 时间戳)
+        self.observations = {}
+        self._lock = threading.Lock()
+
+    def claim(self, owner: str, keys: list, ttl: float = CLAIM_TTL) -> bool:
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                holder = self.claims.get(key)
+                if holder is not None and holder[0] != owner and holder[1] > now:
+                    return False
+            for key in keys:
+                self.claims[key] = (owner, now + ttl)
+            return True
+
+    def release(self, owner: str, keys: list = None) -> None:
+        with self._lock:
+            for key in list(self.claims) if keys is None else keys:
+                holder = self.claims.get(key)
+                if holder is not None and holder[0] == owner:
+                    del self.claims[key]
+
+    def publish(self, venue: str, date: str, cells: list, ts: float = None) -> None:
+        ts = ts if ts is not None else time.time()
+        with self._lock:
+            for court, slot, free in cells:
+                self.observations[(venue, date, court, slot)] = (bool(free), ts)
+
+    def taken_since(self, keys: list, since: float) -> list:
+        with self._lock:
+            result = []
+            for key in keys:
+                observation = self.observations.get(key)
+                if observation is not None and not observation[0] and observation[1] > since:
+                    result.append(key)
+            return result
+
+
+class SQLiteCoordinator(Coordinator):
+    """没有 broker 时用 SQLite 文件协调, BEGIN IMMEDIATE 保证认领的原子性
+
+    Args:
+        path (`str`): SQLite 文件路径. Defaults to `COORDINATION_DB`.
+    """
+
+    def __init__(self, path: str = COORDINATION_DB) -> None:
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 自己管理事务, 认领时需要 BEGIN IMMEDIATE 先拿到写锁
+        self.conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # 只是临时的协调状态, 不需要每次都落盘
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def claim(self, owner: str, keys: list, ttl: float = CLAIM_TTL) -> bool:
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for key in keys:
+                    row = self.conn.execute(
+                        "SELECT owner FROM claims WHERE venue = ? AND date = ? AND court = ? AND slot = ? "
+                        "AND expires > ? AND owner != ?", (*key, now, owner)).fetchone()
+                    if row is not None:
+                        self.conn.execute("ROLLBACK")
+                        return False
+                self.conn.executemany("INSERT OR REPLACE INTO claims VALUES (?, ?, ?, ?, ?, ?)",
+                                      [(*key, owner, now + ttl) for key in keys])
+                self.conn.execute("COMMIT")
+                return True
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def release(self, owner: str, keys: list = None) -> None:
+        with self._lock:
+            if keys is None:
+                self.conn.execute("DELETE FROM claims WHERE owner = ?", (owner,))
+            else:
+                self.conn.executemany(
+                    "DELETE FROM claims WHERE venue = ? AND date = ? AND court = ? AND slot = ? AND owner = ?",
+                    [(*key, owner) for key in keys])
+
+    def publish(self, venue: str, date: str, cells: list, ts: float = None) -> None:
+        ts = ts if ts is not None else time.time()
+        with self._lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("INSERT OR REPLACE INTO observations VALUES (?, ?, ?, ?, ?, ?)",
+                                  [(venue, date, court, slot, int(bool(free)), ts) for court, slot, free in cells])
+            self.conn.execute("COMMIT")
+
+    def taken_since(self, keys: list, since: float) -> list:
+        with self._lock:
+            result = []
+            for key in keys:
+                row = self.conn.execute(
+                    "SELECT 1 FROM observations WHERE venue = ? AND date = ? AND court = ? AND slot = ? "
+                    "AND free = 0 AND ts > ?", (*key, since)).fetchone()
+                if row is not None:
+                    result.append(key)
+            return result
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+class BrokerManager(BaseManager):
+    pass
+
+
+_broker = None
+
+
+def _get_broker() -> MemoryBroker:
+    """在 broker 进程中调用, 所有连接共用一个 MemoryBroker"""
+    global _broker
+    if _broker is None:
+        _broker = MemoryBroker()
+    return _broker
+
+
+BrokerManager.register('get_broker', callable=_get_broker)
+
+
+def start_broker() -> BrokerManager:
+    """在本机随机端口启动 broker, 并把地址写入环境变量, 之后启动的子进程都能连上
+
+    同一个程序启动的子进程共用 multiprocessing 的 authkey, 其他进程无法连接
+
+    Returns:
+        BrokerManager: 用完后调用 shutdown
+    """
+    manager = BrokerManager(('127.0.0.1', 0), authkey=mp.current_process().authkey)
+    manager.start()
+    os.environ[BROKER_ENV] = '%s:%d' % manager.address
+    return manager
+
+
+def connect_broker(address: str) -> Coordinator:
+    host, port = address.rsplit(':', 1)
+    manager = BrokerManager((host, int(port)), authkey=mp.current_process().authkey)
+    manager.connect()
+    return manager.get_broker()
+
+
+def get_coordinator(backend: str = 'auto', path: str = COORDINATION_DB, logger: logging.Logger = None) -> Coordinator:
+    """按配置创建协调后端
+
+    Args:
+        backend (`str`): auto 优先连接 broker, 连不上时使用 SQLite; broker 或 sqlite 只使用对应的后端. Defaults to 'auto'.
+
+        path (`str`): SQLite 文件路径. Defaults to `COORDINATION_DB`.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+    """
+    logger = logger if logger is not None else logging.getLogger()
+    address = os.environ.get(BROKER_ENV)
+    if backend in ('auto', 'broker') and address:
+        try:
+            coordinator = connect_broker(address)
+            logger.info("已连接到协调 broker: %s" % address)
+            return coordinator
+        except Exception as e:
+            logger.warn("连接协调 broker 失败, 使用 SQLite")
+            logger.debug(e, exc_info=True, stack_info=True)
+    elif backend == 'broker':
+        logger.warn("没有可用的协调 broker, 使用 SQLite")
+    return SQLiteCoordinator(path)
+
+
+if __name__ == '__main__':
+    # 两个账号认领同一个场地, 后一个失败; 过期后可以再认领
+    manager = start_broker()
+    broker = get_coordinator()
+    keys = cell_keys('羽毛球馆', datetime.date.today(), 7, ['19:00-20:00', '20:00-21:00'])
+    print("broker  A 认领: %s, B 认领: %s" % (broker.claim('A', keys), broker.claim('B', keys)))
+    broker.release('A')
+    print("broker  A 放弃后 B 认领: %s" % broker.claim('B', keys))
+    manager.shutdown()
+
+    store = SQLiteCoordinator(':memory:')
+    print("sqlite  A 认领: %s, B 认领: %s" % (store.claim('A', keys, ttl=0.1), store.claim('B', keys)))
+    time.sleep(0.2)
+    print("sqlite  过期后 B 认领: %s" % store.claim('B', keys))
+    start = time.time()
+    store.publish('羽毛球馆', keys[0][1], [(7, '19:00-20:00', False)])
+    print("sqlite  被别人看到已占用: %s" % store.taken_since(keys, start - 1))
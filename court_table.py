@@ -0,0 +1,147 @@
+"""场地表格快照
+
+原先的扫描逻辑对每一行、每个单元格都要调用 find_element / get_attribute,
+每次调用都是一次到 webdriver 的 HTTP 往返, 12 点时这些往返的耗时比场地空闲的时间还长。
+这里用一次 execute_script 把整张表读进内存, 之后的匹配全部在内存中完成,
+只有最终的点击才会再和浏览器交互。
+"""
+import datetime
+from functools import lru_cache
+
+# 与原先的 find_elements(By.TAG_NAME, 'tr') 保持一致: 第 0 行是表头, 最后两行不是场次
+SNAPSHOT_SCRIPT = """
+var rows = document.getElementsByTagName('tr');
+var cellDiv = function (td) { return td ? td.getElementsByTagName('div')[0] : null; };
+var labelOf = function (row) {
+    var div = cellDiv(row.getElementsByTagName('td')[0]);
+    return div ? (div.innerText || div.textContent || '').trim() : '';
+};
+var snapshot = {first_label: rows.length > 1 ? labelOf(rows[1]) : '', labels: [], row_index: [], free: []};
+for (var i = 1; i < rows.length - 2; i++) {
+    var tds = rows[i].getElementsByTagName('td');
+    if (tds.length == 0) { continue; }
+    var free = [];
+    for (var j = 1; j < tds.length; j++) {
+        var div = cellDiv(tds[j]);
+        free.push(!!div && div.classList.contains('free'));
+    }
+    snapshot.labels.push(labelOf(rows[i]));
+    snapshot.row_index.push(i);
+    snapshot.free.push(free);
+}
+return snapshot;
+"""
+
+# 一次调用取回所有需要点击的单元格, arguments[0] 为 [[行号, 列号], ...]
+CELL_SCRIPT = """
+var rows = document.getElementsByTagName('tr');
+return arguments[0].map(function (p) {
+    return rows[p[0]].getElementsByTagName('td')[p[1]].getElementsByTagName('div')[0];
+});
+"""
+
+# 每一页表格最多显示的场地数
+COURTS_PER_TABLE = 5
+
+
+class CourtTable:
+    """某一页场地表格在某一时刻的快照
+
+    Attributes:
+        labels (`list`): 每一行的时间段, 例如 "15:00-16:00"
+
+        row_index (`list`): 每一行在页面所有 tr 中的下标, 用于点击
+
+        free (`list`): free[i][c - 1] 表示第 i 行第 c 列 (第 c 个场地) 是否空闲
+
+        table_num (`int`): 表格编号, 即当前是第几页
+    """
+
+    def __init__(self, labels: list, row_index: list, free: list, table_num: int = 0, first_label: str = '') -> None:
+        self.labels = labels
+        self.row_index = row_index
+        self.free = free
+        self.table_num = table_num
+        self.first_label = first_label
+
+    @classmethod
+    def from_script_result(cls, result: dict, table_num: int = 0) -> 'CourtTable':
+        return cls(result['labels'], result['row_index'], result['free'], table_num, result['first_label'])
+
+    @property
+    def is_loaded(self) -> bool:
+        """表格未加载出来时第一行的时间段一栏显示的是 "时间段" """
+        return self.first_label != "时间段"
+
+    @property
+    def col_count(self) -> int:
+        return len(self.free[0]) if self.free else 0
+
+    @property
+    def col_index_list(self) -> list:
+        """场地所在的列号, 第 0 列是时间段"""
+        return list(range(1, self.col_count + 1))
+
+    def court_num(self, col_index: int) -> int:
+        """列号对应的场地号"""
+        return col_index + self.table_num * COURTS_PER_TABLE
+
+    def is_free(self, row: int, col_index: int) -> bool:
+        return self.free[row][col_index - 1]
+
+    def free_rows(self, rows: list, col_index: int) -> list:
+        """在给定的行中, 找到 col_index 列空闲的行"""
+        return [row for row in rows if self.free[row][col_index - 1]]
+
+    def free_courts(self, rows: list) -> list:
+        """在给定的行中至少有一个空闲时间段的场地号"""
+        return [self.court_num(col_index) for col_index in self.col_index_list
+                if any(self.free[row][col_index - 1] for row in rows)]
+
+
+@lru_cache(maxsize=256)
+def label_minutes(label: str) -> tuple:
+    """把 "15:00-16:00" 解析成从 0 点开始的分钟数 (900, 960), 表格的时间段只有十几种, 结果会被缓存"""
+    start, end = label.split('-')
+    start_hour, start_minute = start.split(':')
+    end_hour, end_minute = end.split(':')
+    return int(start_hour) * 60 + int(start_minute), int(end_hour) * 60 + int(end_minute)
+
+
+def format_minutes(minutes: int) -> str:
+    """label_minutes 的逆操作, 900 -> "15:00" """
+    return "%02d:%02d" % (minutes // 60, minutes % 60)
+
+
+def judge_in_time_range(start_time: datetime.datetime, end_time: datetime.datetime, venue_time_range: str) -> bool:
+    """判断 "15:00-16:00" 这样的时间段是否落在 [start_time, end_time] 内, 只比较时和分"""
+    vt_start, vt_end = label_minutes(venue_time_range)
+    return start_time.hour * 60 + start_time.minute <= vt_start and vt_end <= end_time.hour * 60 + end_time.minute
+
+
+def snapshot_court_table(driver, table_num: int = 0) -> CourtTable:
+    """一次 execute_script 读取当前页面的整张场地表
+
+    Args:
+        driver (WebDriver): webdriver
+
+        table_num (`int`): 表格编号. Defaults to 0.
+
+    Returns:
+        CourtTable: 表格快照
+    """
+    return CourtTable.from_script_result(driver.execute_script(SNAPSHOT_SCRIPT), table_num)
+
+
+def find_cells(driver, table: CourtTable, rows: list, col_index: int) -> list:
+    """一次 execute_script 取回 table 中 rows 行 col_index 列的单元格元素"""
+    return driver.execute_script(CELL_SCRIPT, [[table.row_index[row], col_index] for row in rows])
+
+
+def estimate_legacy_commands(table: CourtTable, valid_rows: int, checked_cols: int) -> int:
+    """估算逐个元素查找的旧扫描方式在同一张表上需要的 webdriver 指令数
+
+    旧方式: 找 tr 1 次, 检查首行 3 次, 每行读时间段 3 次, 有效行再找一次 td,
+    每个检查过的场地在每个有效行上 find_element + get_attribute 2 次
+    """
+    return 1 + 3 + 3 * len(table.labels) + valid_rows + 2 * valid_rows * checked_cols
@@ -1,32 +1,32 @@
-import env_check
 from crontab import CronTab
 import os
 import sys
 import getopt
 
 
+def daemon_command() -> str:
+    # config 按当前目录查找, 所以先 cd 到项目目录
+    return f'cd {os.getcwd()} && python3 daemon.py'
+
+
 def set_crontab():
+    """开机时启动 daemon, 具体什么时候预约由 daemon 按放场时刻决定"""
     user_cron = CronTab(user=True)
-    script_path = os.path.join(os.getcwd(), 'main.py')
-    job = user_cron.new(command=f'python3 {script_path}')
-    try:
-        exec_h = int(input('脚本需要每几小时执行一次？'))
-        # TODO: 或许可以加上个检查，如果当天报过了就不再报？
-    except ValueError:
-        raise ValueError('emmm，输入数字就行哈')
-    if not 0 < exec_h <= 24:
-        raise ValueError('emmm，输得不对？ 输入范围应该是(0, 24]中的整数哦')
-    job.hour.every(exec_h)
+    job = user_cron.new(command=daemon_command())
+    job.every_reboot()
     job.enable()
     user_cron.write()
+    print('已设置开机启动 daemon, 现在可以先手动运行 python3 daemon.py')
 
 
 def reset_crontab():
     user_cron = CronTab(user=True)
     script_path = os.path.join(os.getcwd(), 'main.py')
+    # 旧版本设置的是每隔几小时运行一次 main.py
+    commands = (f'python3 {script_path}', daemon_command())
     count = 0
-    for job in user_cron:
-        if job.command == f'python3 {script_path}':
+    for job in list(user_cron):
+        if job.command in commands:
             user_cron.remove(job)
             user_cron.write()
             count += 1
@@ -0,0 +1,393 @@
+"""常驻的预约守护进程
+
+原先 cron.py 让 crontab 每隔几个小时运行一次 main.py, 每次都要重新启动解释器、import、env_check 和浏览器,
+运行的时刻也和 11:55 / 12:00 的放场时刻没有关系。daemon 常驻后台, 所有 config 只读一次
+(修改后由 ConfigRegistry 按修改时间重新读取), 按每个 config 的备选时间段算出下一次放场的时刻,
+提前几分钟启动子进程登录并进入待命, 抢到场地或超过时限后子进程退出, daemon 继续空闲等待。
+
+本机的控制端口可以查看状态、重新读取 config 和停止:
+
+    python daemon.py
+    python daemon.py status
+    python daemon.py reload
+    python daemon.py stop
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing as mp
+import socket
+import socketserver
+import threading
+import time
+
+from config_registry import get_registry, BOOKING_DAYS
+from release_timer import RELEASE_TIME
+from main import task, max_parallel_browsers, needs_broker, _worker_init
+from coordination import start_broker
+from env_check import check_browser_driver
+from log import setup_logger
+
+CONTROL_HOST = '127.0.0.1'
+CONTROL_PORT = 19530
+
+# 提前多少秒启动子进程登录, 与 Booker 的待命状态 (11:55) 对齐
+PREWARM_SECONDS = 300
+# 从第一次启动子进程算起最长运行多少秒, 超过后结束, 这一天不再重试
+RUN_WINDOW = 1800
+# 子进程异常退出后隔多少秒重新启动
+RETRY_DELAY = 10
+# 空闲时最长多久检查一次 config 是否有修改
+IDLE_CHECK = 60
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def release_datetime(date: datetime.date) -> datetime.datetime:
+    """date 当天的场地放场的时刻"""
+    return datetime.datetime.combine(date - datetime.timedelta(days=BOOKING_DAYS), RELEASE_TIME)
+
+
+def pending_dates(slots: tuple, now: datetime.datetime, done: set = ()) -> list:
+    """还需要预约的目标日期
+
+    跳过已经预约过的日期和已经开始的场次, 星期几格式的时间段同时考虑本周和下周
+
+    Returns:
+        list: [(放场时刻, 日期), ...], 按放场时刻排序
+    """
+    today = now.date()
+    minute = now.hour * 60 + now.minute
+    dates = {}
+    for slot in slots:
+        date = slot.date_on(today)
+        candidates = [date] if slot.date is not None else [date, date + datetime.timedelta(days=7)]
+        for date in candidates:
+            if date < today or (date == today and slot.start <= minute) or date in done:
+                continue
+            dates[date] = release_datetime(date)
+    return sorted((release, date) for date, release in dates.items())
+
+
+def _run_worker(config_name: str, browser_name: str, process_id: int) -> None:
+    _worker_init()
+    task(config_name, browser_name, process_id, check_driver=False)
+
+
+class Job:
+    """一个 config 的预约状态
+
+    Attributes:
+        path (`str`): config 文件名
+
+        process (`multiprocessing.Process`): 正在运行的子进程, 没有运行时为 None
+
+        started (`float`): 子进程启动的时间戳
+
+        dates (`list`): 子进程负责的目标日期
+
+        done (`set`): 已经预约过的日期, 正常退出或超时后不再重试
+
+        window_start (`float`): 这一批日期第一次启动子进程的时间戳, 异常退出后重新启动时不变
+
+        retry_at (`float`): 异常退出后, 这个时间戳之前不重新启动
+
+        failures (`int`): 这一批日期异常退出的次数
+
+        last_result (`str`): 上一次运行的结果
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.process = None
+        self.started = None
+        self.dates = []
+        self.done = set()
+        self.window_start = None
+        self.retry_at = None
+        self.failures = 0
+        self.last_result = None
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None
+
+
+class BookingDaemon:
+    """按放场时刻启动预约子进程
+
+    Args:
+        browser (`str`): 浏览器. Defaults to 'chrome'.
+
+        prewarm (`float`): 提前多少秒启动子进程. Defaults to `PREWARM_SECONDS`.
+
+        window (`float`): 子进程最长运行多少秒. Defaults to `RUN_WINDOW`.
+
+        max_browsers (`int`, optional): 同时运行的浏览器数量上限. Defaults to 按 CPU 和内存计算.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+    """
+
+    def __init__(self, browser: str = 'chrome', prewarm: float = PREWARM_SECONDS, window: float = RUN_WINDOW,
+                 max_browsers: int = None, logger: logging.Logger = None) -> None:
+        self.browser = browser
+        self.prewarm = prewarm
+        self.window = window
+        self.max_workers = max_parallel_browsers(max_browsers)
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.registry = get_registry()
+        self.configs = {}
+        self.errors = {}
+        self.jobs = {}
+        self.started = time.time()
+        self.process_count = 0
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        # 控制端口的线程和主循环都会读写 jobs
+        self._lock = threading.Lock()
+        # spawn 在各个平台上行为一致, 也不会把控制端口的线程 fork 到子进程中
+        self._ctx = mp.get_context('spawn')
+
+    def refresh(self) -> None:
+        """重新扫描 config, 只有修改过的文件才会重新解析"""
+        configs, errors = self.registry.load_all()
+        for path, error in errors.items():
+            if self.errors.get(path) != error:
+                self.logger.warn("config 校验失败, 跳过: %s" % error)
+        self.errors = errors
+        self.configs = {path: config for path, config in configs.items() if config.enabled}
+        for path in self.configs:
+            if path not in self.jobs:
+                self.logger.info("加入 config: %s" % path)
+                self.jobs[path] = Job(path)
+        for path in list(self.jobs):
+            if path not in self.configs and not self.jobs[path].running:
+                self.logger.info("移除 config: %s" % path)
+                del self.jobs[path]
+
+    def next_run(self, job: Job, now: datetime.datetime) -> tuple:
+        """job 下一次启动的时刻和要负责的日期
+
+        一次运行会覆盖所有已经放场或同时放场的日期, 与 Booker 一次预约所有有效时间段一致
+
+        Returns:
+            tuple: (启动时刻 `datetime.datetime`, 日期列表), 没有要预约的日期时为 (None, [])
+        """
+        config = self.configs.get(job.path)
+        pending = pending_dates(config.slots, now, job.done) if config is not None else []
+        if not pending:
+            return None, []
+        release = pending[0][0]
+        horizon = max(release, now)
+        return release - datetime.timedelta(seconds=self.prewarm), [date for r, date in pending if r <= horizon]
+
+    def _start(self, job: Job, dates: list) -> None:
+        self.process_count += 1
+        job.process = self._ctx.Process(
+            target=_run_worker, args=(job.path, self.browser, self.process_count), name=job.path)
+        job.process.start()
+        job.started = time.time()
+        job.dates = dates
+        if job.window_start is None:
+            job.window_start = job.started
+        job.retry_at = None
+        self.logger.info("启动 %s, 目标日期: %s, pid %d" % (
+            job.path, ', '.join(str(d) for d in dates), job.process.pid))
+
+    def _finish(self, job: Job, result: str, done: bool = True) -> None:
+        """子进程结束
+
+        Args:
+            done (`bool`): 这一批日期是否不再重试, 为 False 时 RETRY_DELAY 秒后重新启动. Defaults to True.
+        """
+        if done:
+            job.done.update(job.dates)
+            job.window_start = None
+            job.failures = 0
+        else:
+            job.failures += 1
+            job.retry_at = time.time() + RETRY_DELAY
+        job.last_result = "%s %s" % (datetime.datetime.now().strftime(TIME_FORMAT), result)
+        self.logger.info("%s 结束: %s, 耗时 %.0f s" % (job.path, result, time.time() - job.started))
+        job.process = None
+        job.started = None
+        job.dates = []
+
+    def reap(self) -> None:
+        """回收结束的子进程, 结束超时的子进程
+
+        子进程异常退出 (例如预热时崩溃) 时, 只要还在运行时限内就稍后重新启动, 不放弃这一天的放场
+        """
+        for job in self.jobs.values():
+            if not job.running:
+                continue
+            expired = time.time() - job.window_start > self.window
+            if not job.process.is_alive():
+                job.process.join()
+                exitcode = job.process.exitcode
+                if exitcode == 0:
+                    self._finish(job, '已锁定场地')
+                elif expired:
+                    self._finish(job, '失败 (exitcode %s), 已超过运行时限' % exitcode)
+                else:
+                    self._finish(job, '失败 (exitcode %s), %d 秒后重试' % (exitcode, RETRY_DELAY), done=False)
+            elif expired:
+                job.process.terminate()
+                job.process.join(10)
+                self._finish(job, '超时')
+
+    def step(self) -> float:
+        """扫描一次 config 和子进程, 启动到点的任务
+
+        Returns:
+            float: 距离下一个需要处理的时刻还有多少秒
+        """
+        with self._lock:
+            self.refresh()
+            self.reap()
+            now = datetime.datetime.now()
+            running = sum(1 for job in self.jobs.values() if job.running)
+            delay = IDLE_CHECK
+            for job in self.jobs.values():
+                if job.running:
+                    delay = min(delay, 1)
+                    continue
+                if job.retry_at is not None and time.time() < job.retry_at:
+                    delay = min(delay, job.retry_at - time.time())
+                    continue
+                run_at, dates = self.next_run(job, now)
+                if run_at is None:
+                    continue
+                if run_at > now:
+                    delay = min(delay, (run_at - now).total_seconds())
+                elif running < self.max_workers:
+                    self._start(job, dates)
+                    running += 1
+                    delay = min(delay, 1)
+                else:
+                    # 浏览器数量已满, 等其他子进程结束
+                    delay = min(delay, 1)
+            return max(delay, 0.1)
+
+    def run(self) -> None:
+        self.logger.info("daemon 启动, 最多同时运行 %d 个浏览器" % self.max_workers)
+        with self._lock:
+            self.refresh()
+        # 之后启动的子进程通过环境变量找到 broker, 之后才开启协调的 config 退回到 SQLite
+        broker = start_broker() if needs_broker(list(self.configs)) else None
+        try:
+            while not self.stopping.is_set():
+                delay = self.step()
+                self.wake.wait(delay)
+                self.wake.clear()
+        finally:
+            self.shutdown()
+            if broker is not None:
+                broker.shutdown()
+
+    def shutdown(self) -> None:
+        """结束所有子进程"""
+        with self._lock:
+            for job in self.jobs.values():
+                if job.running:
+                    job.process.terminate()
+                    job.process.join(10)
+                    self._finish(job, '随 daemon 停止')
+        self.logger.info("daemon 已停止")
+
+    def reload(self) -> None:
+        """丢弃 config 缓存, 立即重新读取"""
+        self.registry.clear()
+        self.logger.info("重新读取 config")
+        self.wake.set()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.wake.set()
+
+    def status(self) -> dict:
+        with self._lock:
+            now = datetime.datetime.now()
+            jobs = []
+            for job in self.jobs.values():
+                item = {'config': job.path, 'last_result': job.last_result, 'failures': job.failures}
+                if job.running:
+                    item.update(state='running', pid=job.process.pid, dates=[str(d) for d in job.dates],
+                                elapsed=round(time.time() - job.started))
+                else:
+                    run_at, dates = self.next_run(job, now)
+                    item.update(state='waiting' if run_at is not None else 'idle', dates=[str(d) for d in dates],
+                                next_run=run_at.strftime(TIME_FORMAT) if run_at is not None else None)
+                jobs.append(item)
+            return {'started': datetime.datetime.fromtimestamp(self.started).strftime(TIME_FORMAT),
+                    'jobs': jobs, 'errors': self.errors}
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    """一行一个命令, 回复一行 JSON"""
+
+    def handle(self) -> None:
+        command = self.rfile.readline().decode('utf8').strip()
+        daemon = self.server.booking_daemon
+        if command == 'status':
+            reply = daemon.status()
+        elif command == 'reload':
+            daemon.reload()
+            reply = {'ok': True}
+        elif command == 'stop':
+            daemon.stop()
+            reply = {'ok': True}
+        else:
+            reply = {'error': '未知命令: %s' % command}
+        self.wfile.write((json.dumps(reply, ensure_ascii=False) + '\n').encode('utf8'))
+
+
+class ControlServer(socketserver.ThreadingTCPServer):
+    """只监听本机的控制端口"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, booking_daemon: BookingDaemon, host: str = CONTROL_HOST, port: int = CONTROL_PORT) -> None:
+        super().__init__((host, port), _ControlHandler)
+        self.booking_daemon = booking_daemon
+
+
+def send_command(command: str, host: str = CONTROL_HOST, port: int = CONTROL_PORT, timeout: float = 5) -> dict:
+    """向正在运行的 daemon 发送命令"""
+    with socket.create_connection((host, port), timeout=timeout) as conn:
+        conn.sendall((command + '\n').encode('utf8'))
+        data = conn.makefile('rb').readline()
+    return json.loads(data.decode('utf8'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PKU智慧场馆自动预约守护进程')
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'status', 'reload', 'stop'])
+    parser.add_argument('--browser', default='chrome', choices=['chrome', 'firefox', 'edge'])
+    parser.add_argument('--port', type=int, default=CONTROL_PORT, help='本机控制端口')
+    parser.add_argument('--prewarm', type=float, default=PREWARM_SECONDS, help='提前多少秒启动浏览器登录')
+    parser.add_argument('--window', type=float, default=RUN_WINDOW, help='每次预约最长运行多少秒')
+    parser.add_argument('--max-browsers', type=int, default=None, help='同时运行的浏览器数量上限')
+    args = parser.parse_args()
+
+    if args.command != 'run':
+        try:
+            print(json.dumps(send_command(args.command, port=args.port), ensure_ascii=False, indent=2))
+        except OSError:
+            print("连接不到 daemon, 请确认已经用 python daemon.py 启动")
+        raise SystemExit
+
+    check_browser_driver(args.browser)
+    booking_daemon = BookingDaemon(args.browser, args.prewarm, args.window, args.max_browsers,
+                                   setup_logger('daemon.ini'))
+    server = ControlServer(booking_daemon, port=args.port)
+    threading.Thread(target=server.serve_forever, name='control', daemon=True).start()
+    try:
+        booking_daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
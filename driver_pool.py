@@ -0,0 +1,127 @@
+"""预热的浏览器池
+
+按序预约多个 config 时, 每个 Booker 都要自己启动浏览器并从头登录, 排在后面的 config 会晚很多秒才开始抢。
+DriverPool 在后台提前为后面的 Booker 启动浏览器并完成登录, 用完的浏览器清理后交给下一个 Booker,
+不健康的浏览器会被直接退出并换成新的。
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from browser import create_driver, is_driver_alive, reset_driver, quit_driver
+
+
+class DriverPool:
+    """浏览器池
+
+    Args:
+        browser_name (`str`): chrome, firefox 或 edge
+
+        size (`int`): 同时存在的浏览器数量上限, 也就是最多提前预热几个 Booker. Defaults to 2.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+    """
+
+    def __init__(self, browser_name: str, size: int = 2, logger: logging.Logger = None) -> None:
+        self.browser_name = browser_name
+        self.size = size
+        self.logger = logger if logger is not None else logging.getLogger()
+
+        # 已经清理好, 等待分配的浏览器
+        self._idle = queue.Queue()
+        # 每个存活的浏览器占用一个名额
+        self._slots = threading.Semaphore(size)
+        self._executor = ThreadPoolExecutor(max_workers=size)
+        self._futures = {}
+        # 成功拿到名额的 Booker
+        self._leases = set()
+        self._closed = False
+
+    def _get_driver(self, booker):
+        """取一个可用的浏览器, 优先复用回收的浏览器, 新启动的浏览器使用 booker 的启动配置"""
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                return create_driver(self.browser_name, self.logger, booker.browser_profile, booker.blocked_urls)
+            if is_driver_alive(driver):
+                return driver
+            self.logger.info("回收的浏览器已失效, 重新启动")
+            quit_driver(driver)
+
+    def _warm(self, booker, submit_time: float) -> dict:
+        """在后台线程中为 booker 准备好浏览器并登录"""
+        while not self._slots.acquire(timeout=0.5):
+            if self._closed:
+                raise RuntimeError("浏览器池已关闭")
+        slot_time = time.perf_counter()
+        try:
+            driver = self._get_driver(booker)
+        except Exception:
+            self._slots.release()
+            raise
+        self._leases.add(id(booker))
+        launch_time = time.perf_counter()
+        booker.page_init(driver)
+        ready_time = time.perf_counter()
+        return {
+            'queue': slot_time - submit_time,
+            'launch': launch_time - slot_time,
+            'login': ready_time - launch_time,
+            'ready': ready_time,
+        }
+
+    def submit(self, booker) -> None:
+        """提交一个 Booker, 在后台为其预热浏览器"""
+        submit_time = time.perf_counter()
+        self._futures[id(booker)] = (submit_time, self._executor.submit(self._warm, booker, submit_time))
+
+    def acquire(self, booker) -> None:
+        """等待 booker 预热完成
+
+        预热失败时 booker.status 为 False, keep_run 会按原来的逻辑重新登录
+        """
+        submit_time, future = self._futures.pop(id(booker))
+        wait_start = time.perf_counter()
+        try:
+            timing = future.result()
+        except Exception as e:
+            booker.logger.error("预热浏览器失败")
+            booker.logger.debug(e, exc_info=True, stack_info=True)
+            return
+        booker.logger.info("浏览器就绪: 提交到就绪 %.2f s (排队 %.2f s, 启动 %.2f s, 登录 %.2f s), 实际等待 %.2f s" % (
+            timing['ready'] - submit_time, timing['queue'], timing['launch'], timing['login'],
+            time.perf_counter() - wait_start))
+
+    def release(self, booker) -> None:
+        """回收 booker 使用的浏览器"""
+        driver = booker.detach_driver()
+        if id(booker) not in self._leases:
+            # 预热时没能启动浏览器, 名额已经还回去了, booker 自己启动的浏览器直接退出
+            if driver is not None:
+                quit_driver(driver)
+            return
+        self._leases.discard(id(booker))
+        if driver is None:
+            self._slots.release()
+            return
+        try:
+            reset_driver(driver)
+            self._idle.put(driver)
+        except Exception as e:
+            self.logger.info("浏览器无法清理, 直接退出")
+            self.logger.debug(e, exc_info=True, stack_info=True)
+            quit_driver(driver)
+        self._slots.release()
+
+    def close(self) -> None:
+        """退出池中所有空闲的浏览器, 还没开始预热的 Booker 不再预热"""
+        self._closed = True
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        while True:
+            try:
+                quit_driver(self._idle.get_nowait())
+            except queue.Empty:
+                break
@@ -1,25 +1,26 @@
 # -*- coding: utf-8
-import sys
+import importlib.util
 import os
 import re
-from selenium import webdriver
-from bs4 import BeautifulSoup
-from webdriver_manager.chrome import ChromeDriverManager, DriverCacheManager
-from selenium.webdriver.chrome.service import Service as Chrome_Service
+import json
 import shutil
-from configparser import ConfigParser
+from browser import get_driver_path, find_browser_binary
+from config_registry import get_registry, load_config
+
+# 上一次检查通过时浏览器和驱动的指纹
+DRIVER_CHECK_CACHE = './cache/driver_check.json'
 
 def env_check():
-    try:
-        import selenium
-    except ImportError:
+    # 只检查是否安装, 不在这里导入
+    if importlib.util.find_spec('selenium') is None:
         raise ImportError(
             '没有找到selenium包，请用pip安装一下吧～ pip3 install --user selenium')
 
-    lst_conf = [
-        fileName for fileName in os.listdir()
-        if re.match(r'^config[_0-9a-zA-Z]*.ini$', fileName) and is_config_enabled(fileName)
-    ]
+    # 校验失败的 config 不会被启用
+    configs, errors = get_registry().load_all()
+    for config_name, error in errors.items():
+        print('config 校验失败, 跳过: %s' % error)
+    lst_conf = [config_name for config_name, config in configs.items() if config.enabled]
 
     if len(lst_conf) == 0:
         raise ValueError('请先在config.sample.ini文件中填入个人信息，并将它改名为config.ini')
@@ -29,21 +30,63 @@ def env_check():
     return lst_conf
 
 def is_config_enabled(config_name:str) -> bool:
-    parser = ConfigParser()
-    parser.read(config_name, encoding='utf-8')
-    is_enabled = parser.getboolean('enabled', 'enabled')
-    return is_enabled
+    return load_config(config_name).enabled
+
+def driver_fingerprint(browser) -> dict:
+    """浏览器和驱动可执行文件的路径、修改时间和大小
+
+    找不到驱动或浏览器时返回 None, 不完整的指纹无法发现浏览器升级, 不能用来缓存检查结果
+    """
+    driver_path = get_driver_path(browser)
+    browser_path = find_browser_binary(browser)
+    if not os.path.exists(driver_path) or browser_path is None:
+        return None
+    fingerprint = {}
+    for name, path in (('driver', driver_path), ('browser', browser_path)):
+        stat = os.stat(path)
+        fingerprint[name] = [os.path.abspath(path), stat.st_mtime, stat.st_size]
+    return fingerprint
+
+def _load_driver_cache() -> dict:
+    try:
+        with open(DRIVER_CHECK_CACHE, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_driver_cache(cache: dict) -> None:
+    try:
+        os.makedirs(os.path.dirname(DRIVER_CHECK_CACHE), exist_ok=True)
+        with open(DRIVER_CHECK_CACHE, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+    except OSError:
+        pass
 
 def check_browser_driver(browser):
+    # 浏览器和驱动都没有变化时不再启动一次浏览器检查版本
+    cache = _load_driver_cache()
+    fingerprint = driver_fingerprint(browser)
+    if fingerprint is not None and cache.get(browser) == fingerprint:
+        return
+
     # 目前支持了chrome
     if (browser == 'chrome'):
         __check_chrome_driver()
 
+    # 检查时可能更新了驱动, 重新计算
+    fingerprint = driver_fingerprint(browser)
+    if fingerprint is not None:
+        cache[browser] = fingerprint
+        _save_driver_cache(cache)
+
 def __check_chrome_driver():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service as Chrome_Service
+
     chrome_options = webdriver.ChromeOptions()
     chrome_options.add_argument('--headless')
 
-    chrome_service = Chrome_Service(executable_path='driver/chromedriver.exe')
+    chrome_service = Chrome_Service(executable_path=get_driver_path('chrome'))
     driver = None
     while not driver:
         try:
@@ -53,7 +96,7 @@ def __check_chrome_driver():
             print("Detected that the current driver version and browser version are not compatible, preparing to download a new driver version.") 
             print(f"Old webdriver version: {old_version}")  
             print(f"Current chrome browser version: {cnt_version}")  
-            __update_chrome_webdriver(cnt_version, 'driver/test.exe')
+            __update_chrome_webdriver(cnt_version, get_driver_path('chrome'))
 
     # Use JavaScript to get the version of Chrome
     chrome_version = driver.execute_script("return navigator.userAgent")
@@ -85,9 +128,12 @@ def __get_driver_version_from_exception(e:Exception) -> (str,str):
     return old_chrome_version, current_browser_version
 
 def __update_chrome_webdriver(driver_version:str, driver_path:str):
+    # webdriver_manager 只有需要更新驱动时才用到
+    from webdriver_manager.chrome import ChromeDriverManager, DriverCacheManager
+
     manager = ChromeDriverManager(cache_manager=DriverCacheManager(root_dir='./driver'))
     path = manager.install()
-    shutil.copyfile(path, './driver/chromedriver.exe')
+    shutil.copyfile(path, driver_path)
     shutil.rmtree('./driver/.wdm') 
     
     
@@ -0,0 +1,311 @@
+"""场地空闲情况的历史记录
+
+每次扫描表格得到的空闲情况原先用完就丢了。这里把它们写进本地的 SQLite:
+scans 表记录每一次快照 (时间, 场馆, 日期, 来源, 看到的格子数和空闲数),
+cells 表只记录状态发生变化的格子 (场馆, 日期, 场地号, 时间段), 相当于对快照做了游程压缩,
+两张表合起来可以还原任意一次快照。写入先缓存在内存中, 攒够一批或隔一段时间交给后台线程用一个事务批量插入,
+扫描的循环不会被 SQLite 的文件锁卡住。并行预约的多个进程扫描同一个日期时, 同一个变化只会记录一次。
+
+report 统计退订出来的场地一般在什么时候空出来、提前多久空出来、空出来之后多久被别人抢走,
+用来决定什么时段值得加密轮询:
+
+    python history.py report --days 30
+    python history.py report --venue 羽毛球馆
+"""
+import argparse
+import datetime
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from court_table import CourtTable
+
+HISTORY_DB = './history/availability.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    ts REAL NOT NULL, venue TEXT NOT NULL, date TEXT NOT NULL, source TEXT NOT NULL,
+    cells INTEGER NOT NULL, free INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cells (
+    ts REAL NOT NULL, venue TEXT NOT NULL, date TEXT NOT NULL, court INTEGER NOT NULL, slot TEXT NOT NULL,
+    free INTEGER NOT NULL, first INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cells_key ON cells (venue, date, court, slot, ts);
+CREATE INDEX IF NOT EXISTS scans_ts ON scans (ts);
+"""
+
+# 空出来的时间距离场次开始还有多久, 单位为小时
+LEAD_BUCKETS = ((2, '2 小时内'), (6, '2~6 小时'), (24, '6~24 小时'), (48, '1~2 天'), (float('inf'), '2 天以上'))
+
+
+class HistoryStore:
+    """批量写入空闲情况的历史记录
+
+    Args:
+        path (`str`): SQLite 文件路径. Defaults to `HISTORY_DB`.
+
+        batch_size (`int`): 缓存多少行后写入. Defaults to 500.
+
+        flush_interval (`float`): 距离上次写入超过多少秒时写入, 单位为秒. Defaults to 30.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+    """
+
+    def __init__(self, path: str = HISTORY_DB, batch_size: int = 500, flush_interval: float = 30,
+                 logger: logging.Logger = None) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.logger = logger if logger is not None else logging.getLogger()
+        # 连接和 state 只在后台写入线程中使用, 扫描的线程不会碰 SQLite
+        self.conn = None
+        self._batches = queue.Queue()
+        self._writer = None
+        # [(ts, venue, date, source, 格子数, 空闲数, [(场地号, 时间段, 是否空闲), ...] 或 None), ...]
+        self.pending = []
+        self.pending_rows = 0
+        self.last_flush = time.monotonic()
+        # (venue, date) -> {(court, slot): free}, 每个日期第一次出现时从数据库中恢复
+        self.state = {}
+        # (venue, date) -> 上一次记录的位图, 没有变化时不再逐格比较
+        self.last_bits = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # 并行预约的多个进程会写同一个文件; 自己管理事务, 写入时需要 BEGIN IMMEDIATE 先拿到写锁
+            self.conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+        return self.conn
+
+    def _load_state(self, conn: sqlite3.Connection, venue: str, date: str) -> dict:
+        key = (venue, date)
+        if key not in self.state:
+            state = {}
+            rows = conn.execute(
+                "SELECT court, slot, free FROM cells WHERE venue = ? AND date = ? ORDER BY ts",
+                (venue, date)).fetchall()
+            for court, slot, free in rows:
+                state[(court, slot)] = free
+            self.state[key] = state
+        return self.state[key]
+
+    def record(self, venue: str, date: datetime.date, cells, source: str = 'browser', ts: float = None) -> None:
+        """记录一次快照, 只放进缓存, 比较哪些格子发生了变化由后台线程完成
+
+        Args:
+            venue (`str`): 场馆
+
+            date (`datetime.date`): 日期
+
+            cells (iterable): [(场地号, 时间段, 是否空闲), ...], 可以只是一部分场地
+
+            source (`str`): 数据来源, browser, http 或 watch. Defaults to 'browser'.
+
+            ts (`float`, optional): 时间戳. Defaults to 当前时间.
+        """
+        ts = ts if ts is not None else time.time()
+        cells = [(court, slot, int(bool(free))) for court, slot, free in cells]
+        self.pending.append((ts, venue, date.strftime("%Y-%m-%d"), source,
+                             len(cells), sum(free for _, _, free in cells), cells))
+        self.pending_rows += len(cells) + 1
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        if self.pending_rows >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def record_table(self, venue: str, date: datetime.date, table: CourtTable, source: str = 'browser') -> None:
+        """记录一页场地表格"""
+        self.record(venue, date, (
+            (table.court_num(col), label, table.is_free(row, col))
+            for row, label in enumerate(table.labels) for col in table.col_index_list), source)
+
+    def record_grid(self, venue: str, date: datetime.date, grid, source: str = 'watch') -> None:
+        """记录 watcher 的 AvailabilityGrid, 位图没有变化时只记一次快照"""
+        key = (venue, date)
+        if self.last_bits.get(key) == (grid.labels, grid.bits):
+            self.pending.append((time.time(), venue, date.strftime("%Y-%m-%d"), source,
+                                 len(grid.labels) * grid.courts, bin(grid.bits).count('1'), None))
+            self.pending_rows += 1
+            self._maybe_flush()
+            return
+        self.last_bits[key] = (grid.labels, grid.bits)
+        self.record(venue, date, (
+            (index % grid.courts + 1, grid.labels[index // grid.courts], grid.bits >> index & 1)
+            for index in range(len(grid.labels) * grid.courts)), source)
+
+    def flush(self) -> None:
+        """把缓存的记录交给后台线程写入数据库, 不等待写完"""
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop, name='history-writer', daemon=True)
+            self._writer.start()
+        self._batches.put(self.pending)
+        self.pending, self.pending_rows = [], 0
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = self._batches.get()
+            try:
+                if batch is None:
+                    if self.conn is not None:
+                        self.conn.close()
+                        self.conn = None
+                    return
+                self._write(batch)
+            finally:
+                self._batches.task_done()
+
+    def _write(self, snapshots: list) -> None:
+        """在后台线程中用一个事务写入一批快照, 失败时只记日志, 不影响抢场
+
+        只写入状态发生变化的格子; 其他进程已经记录过的变化 (同一个格子最近一条记录的状态相同) 不再重复写入
+        """
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for ts, venue, date, source, count, free_count, cells in snapshots:
+                    conn.execute("INSERT INTO scans VALUES (?, ?, ?, ?, ?, ?)",
+                                 (ts, venue, date, source, count, free_count))
+                    if cells is None:
+                        continue
+                    state = self._load_state(conn, venue, date)
+                    for court, slot, free in cells:
+                        if state.get((court, slot)) == free:
+                            continue
+                        state[(court, slot)] = free
+                        row = conn.execute(
+                            "SELECT free FROM cells WHERE venue = ? AND date = ? AND court = ? AND slot = ? "
+                            "AND ts <= ? ORDER BY ts DESC LIMIT 1", (venue, date, court, slot, ts)).fetchone()
+                        if row is None or row[0] != free:
+                            conn.execute("INSERT INTO cells VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                         (ts, venue, date, court, slot, free, int(row is None)))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                # 内存中的状态可能已经领先于数据库, 下次从数据库重新恢复
+                self.state.clear()
+                raise
+        except Exception as e:
+            self.logger.warn("写入历史记录失败")
+            self.logger.debug(e, exc_info=True, stack_info=True)
+
+    def close(self) -> None:
+        """写完所有缓存的记录后关闭"""
+        self.flush()
+        if self._writer is not None and self._writer.is_alive():
+            self._batches.put(None)
+            self._writer.join()
+        self._writer = None
+
+
+def _slot_start(date: str, slot: str) -> float:
+    return datetime.datetime.strptime("%s %s" % (date, slot.split('-')[0]), "%Y-%m-%d %H:%M").timestamp()
+
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def analyze(conn: sqlite3.Connection, venue: str = None, days: int = 30) -> dict:
+    """统计退订空出来的格子
+
+    第一次看到就空闲的格子不知道是什么时候空出来的, 不计入统计
+
+    Returns:
+        dict: scans (快照数), freed (空出来的次数), by_hour ({几点: 次数}), by_lead ({提前多久: 次数}),
+            taken_seconds (空出来到被占用的秒数列表), venues ({场馆: 空出来的次数})
+    """
+    since = time.time() - days * 24 * 3600
+    where, params = "ts >= ?", [since]
+    if venue:
+        where += " AND venue = ?"
+        params.append(venue)
+    scans = conn.execute("SELECT count(*) FROM scans WHERE " + where, params).fetchone()[0]
+    rows = conn.execute(
+        "SELECT ts, venue, date, court, slot, free, first FROM cells WHERE " + where +
+        " ORDER BY venue, date, court, slot, ts", params).fetchall()
+
+    result = {'scans': scans, 'freed': 0, 'by_hour': {}, 'by_lead': {}, 'taken_seconds': [], 'venues': {}}
+    freed_at = None
+    last_key = None
+    for ts, row_venue, date, court, slot, free, first in rows:
+        key = (row_venue, date, court, slot)
+        if key != last_key:
+            freed_at = None
+            last_key = key
+        if free and not first:
+            freed_at = ts
+            result['freed'] += 1
+            result['venues'][row_venue] = result['venues'].get(row_venue, 0) + 1
+            hour = datetime.datetime.fromtimestamp(ts).hour
+            result['by_hour'][hour] = result['by_hour'].get(hour, 0) + 1
+            lead = (_slot_start(date, slot) - ts) / 3600
+            for bound, name in LEAD_BUCKETS:
+                if lead < bound:
+                    result['by_lead'][name] = result['by_lead'].get(name, 0) + 1
+                    break
+        elif not free and freed_at is not None:
+            result['taken_seconds'].append(ts - freed_at)
+            freed_at = None
+    return result
+
+
+def report(path: str = HISTORY_DB, venue: str = None, days: int = 30, top: int = 3) -> str:
+    if not os.path.exists(path):
+        return "没有历史记录: %s" % path
+    conn = sqlite3.connect(path)
+    try:
+        result = analyze(conn, venue, days)
+    finally:
+        conn.close()
+
+    lines = ["最近 %d 天, 快照 %d 次, 空出来的场次 %d 次" % (days, result['scans'], result['freed'])]
+    if not result['freed']:
+        return '\n'.join(lines)
+    for name, count in sorted(result['venues'].items(), key=lambda x: -x[1]):
+        lines.append("  %s: %d" % (name, count))
+
+    lines.append("按空出来的时刻:")
+    peak = max(result['by_hour'].values())
+    for hour in sorted(result['by_hour']):
+        count = result['by_hour'][hour]
+        lines.append("  %02d:00  %4d  %s" % (hour, count, '#' * max(1, round(count * 40 / peak))))
+
+    lines.append("按距离场次开始的时间:")
+    for _, name in LEAD_BUCKETS:
+        if name in result['by_lead']:
+            lines.append("  %-10s %4d" % (name, result['by_lead'][name]))
+
+    taken = result['taken_seconds']
+    if taken:
+        lines.append("空出来到被占用: %d 次, p50 %.0f s, p90 %.0f s, 1 分钟内被占用 %.0f%%" % (
+            len(taken), _percentile(taken, 0.5), _percentile(taken, 0.9),
+            100 * sum(1 for x in taken if x <= 60) / len(taken)))
+
+    hours = sorted(result['by_hour'], key=lambda h: -result['by_hour'][h])[:top]
+    lines.append("退订最集中的时段: %s" % ', '.join("%02d:00" % h for h in sorted(hours)))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='场地空闲情况的历史记录')
+    parser.add_argument('command', choices=['report'])
+    parser.add_argument('--db', default=HISTORY_DB)
+    parser.add_argument('--venue', default=None, help='只统计这个场馆')
+    parser.add_argument('--days', type=int, default=30, help='统计最近多少天')
+    args = parser.parse_args()
+
+    print(report(args.db, args.venue, args.days))
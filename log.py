@@ -1,46 +1,247 @@
+"""日志
+
+调用 logger.info 的线程只把记录放进队列, 格式化和写文件、写控制台都由一个后台线程 (QueueListener) 完成,
+抢场的热循环里打日志不会被磁盘和控制台拖慢。同一个 logger 重复 setup 时直接返回, 不会重复添加 handler。
+相同的日志 (数字不同也算相同) 短时间内大量出现时会被限流, 之后补一条省略了多少条。
+开启 json_lines 时额外写一份 JSON lines 日志, 带上 run、account 和 stage 字段, 方便用程序分析。
+"""
+import atexit
+import datetime
+import json
 import logging
 import os
-import datetime
+import queue
+import re
+import threading
 import time
+from logging.handlers import QueueHandler, QueueListener
+
+from config_registry import load_config, ConfigError
+
+LOG_DIR = './log'
+
+LOG_FORMAT = "%(asctime)s %(name)s [%(levelname)s] %(message)s"
+
+# 同一条日志每 RATE_LIMIT_INTERVAL 秒内最多输出 RATE_LIMIT_BURST 条, ERROR 及以上不限流
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_INTERVAL = 10
+
+# 本次运行的标识, 写入 JSON lines 日志
+RUN_ID = "%s-%d" % (datetime.datetime.now().strftime("%Y%m%d%H%M%S"), os.getpid())
+
+_DIGITS = re.compile(r'\d+')
+
+
+class RateLimitFilter(logging.Filter):
+    """相同的日志短时间内出现太多次时丢弃, 恢复输出时在消息后面注明省略了多少条
+
+    Args:
+        burst (`int`): 每个时间窗口内最多输出多少条. Defaults to `RATE_LIMIT_BURST`.
+
+        interval (`float`): 时间窗口, 单位为秒. Defaults to `RATE_LIMIT_INTERVAL`.
+    """
+
+    def __init__(self, burst: int = RATE_LIMIT_BURST, interval: float = RATE_LIMIT_INTERVAL) -> None:
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        # 去掉数字后的消息 -> [窗口开始时间, 窗口内的条数, 省略的条数]
+        self.windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.levelno, _DIGITS.sub('#', str(record.msg)))
+        now = time.monotonic()
+        with self._lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = "%s (之前 %d 秒内省略了 %d 条相同的日志)" % (record.msg, self.interval, suppressed)
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class ContextFilter(logging.Filter):
+    """在调用线程上给记录加上 run、account 和 stage 字段"""
+
+    def __init__(self, account: str) -> None:
+        super().__init__()
+        self.fields = {'run': RUN_ID, 'account': account, 'stage': ''}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, value in self.fields.items():
+            setattr(record, name, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """一条日志一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'run': getattr(record, 'run', RUN_ID),
+            'account': getattr(record, 'account', ''),
+            'stage': getattr(record, 'stage', ''),
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _EnqueueHandler(QueueHandler):
+    """只在进程内传递记录, 不需要像 QueueHandler 默认那样在调用线程上先格式化一遍"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _RoutingHandler(logging.Handler):
+    """在后台线程上按 logger 名字把记录交给各自的 handler"""
 
-def setup_logger(config_path:str, process_id:int = None) -> logging.Logger:
+    def __init__(self) -> None:
+        super().__init__()
+        self.routes = {}
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        for handler in self.routes.get(record.name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+    def close(self) -> None:
+        for handlers in self.routes.values():
+            for handler in handlers:
+                handler.close()
+        super().close()
+
+
+_queue = None
+_router = None
+_listener = None
+_listener_pid = None
+_setup_lock = threading.Lock()
+
+
+def _ensure_listener() -> None:
+    """启动后台线程; fork 出来的子进程中后台线程不存在, 需要重新启动"""
+    global _queue, _router, _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+    _queue = queue.Queue()
+    _router = _RoutingHandler()
+    _listener = QueueListener(_queue, _router)
+    _listener.start()
+    _listener_pid = os.getpid()
+
+
+def flush_logs() -> None:
+    """等待队列中的日志都写完
+
+    multiprocessing 的子进程退出时不会执行 atexit, 退出前需要调用一次
+    """
+    if _queue is not None and _listener_pid == os.getpid():
+        _queue.join()
+
+
+def _stop_listener() -> None:
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        _router.close()
+
+
+atexit.register(_stop_listener)
+
+
+def set_log_context(logger: logging.Logger, **fields) -> None:
+    """修改 JSON lines 日志中的字段, 例如 account 或 stage"""
+    for log_filter in logger.filters:
+        if isinstance(log_filter, ContextFilter):
+            log_filter.fields.update(fields)
+
+
+def _json_lines_enabled(config_path: str) -> bool:
+    """config 的 [log] json_lines, config 不存在或校验失败时为 False"""
+    try:
+        return load_config(config_path).parser.getboolean('log', 'json_lines', fallback=False)
+    except (ConfigError, ValueError):
+        return False
+
+
+def setup_logger(config_path:str, process_id:int = None, json_lines:bool = None) -> logging.Logger:
+    """创建 config 对应的 logger, 同一个 logger 重复调用时直接返回
+
+    Args:
+        config_path (`str`): config 文件名, 决定 logger 的名字和日志文件名
+
+        process_id (`int`, optional): 并行预约时子进程的编号. Defaults to None.
+
+        json_lines (`bool`, optional): 是否额外写一份 JSON lines 日志. Defaults to config 中的 [log] json_lines.
+    """
     # 设置logger的name
     config_name = config_path.split('.')[0]
     logger_name = f"{config_name}_logger"
     if process_id:
         logger_name += f"_{process_id}"
 
-    # 设置log输出的位置
-    log_dir = './log'
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    now = datetime.datetime.now()
-    fmt_time = now.strftime("%Y%m%d_%H_%M_%S")
-
-    logfile_name = f"{logger_name}_{process_id}_{fmt_time}.log" if  process_id else f"{logger_name}_{fmt_time}.log"
-    log_path = os.path.join(log_dir, logfile_name)
-    
     logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.DEBUG)
+    with _setup_lock:
+        _ensure_listener()
+        if logger_name in _router.routes:
+            return logger
 
-    # 创建文件处理器，将日志写入到log.txt文件中
-    file_handler = logging.FileHandler(log_path, encoding='utf-8')
-    file_handler.setLevel(logging.DEBUG)
+        # 设置log输出的位置
+        if not os.path.exists(LOG_DIR):
+            os.makedirs(LOG_DIR)
+        now = datetime.datetime.now()
+        fmt_time = now.strftime("%Y%m%d_%H_%M_%S")
 
-    # 创建控制台处理器，将大于debug级别的日志输出到控制台
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
+        logfile_name = f"{logger_name}_{process_id}_{fmt_time}" if process_id else f"{logger_name}_{fmt_time}"
+        log_path = os.path.join(LOG_DIR, logfile_name)
 
-    # 创建日志格式器
-    formatter = logging.Formatter("%(asctime)s %(name)s [%(levelname)s] %(message)s")
+        # 创建文件处理器，将日志写入到log.txt文件中
+        file_handler = logging.FileHandler(log_path + '.log', encoding='utf-8')
+        file_handler.setLevel(logging.DEBUG)
 
-    # 将格式器添加到处理器
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
+        # 创建控制台处理器，将大于debug级别的日志输出到控制台
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.INFO)
 
-    # 将处理器添加到logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+        # 创建日志格式器
+        formatter = logging.Formatter(LOG_FORMAT)
+        file_handler.setFormatter(formatter)
+        console_handler.setFormatter(formatter)
+        handlers = [file_handler, console_handler]
+
+        if json_lines is None:
+            json_lines = _json_lines_enabled(config_path)
+        if json_lines:
+            json_handler = logging.FileHandler(log_path + '.jsonl', encoding='utf-8')
+            json_handler.setLevel(logging.DEBUG)
+            json_handler.setFormatter(JsonFormatter())
+            handlers.append(json_handler)
+
+        # handler 都在后台线程上执行, logger 上只有一个入队的 handler
+        _router.routes[logger_name] = handlers
+        for handler in list(logger.handlers):
+            if isinstance(handler, _EnqueueHandler):
+                logger.removeHandler(handler)
+        logger.addHandler(_EnqueueHandler(_queue))
+        logger.filters = [f for f in logger.filters if not isinstance(f, (RateLimitFilter, ContextFilter))]
+        logger.addFilter(RateLimitFilter())
+        logger.addFilter(ContextFilter(config_name))
+        logger.setLevel(logging.DEBUG)
 
     # 写入初始信息
     logger.info("Created at " + str(datetime.datetime.now()))
@@ -48,9 +249,17 @@ def setup_logger(config_path:str, process_id:int = None) -> logging.Logger:
     return logger
 
 if __name__ == "__main__":
-    logger = setup_logger("test.ini")
+    logger = setup_logger("test.ini", json_lines=True)
+    assert setup_logger("test.ini") is logger and len(logger.handlers) == 1
     logger.debug("This is a debug message")
     logger.info("This is an info message")
     logger.warning("This is a warning message")
     logger.error("This is an error message")
-    logger.critical("This is a critical message")
\ No newline at end of file
+    logger.critical("This is a critical message")
+
+    # 热循环中的日志只是入队, 重复的日志会被限流
+    start = time.perf_counter()
+    for i in range(10000):
+        logger.debug("查找空闲场地, 第 %d 次尝试" % i)
+    print("每条日志 %.1f µs" % ((time.perf_counter() - start) / 10000 * 1e6))
+    flush_logs()
@@ -1,38 +1,134 @@
-from configparser import ConfigParser
+import argparse
 import multiprocessing as mp
+import os
+import signal
+import sys
 from booker import Booker
-from env_check import *
-from page_func import *
-from log import setup_logger
+from driver_pool import DriverPool
+from env_check import env_check, check_browser_driver
+from log import setup_logger, flush_logs
+from config_registry import load_config
+from coordination import start_broker
 
-def sequence_run(lst_conf, browser="chrome"):
+# 每个 headless 浏览器大约占用的内存, 单位为 MB
+BROWSER_MEMORY_MB = 400
+
+def sequence_run(lst_conf, browser="chrome", pool_size=2):
+    """按序预约, 排在后面的 config 会由 DriverPool 提前启动浏览器并登录"""
     print("按序预约")
+    check_browser_driver(browser)
+    pool = DriverPool(browser, size=pool_size)
+    bookers = []
     for config in lst_conf:
-        print("预约 %s" % config)
-        task(config, browser)
+        booker = Booker(config, setup_logger(config), browser)
+        pool.submit(booker)
+        bookers.append(booker)
+    try:
+        for booker in bookers:
+            print("预约 %s" % booker.config_path)
+            pool.acquire(booker)
+            booker.keep_run()
+            pool.release(booker)
+    finally:
+        pool.close()
+        for booker in bookers:
+            booker.close()
+
+
+def max_parallel_browsers(max_browsers: int = None) -> int:
+    """计算最多可以同时运行几个浏览器
+
+    不超过 CPU 核数, 也不超过物理内存的 3/4 能容纳的浏览器数量, max_browsers 可以进一步限制
+    """
+    limit = os.cpu_count() or 1
+    try:
+        total_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+        limit = min(limit, total_mb * 3 // 4 // BROWSER_MEMORY_MB)
+    except (AttributeError, ValueError, OSError):
+        # Windows 上没有 sysconf, 只按 CPU 核数限制
+        pass
+    if max_browsers:
+        limit = min(limit, max_browsers)
+    return max(1, limit)
+
+
+def needs_broker(lst_conf) -> bool:
+    """是否有 config 开启了账号协调, 开启时由主进程启动 broker"""
+    return any(load_config(config).parser.getboolean('coordination', 'coordination', fallback=False)
+               for config in lst_conf)
+
 
+def _worker_init():
+    """子进程初始化
 
-# def multi_run(lst_conf, browser="chrome"):
-#     parameter_list = []
-#     for i in range(len(lst_conf)):
-#         parameter_list.append((lst_conf[i], browser))
-#     print("并行预约")
-#     pool = mp.Pool()
-#     pool.starmap_async(task, parameter_list)
-#     pool.close()
-#     pool.join()
+    Ctrl-C 只由主进程处理, 主进程 terminate 子进程时发送的 SIGTERM 转换成 SystemExit,
+    这样 task 中的 finally 可以退出浏览器
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
 
 
-def task(config_name:str, browser_name:str, process_id=None):
-    check_browser_driver(browser_name)
+def multi_run(lst_conf, browser="chrome", max_browsers=None):
+    """每个 config 在单独的进程中预约
+
+    Args:
+        lst_conf (`list`): config 文件列表
+
+        browser (`str`): 浏览器. Defaults to "chrome".
+
+        max_browsers (`int`, optional): 同时运行的浏览器数量上限. Defaults to None.
+    """
+    check_browser_driver(browser)
+    processes = min(len(lst_conf), max_parallel_browsers(max_browsers))
+    print("并行预约, 同时运行 %d 个浏览器" % processes)
+
+    # 必须在启动子进程之前, 子进程通过环境变量找到 broker
+    broker = start_broker() if needs_broker(lst_conf) else None
+    pool = mp.Pool(processes=processes, initializer=_worker_init)
+    results = {}
+    for i, config in enumerate(lst_conf):
+        # 单个 config 失败时只影响自己的进程, 浏览器在 task 的 finally 中退出
+        results[config] = pool.apply_async(
+            task, (config, browser, i + 1, False),
+            error_callback=lambda e, config=config: print("预约 %s 失败: %s" % (config, e)))
+    pool.close()
+    try:
+        # 带超时地等待, 让主进程可以及时响应 Ctrl-C
+        for result in results.values():
+            while not result.ready():
+                result.wait(timeout=1)
+    except KeyboardInterrupt:
+        print("收到中断, 正在关闭所有浏览器")
+        pool.terminate()
+    pool.join()
+    if broker is not None:
+        broker.shutdown()
+
+
+def task(config_name:str, browser_name:str, process_id=None, check_driver=True):
+    if check_driver:
+        check_browser_driver(browser_name)
     logger = setup_logger(config_name, process_id)
     booker = Booker(config_name, logger, browser_name)
-    booker.keep_run()
+    try:
+        booker.keep_run()
+    finally:
+        booker.close()
+        # 子进程退出时不会执行 atexit, 先把队列中的日志写完
+        flush_logs()
       
 
 if __name__ == '__main__':
-    browser = "chrome"
+    parser = argparse.ArgumentParser(description='PKU智慧场馆自动预约')
+    parser.add_argument('--browser', default='chrome', choices=['chrome', 'firefox', 'edge'])
+    parser.add_argument('--parallel', action='store_true', help='每个 config 在单独的进程中并行预约')
+    parser.add_argument('--max-browsers', type=int, default=None, help='并行预约时同时运行的浏览器数量上限')
+    parser.add_argument('--pool-size', type=int, default=2, help='按序预约时提前预热的浏览器数量')
+    args = parser.parse_args()
+
     lst_conf = env_check()
     print("本次使用的config文件:" + str(lst_conf))
-    # multi_run(lst_conf, browser)
-    sequence_run(lst_conf, browser)
+    if args.parallel:
+        multi_run(lst_conf, args.browser, args.max_browsers)
+    else:
+        sequence_run(lst_conf, args.browser, args.pool_size)
@@ -0,0 +1,271 @@
+"""各阶段耗时的统计
+
+Booker 的 stage 和 retry 装饰器会把每个阶段的耗时、重试次数和结果记录到 MetricsRegistry 中。
+每次运行结束时写出一份本次运行的 JSON 摘要, 同时把直方图合并到 metrics/aggregate.json,
+再由合并后的数据生成 Prometheus 的 textfile (metrics/booker.prom), 这样可以按周查看每个阶段的 p50/p95:
+
+    python metrics.py
+"""
+import datetime
+import json
+import math
+import os
+import threading
+import time
+
+METRICS_DIR = './metrics'
+AGGREGATE_FILE = 'aggregate.json'
+PROM_FILE = 'booker.prom'
+
+# 直方图的桶, 单位为秒, 从几毫秒的表格扫描到几十秒的登录都能覆盖
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+# 拿不到进程启动时间时, 用 metrics 第一次被导入的时刻近似
+_IMPORTED_AT = time.time()
+
+
+def process_start_time() -> float:
+    """当前进程启动的时间戳
+
+    Linux 上由 /proc/self/stat 的 starttime 和 /proc/uptime 算出, 精度约 10 ms;
+    其他系统用 metrics 第一次被导入的时刻近似, 不包括解释器本身的启动时间
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # 进程名可能包含空格, 从最后一个 ')' 之后开始数, starttime 是第 22 个字段
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - (uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return _IMPORTED_AT
+
+
+class Histogram:
+    """累积计数的直方图, 与 Prometheus 的 histogram 相同"""
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: 'Histogram') -> None:
+        if other.buckets != self.buckets:
+            raise ValueError("直方图的桶不一致, 无法合并")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        """在桶内线性插值估计分位数, 与 Prometheus 的 histogram_quantile 一致"""
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        cumulative = 0
+        for i, bound in enumerate(self.buckets):
+            if cumulative + self.counts[i] >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if math.isinf(bound) or self.counts[i] == 0:
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / self.counts[i]
+            cumulative += self.counts[i]
+        return self.buckets[-2]
+
+    def to_dict(self) -> dict:
+        return {'buckets': [b if not math.isinf(b) else 'inf' for b in self.buckets],
+                'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Histogram':
+        histogram = cls(tuple(math.inf if b == 'inf' else b for b in data['buckets']))
+        histogram.counts = list(data['counts'])
+        histogram.sum = data['sum']
+        histogram.count = data['count']
+        return histogram
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items)
+
+
+class MetricsRegistry:
+    """计数器, 仪表和直方图的集合, 可以在多个线程中使用"""
+
+    def __init__(self) -> None:
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def merge(self, other: 'MetricsRegistry') -> None:
+        """把 other 的计数器和直方图累加进来, 仪表以 other 为准"""
+        with self._lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(other.gauges)
+            for key, histogram in other.histograms.items():
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(histogram.buckets)
+                self.histograms[key].merge(histogram)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'counters': [{'name': k[0], 'labels': dict(k[1]), 'value': v} for k, v in self.counters.items()],
+                'gauges': [{'name': k[0], 'labels': dict(k[1]), 'value': v} for k, v in self.gauges.items()],
+                'histograms': [dict(h.to_dict(), name=k[0], labels=dict(k[1])) for k, h in self.histograms.items()],
+            }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'MetricsRegistry':
+        registry = cls()
+        for item in data.get('counters', []):
+            registry.counters[_key(item['name'], item['labels'])] = item['value']
+        for item in data.get('gauges', []):
+            registry.gauges[_key(item['name'], item['labels'])] = item['value']
+        for item in data.get('histograms', []):
+            registry.histograms[_key(item['name'], item['labels'])] = Histogram.from_dict(item)
+        return registry
+
+    def to_prometheus(self) -> str:
+        """Prometheus 的文本格式"""
+        lines = []
+        with self._lock:
+            for metric_type, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({k[0] for k in metrics}):
+                    lines.append('# TYPE %s %s' % (name, metric_type))
+                    for key, value in metrics.items():
+                        if key[0] == name:
+                            lines.append('%s%s %s' % (name, _format_labels(key[1]), value))
+            for name in sorted({k[0] for k in self.histograms}):
+                lines.append('# TYPE %s histogram' % name)
+                for key, histogram in self.histograms.items():
+                    if key[0] != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if math.isinf(bound) else repr(float(bound))
+                        lines.append('%s_bucket%s %d' % (name, _format_labels(key[1], (('le', le),)), cumulative))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(key[1]), histogram.sum))
+                    lines.append('%s_count%s %d' % (name, _format_labels(key[1]), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class _FileLock:
+    """用 O_EXCL 创建锁文件实现的跨进程锁, 并行预约的多个进程会同时写 aggregate.json"""
+
+    def __init__(self, path: str, timeout: float = 5) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.fd = None
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                self.fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                return self
+            except FileExistsError:
+                if time.time() > deadline:
+                    # 上一个进程崩溃时可能留下了锁文件
+                    try:
+                        os.remove(self.path)
+                    except FileNotFoundError:
+                        pass
+                    deadline = time.time() + self.timeout
+                    continue
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        os.close(self.fd)
+        os.remove(self.path)
+
+
+def _write_atomic(path: str, text: str) -> None:
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def load_aggregate(metrics_dir: str = METRICS_DIR) -> MetricsRegistry:
+    path = os.path.join(metrics_dir, AGGREGATE_FILE)
+    if not os.path.exists(path):
+        return MetricsRegistry()
+    with open(path, encoding='utf-8') as f:
+        return MetricsRegistry.from_dict(json.load(f))
+
+
+def export_run(registry: MetricsRegistry, run_info: dict, metrics_dir: str = METRICS_DIR) -> str:
+    """写出本次运行的摘要, 并合并到历史数据中
+
+    Args:
+        registry (`MetricsRegistry`): 本次运行的统计
+
+        run_info (`dict`): 本次运行的附加信息, 例如 config 和账号
+
+        metrics_dir (`str`): 输出目录. Defaults to `METRICS_DIR`.
+
+    Returns:
+        str: 本次运行摘要的路径
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    now = datetime.datetime.now()
+    summary = dict(run_info, finished_at=now.isoformat(timespec='seconds'), metrics=registry.to_dict())
+    run_path = os.path.join(metrics_dir, 'run_%s_%d.json' % (now.strftime("%Y%m%d_%H_%M_%S_%f"), os.getpid()))
+    _write_atomic(run_path, json.dumps(summary, ensure_ascii=False, indent=1))
+
+    with _FileLock(os.path.join(metrics_dir, AGGREGATE_FILE + '.lock')):
+        aggregate = load_aggregate(metrics_dir)
+        aggregate.merge(registry)
+        aggregate.inc('booker_runs_total')
+        _write_atomic(os.path.join(metrics_dir, AGGREGATE_FILE), json.dumps(aggregate.to_dict()))
+        _write_atomic(os.path.join(metrics_dir, PROM_FILE), aggregate.to_prometheus())
+    return run_path
+
+
+def report(registry: MetricsRegistry) -> str:
+    """按直方图列出次数和 p50/p95"""
+    lines = []
+    for (name, labels), histogram in sorted(registry.histograms.items()):
+        lines.append("%s%s  次数 %d  p50 %.3f s  p95 %.3f s" % (
+            name, _format_labels(labels), histogram.count, histogram.quantile(0.5), histogram.quantile(0.95)))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    print(report(load_aggregate()))
@@ -0,0 +1,465 @@
+"""门户、智慧场馆和 tt识图 的本地模拟
+
+页面结构只保留 Booker 用到的元素 (mainWrap02, user_name, no-border-table, funModule,
+ivu-form-item-content, tableWrap 中带 free 的单元格, 翻页箭头, payHandleItem, verify-img-out,
+payMent, promoptCon), 场地数据通过与真实后端相同格式的 day/info 接口获取,
+验证码图片由服务端生成, /predict 按 tt识图 的格式返回答案。各个接口都可以注入延迟。
+
+    python mock_site.py --port 8800 --api-delay 0.05
+"""
+import argparse
+import base64
+import datetime
+import io
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from PIL import Image, ImageDraw, ImageFont
+
+from venue_client import DAY_INFO_PATH
+
+# 每一页表格显示的场地数, 与真实页面一致
+COURTS_PER_PAGE = 5
+
+TIME_SLOTS = [("%02d:00" % h, "%02d:00" % (h + 1)) for h in range(8, 22)]
+
+CAPTCHA_CHARS = 'ABCDEFGHJKLMNPQRSTUVWXYZ'
+CAPTCHA_SIZE = (310, 155)
+
+# 真实页面上与抢场无关的图片、字体和统计脚本, 用来比较屏蔽资源的效果
+ASSET_COUNT = 6
+ASSETS = '<style>@font-face { font-family: venue; src: url(/static/venue.woff2); } body { font-family: venue; }</style>' + \
+    '<script async src="/static/analytics.js"></script>'
+ASSET_BODY = ''.join('<img src="/static/banner%d.png" width="1" height="1">' % i for i in range(ASSET_COUNT))
+
+SPINNER = '<div id="loading" class="loading ivu-spin ivu-spin-large ivu-spin-fix" style="display:none">加载中</div>'
+
+PORTAL_PAGE = """<!DOCTYPE html><html><head><meta charset="utf-8"><title>北京大学校内信息门户</title></head><body>
+<div><header><section><section class="mainWrap02">
+<ul class="subNavLeft"><li><a class="ng-binding" href="/iaaa/">请登录</a></li></ul>
+</section></section></header></div>
+</body></html>"""
+
+LOGIN_PAGE = """<!DOCTYPE html><html><head><meta charset="utf-8"><title>IAAA</title></head><body>
+<input id="user_name" type="text"><input id="password" type="password">
+<button id="logon_button" onclick="logon()">登录</button>
+<script>
+function logon() {
+    fetch('/iaaa/logon', {method: 'POST', body: JSON.stringify({
+        user_name: document.getElementById('user_name').value,
+        password: document.getElementById('password').value})})
+    .then(function (r) { if (r.ok) { location.href = '/portal2017/home'; } });
+}
+</script>
+</body></html>"""
+
+HOME_PAGE = """<!DOCTYPE html><html><head><meta charset="utf-8"><title>北京大学校内信息门户</title></head><body>
+<div><header><section><section class="mainWrap02"><ul class="subNavLeft"><li>已登录</li></ul></section></section></header></div>
+<table class="no-border-table"><tr><td>我的应用</td></tr></table>
+<div id="all" onclick="document.getElementById('venues').style.display = 'block'">全部</div>
+<div id="venues" style="display:none" onclick="window.open('/venue/')">智慧场馆</div>
+</body></html>"""
+
+VENUE_PAGE = """<!DOCTYPE html><html><head><meta charset="utf-8"><title>智慧场馆</title>
+%(assets)s
+<style>.reserved { background: #ccc; } .free { background: #fff; } .selected { background: #5cadff; }
+td div { width: 60px; height: 20px; }</style></head><body>
+%(spinner)s
+%(asset_body)s
+<div id="app"></div>
+<script>
+var VENUES = %(venues)s;
+var SITE_ID = '%(site_id)s';
+var state = {view: 'home', venue: null, dayOffset: 0, page: 0, data: null, date: null, selected: [], captcha: null, clicks: []};
+var app = document.getElementById('app');
+
+function fmt(d) {
+    var m = d.getMonth() + 1, day = d.getDate();
+    return d.getFullYear() + '-' + (m < 10 ? '0' : '') + m + '-' + (day < 10 ? '0' : '') + day;
+}
+function loading(on) { document.getElementById('loading').style.display = on ? 'block' : 'none'; }
+function post(url, body) {
+    return fetch(url, {method: 'POST', body: JSON.stringify(body)}).then(function (r) { return r.json(); });
+}
+
+function route() {
+    var m = location.hash.match(/^#\\/venue\\/(.+)$/);
+    if (m) {
+        state.view = 'table';
+        state.venue = decodeURIComponent(m[1]);
+        loadDay();
+    } else {
+        render();
+    }
+}
+
+function loadDay() {
+    loading(true);
+    var d = new Date();
+    d.setDate(d.getDate() + state.dayOffset);
+    fetch('%(day_info)s?venueSiteId=' + SITE_ID + '&searchDate=' + fmt(d) + '&nocache=' + Date.now())
+        .then(function (r) { return r.json(); })
+        .then(function (j) {
+            state.data = j.data; state.date = fmt(d); state.page = 0; state.selected = [];
+            loading(false); render();
+        });
+}
+
+function moveDay(step) {
+    var next = state.dayOffset + step;
+    if (next < 0 || next > 3) { return; }
+    state.dayOffset = next;
+    loadDay();
+}
+
+function movePage(step) { state.page += step; render(); }
+
+function toggle(div, court, slot) {
+    if (div.className.split(' ').indexOf('free') < 0) { return; }
+    var key = court + ':' + slot, i = state.selected.indexOf(key);
+    if (i < 0) { state.selected.push(key); div.className += ' selected'; }
+    else { state.selected.splice(i, 1); div.className = div.className.replace(' selected', ''); }
+}
+
+function tableHtml() {
+    var spaces = state.data.reservationDateSpaceInfo[state.date] || [];
+    var times = state.data.spaceTimeInfo;
+    var first = state.page * %(per_page)d, last = Math.min(spaces.length, first + %(per_page)d);
+    var html = '<table><tr><td><div>时间段</div></td>';
+    for (var c = first; c < last; c++) { html += '<td><div>' + spaces[c].spaceName + '</div></td>'; }
+    html += '</tr>';
+    for (var t = 0; t < times.length; t++) {
+        html += '<tr><td><div>' + times[t].beginTime + '-' + times[t].endTime + '</div></td>';
+        for (var c = first; c < last; c++) {
+            var info = spaces[c][String(times[t].id)] || {};
+            var cls = info.reservationStatus == 1 ? 'reserveBlock free' : 'reserveBlock reserved';
+            html += '<td><div class="' + cls + '" onclick="toggle(this, ' + (c + 1) + ', ' + times[t].id + ')"></div></td>';
+        }
+        html += '</tr>';
+    }
+    html += '<tr><td><div class="free">可预约</div></td></tr><tr><td><div class="reserved">不可预约</div></td></tr></table>';
+    if (state.page > 0) { html += '<i class="ivu-icon ivu-icon-ios-arrow-back" onclick="movePage(-1)">&lt;</i>'; }
+    if (last < spaces.length) { html += '<i class="ivu-icon ivu-icon-ios-arrow-forward" onclick="movePage(1)">&gt;</i>'; }
+    return html;
+}
+
+function render() {
+    var html = '';
+    if (state.view == 'home') {
+        html = '<div class="funModule"><div class="funModuleItem">我的预约</div>' +
+            '<div class="funModuleItem" onclick="state.view=\\'venues\\'; render()">场地预约</div></div>';
+    } else if (state.view == 'venues') {
+        for (var i = 0; i < VENUES.length; i++) {
+            html += '<div class="venueItem" onclick="location.hash=\\'#/venue/' + VENUES[i] + '\\'">' + VENUES[i] + '</div>';
+        }
+    } else if (state.view == 'table') {
+        html = '<form><div class="ivu-form-item-content">' +
+            '<button type="button" class="ivu-btn" onclick="moveDay(-1)">前一天</button>' +
+            '<span>' + state.date + '</span>' +
+            '<button type="button" class="ivu-btn" onclick="moveDay(1)">后一天</button></div></form>' +
+            '<div class="tableWrap">' + tableHtml() + '</div>' +
+            '<label class="ivu-checkbox-wrapper"><input type="checkbox" id="agree">我已阅读并同意预约须知</label>' +
+            '<div class="reservationStep1"><div class="payHandle">' +
+            '<div class="payHandleItem">取消</div><div class="payHandleItem" onclick="toStepTwo()">我要预约</div></div></div>';
+    } else if (state.view == 'step2') {
+        html = '<div class="reservation-step-two"><div>已选择 ' + state.selected.length + ' 个时间段</div>' +
+            '<div class="payHandle"><div class="payHandleItem" onclick="state.view=\\'table\\'; render()">返回</div>' +
+            '<div class="payHandleItem" onclick="submitOrder()">提交订单</div></div></div>';
+    } else if (state.view == 'captcha') {
+        html = '<div class="verify-img-out"><img id="captcha" src="data:image/png;base64,' + state.captcha.image + '"></div>' +
+            '<div class="verify-msg">请依次点击【' + state.captcha.chars.split('').join(',') + '】</div>';
+    } else if (state.view == 'pay') {
+        html = '<div class="payMent"><div class="payMentItem">校园卡</div><div class="payMentItem">其他方式</div></div>' +
+            '<div class="payHandle"><span>订单 ' + state.captcha.order + '</span></div>' +
+            '<div class="payHandle"><button>取消</button><button onclick="pay()">确认支付</button></div>';
+    } else if (state.view == 'done') {
+        html = '<div class="promoptCon">支付成功</div>';
+    }
+    app.innerHTML = html;
+    if (state.view == 'captcha') {
+        document.getElementById('captcha').addEventListener('click', clickCaptcha);
+    }
+}
+
+function toStepTwo() {
+    if (!document.getElementById('agree').checked || state.selected.length == 0) { return; }
+    state.view = 'step2'; render();
+}
+
+function submitOrder() {
+    loading(true);
+    post('/mock/order', {date: state.date, cells: state.selected}).then(function (j) {
+        loading(false);
+        if (!j.ok) { alert(j.message); state.view = 'table'; loadDay(); return; }
+        state.captcha = j; state.clicks = []; state.view = 'captcha'; render();
+    });
+}
+
+function clickCaptcha(e) {
+    var img = e.target, rect = img.getBoundingClientRect();
+    state.clicks.push([Math.round((e.clientX - rect.left) * img.naturalWidth / rect.width),
+                       Math.round((e.clientY - rect.top) * img.naturalHeight / rect.height)]);
+    if (state.clicks.length < state.captcha.chars.length) { return; }
+    post('/mock/verify', {id: state.captcha.id, points: state.clicks}).then(function (j) {
+        if (j.ok) { state.view = 'pay'; render(); }
+        else { state.captcha.image = j.image; state.captcha.id = j.id; state.captcha.chars = j.chars; state.clicks = []; render(); }
+    });
+}
+
+function pay() {
+    post('/mock/pay', {order: state.captcha.order}).then(function (j) { state.view = 'done'; render(); });
+}
+
+window.addEventListener('hashchange', route);
+route();
+</script>
+</body></html>"""
+
+
+class MockVenue:
+    """模拟场馆的状态: 场地空闲情况, 订单和验证码
+
+    Args:
+        courts (`int`): 场地数. Defaults to 12.
+
+        free_ratio (`float`): 每个时间段空闲的概率. Defaults to 0.3.
+
+        seed (`int`): 随机种子, 相同的种子在同一天得到相同的空闲情况. Defaults to 0.
+    """
+
+    def __init__(self, courts: int = 12, free_ratio: float = 0.3, seed: int = 0) -> None:
+        self.courts = courts
+        self.free_ratio = free_ratio
+        self.seed = seed
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            # (日期, 场地号, 时间段 id) -> 订单号
+            self.locked = {}
+            self.orders = {}
+            self.captchas = {}
+            # 图片 base64 -> 答案, 供 /predict 使用
+            self.answers = {}
+            self.paid = []
+
+    def is_free(self, date: str, court: int, slot: int) -> bool:
+        if (date, court, slot) in self.locked:
+            return False
+        return random.Random("%s-%s-%d-%d" % (self.seed, date, court, slot)).random() < self.free_ratio
+
+    def day_info(self, date: str) -> dict:
+        time_info = [{"id": i + 1, "beginTime": b, "endTime": e} for i, (b, e) in enumerate(TIME_SLOTS)]
+        spaces = []
+        for court in range(1, self.courts + 1):
+            space = {"id": court, "spaceName": "%d号" % court}
+            for t in time_info:
+                space[str(t['id'])] = {"reservationStatus": 1 if self.is_free(date, court, t['id']) else 4}
+            spaces.append(space)
+        return {"code": 200, "message": "", "data": {
+            "spaceTimeInfo": time_info, "reservationDateSpaceInfo": {date: spaces}}}
+
+    def order(self, date: str, cells: list) -> dict:
+        keys = [(date, int(c.split(':')[0]), int(c.split(':')[1])) for c in cells]
+        with self._lock:
+            if not all(self.is_free(*key) for key in keys):
+                return {'ok': False, 'message': '场地已被预约'}
+            order_id = uuid.uuid4().hex[:8]
+            for key in keys:
+                self.locked[key] = order_id
+            self.orders[order_id] = keys
+        return dict(self.new_captcha(order_id), ok=True, order=order_id)
+
+    def new_captcha(self, order_id: str) -> dict:
+        """生成验证码, 图片中有 5 个字母, 需要依次点击其中 3 个"""
+        chars = random.sample(CAPTCHA_CHARS, 5)
+        img = Image.new('RGB', CAPTCHA_SIZE, tuple(random.randint(170, 250) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        try:
+            font = ImageFont.truetype('DejaVuSans.ttf', 30)
+        except OSError:
+            font = ImageFont.load_default()
+        centers = []
+        for i, c in enumerate(chars):
+            x, y = 15 + i * 58 + random.randint(0, 15), random.randint(10, 100)
+            draw.text((x, y), c, font=font, fill=(0, 0, 0))
+            box = draw.textbbox((x, y), c, font=font)
+            centers.append([(box[0] + box[2]) // 2, (box[1] + box[3]) // 2])
+        buf = io.BytesIO()
+        img.save(buf, 'PNG')
+        image = base64.b64encode(buf.getvalue()).decode()
+
+        targets = random.sample(range(5), 3)
+        captcha_id = uuid.uuid4().hex[:8]
+        with self._lock:
+            self.captchas[captcha_id] = (order_id, [centers[i] for i in targets])
+            self.answers[image] = [centers[i] for i in targets]
+        return {'id': captcha_id, 'image': image, 'chars': ''.join(chars[i] for i in targets)}
+
+    def verify(self, captcha_id: str, points: list, tolerance: int = 15) -> dict:
+        with self._lock:
+            order_id, answer = self.captchas.pop(captcha_id, (None, None))
+        if answer is not None and len(points) == len(answer) and all(
+                (p[0] - a[0]) ** 2 + (p[1] - a[1]) ** 2 <= tolerance ** 2 for p, a in zip(points, answer)):
+            return {'ok': True}
+        return dict(self.new_captcha(order_id), ok=False)
+
+    def predict(self, image: str, error_rate: float = 0) -> dict:
+        """tt识图 /predict 格式的识别结果"""
+        answer = self.answers.get(image)
+        if answer is None:
+            return {'success': False, 'code': '-1', 'message': '识别失败', 'data': ''}
+        if random.random() < error_rate:
+            answer = [[x + 40, y] for x, y in answer]
+        return {'success': True, 'code': '0', 'message': 'success',
+                'data': {'result': '|'.join('%d,%d' % tuple(p) for p in answer), 'id': uuid.uuid4().hex}}
+
+
+class MockSite:
+    """在后台线程中运行的模拟站点
+
+    Args:
+        port (`int`): 端口, 0 表示随机选择. Defaults to 0.
+
+        venue (`MockVenue`, optional): 场馆状态. Defaults to `MockVenue()`.
+
+        delays (`dict`, optional): 注入的延迟, 单位为秒, 键为 page, asset, api, order, captcha. Defaults to None.
+
+        captcha_error_rate (`float`): /predict 返回错误答案的概率. Defaults to 0.
+    """
+
+    VENUES = ['羽毛球馆', '羽毛球场', '网球场']
+    SITE_ID = '60'
+
+    def __init__(self, port: int = 0, venue: MockVenue = None, delays: dict = None,
+                 captcha_error_rate: float = 0) -> None:
+        self.venue = venue if venue is not None else MockVenue()
+        self.delays = dict(delays or {})
+        self.captcha_error_rate = captcha_error_rate
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def start(self) -> 'MockSite':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _delay(self, kind: str) -> None:
+        if self.delays.get(kind):
+            time.sleep(self.delays[kind])
+
+    def _make_handler(self):
+        site = self
+
+        class MockHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _send(self, body, content_type='text/html; charset=utf-8', status=200):
+                if isinstance(body, (dict, list)):
+                    body, content_type = json.dumps(body, ensure_ascii=False), 'application/json;charset=UTF-8'
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self) -> dict:
+                length = int(self.headers.get('Content-Length', 0))
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def do_HEAD(self):
+                # ServerClock 用 HEAD 请求读取 Date 头
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path in ('/', '/portal2017', '/portal2017/'):
+                    site._delay('page')
+                    self._send(PORTAL_PAGE)
+                elif url.path == '/iaaa/':
+                    site._delay('page')
+                    self._send(LOGIN_PAGE)
+                elif url.path == '/portal2017/home':
+                    site._delay('page')
+                    self._send(HOME_PAGE)
+                elif url.path == '/venue/':
+                    site._delay('page')
+                    self._send(VENUE_PAGE % {
+                        'spinner': SPINNER, 'venues': json.dumps(site.VENUES, ensure_ascii=False),
+                        'site_id': site.SITE_ID, 'day_info': DAY_INFO_PATH, 'per_page': COURTS_PER_PAGE,
+                        'assets': ASSETS, 'asset_body': ASSET_BODY})
+                elif url.path.startswith('/static/'):
+                    site._delay('asset')
+                    self._send('', content_type='application/octet-stream')
+                elif url.path == DAY_INFO_PATH:
+                    site._delay('api')
+                    query = parse_qs(url.query)
+                    date = query.get('searchDate', [datetime.date.today().strftime("%Y-%m-%d")])[0]
+                    self._send(site.venue.day_info(date))
+                else:
+                    self._send('not found', status=404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self._body()
+                if url.path == '/iaaa/logon':
+                    self._send({'success': True})
+                elif url.path == '/mock/order':
+                    site._delay('order')
+                    self._send(site.venue.order(body['date'], body['cells']))
+                elif url.path == '/mock/verify':
+                    self._send(site.venue.verify(body['id'], body['points']))
+                elif url.path == '/mock/pay':
+                    site.venue.paid.append(body.get('order'))
+                    self._send({'ok': True})
+                elif url.path == '/mock/reset':
+                    site.venue.reset()
+                    self._send({'ok': True})
+                elif url.path == '/predict':
+                    site._delay('captcha')
+                    self._send(site.venue.predict(body.get('image', ''), site.captcha_error_rate))
+                elif url.path == '/reporterror.json':
+                    self._send({'success': True})
+                else:
+                    self._send('not found', status=404)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MockHandler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='门户、智慧场馆和 tt识图 的本地模拟')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--page-delay', type=float, default=0, help='页面加载的延迟, 单位为秒')
+    parser.add_argument('--asset-delay', type=float, default=0, help='图片、字体等静态资源的延迟')
+    parser.add_argument('--api-delay', type=float, default=0, help='day/info 接口的延迟')
+    parser.add_argument('--order-delay', type=float, default=0, help='提交订单的延迟')
+    parser.add_argument('--captcha-delay', type=float, default=0, help='/predict 验证码识别的延迟')
+    parser.add_argument('--captcha-error-rate', type=float, default=0, help='/predict 返回错误答案的概率')
+    args = parser.parse_args()
+
+    site = MockSite(args.port, delays={'page': args.page_delay, 'asset': args.asset_delay, 'api': args.api_delay,
+                                       'order': args.order_delay, 'captcha': args.captcha_delay},
+                    captcha_error_rate=args.captcha_error_rate)
+    print("模拟站点运行在 %s, 门户地址 %s/portal2017" % (site.url, site.url))
+    site.server.serve_forever()
@@ -2,8 +2,12 @@ from email.header import Header
 from email.mime.text import MIMEText
 from urllib.parse import quote
 from urllib import request
+import atexit
 import json
 import logging
+import queue
+import threading
+import time
 
 
 # ! Deprecated
@@ -20,7 +24,7 @@ def wechat_notification(user_name, venue, venue_num, start_time, end_time, sckey
             print(str(response['errno']) + ' error: ' + response['errmsg'])
     return "微信通知成功\n"
 
-def wechat_push(sckey:str, title:str, content:str, logger=None) -> None:
+def wechat_push(sckey:str, title:str, content:str, logger=None, timeout:float=None) -> bool:
     """通过server酱公众号完成微信推送的功能
 
     Args:
@@ -32,18 +36,183 @@ def wechat_push(sckey:str, title:str, content:str, logger=None) -> None:
 
         logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
 
+        timeout (`float`, optional): 请求的超时时间, 单位为秒. Defaults to None.
+
+    Returns:
+        bool: 是否推送成功
     """
     if logger is None:
         logger = logging.getLogger()
 
     with request.urlopen(
             quote('https://sctapi.ftqq.com/' + sckey + '.send?title=' + title + '&desp=' + content,
-                  safe='/:?=&')) as response:
+                  safe='/:?=&'), timeout=timeout) as response:
         response = json.loads(response.read().decode('utf-8'))
         if response['code'] == 0 and response['data']['error'] == 'SUCCESS':
             logger.info('微信通知成功')
+            return True
         else:
             logger.error('Errno:' + str(response['errno']) + ': ' + response['errmsg'])
+            return False
+
+
+class Notification:
+    """一条待发送的推送, 同一次运行的多条推送会合并成一条
+
+    logger 为发送这条推送的账号的 logger, 发送的结果和错误记在这个账号的日志里
+    """
+
+    def __init__(self, sckey: str, title: str, content: str, key=None, logger: logging.Logger = None) -> None:
+        self.sckey = sckey
+        self.titles = [title]
+        self.contents = [content]
+        self.key = key
+        self.logger = logger
+
+    def can_merge(self, other: 'Notification') -> bool:
+        return self.key is not None and self.key == other.key and self.sckey == other.sckey
+
+    def merge(self, other: 'Notification') -> None:
+        for title in other.titles:
+            if title not in self.titles:
+                self.titles.append(title)
+        self.contents.extend(other.contents)
+
+    @property
+    def title(self) -> str:
+        return ' / '.join(self.titles)
+
+    @property
+    def content(self) -> str:
+        return '\n'.join(c for c in self.contents if c)
+
+
+class NotificationDispatcher:
+    """在后台线程中发送微信推送, 预约流程只需要把消息放进队列
+
+    Server酱的响应可能很慢, 原先在锁定场地和付款之间同步推送, 推送的耗时会直接推迟付款。
+    这里的队列有上限, 满了直接丢弃新消息; 每次请求都有超时, 失败后按指数退避重试;
+    取出一条消息后会稍等片刻, 把同一次运行 (相同的 key) 的后续消息合并成一条, 节省每天的免费推送次数。
+
+    Args:
+        maxsize (`int`): 队列的最大长度. Defaults to 32.
+
+        timeout (`float`): 每次请求的超时时间, 单位为秒. Defaults to 5.
+
+        max_retry (`int`): 失败后的最大重试次数. Defaults to 2.
+
+        coalesce_delay (`float`): 合并消息时等待的时间, 单位为秒. Defaults to 1.
+
+        logger (`logging.Logger`, optional): 消息没有指定 logger 时使用. Defaults to `logging.getLogger(__name__)`.
+
+        push (`callable`, optional): 实际发送推送的函数. Defaults to `wechat_push`.
+    """
+
+    def __init__(self, maxsize: int = 32, timeout: float = 5, max_retry: int = 2,
+                 coalesce_delay: float = 1, logger: logging.Logger = None, push=wechat_push) -> None:
+        self.timeout = timeout
+        self.max_retry = max_retry
+        self.coalesce_delay = coalesce_delay
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self._push = push
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._worker, name='notice', daemon=True)
+        self._thread.start()
+
+    def notify(self, sckey: str, title: str, content: str, key=None, logger: logging.Logger = None) -> bool:
+        """把一条推送放进队列, 不会阻塞
+
+        Args:
+            key (optional): 相同 key 的消息会被合并, 一般为某一次运行的标识. Defaults to None.
+
+            logger (`logging.Logger`, optional): 记录这条推送结果的 logger. Defaults to 分发器的 logger.
+
+        Returns:
+            bool: 是否成功放入队列
+        """
+        try:
+            self._queue.put_nowait(Notification(sckey, title, content, key, logger))
+            return True
+        except queue.Full:
+            (logger or self.logger).warn("微信通知队列已满, 丢弃消息: %s" % title)
+            return False
+
+    def _collect(self, first: Notification) -> list:
+        """取出队列中可以与 first 合并的消息, 返回需要发送的消息列表"""
+        messages = [first]
+        deadline = time.monotonic() + (self.coalesce_delay if first.key is not None else 0)
+        while True:
+            try:
+                message = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            self._queue.task_done()
+            for pending in messages:
+                if pending.can_merge(message):
+                    pending.merge(message)
+                    break
+            else:
+                messages.append(message)
+        return messages
+
+    def _send(self, message: Notification) -> None:
+        logger = message.logger or self.logger
+        for i in range(self.max_retry + 1):
+            try:
+                if self._push(message.sckey, message.title, message.content, logger, timeout=self.timeout):
+                    return
+            except Exception as e:
+                logger.warn("微信通知失败: %s" % e)
+            if i < self.max_retry:
+                time.sleep(2 ** i)
+        logger.error("微信通知发送失败, 已放弃: %s" % message.title)
+
+    def _worker(self) -> None:
+        while True:
+            first = self._queue.get()
+            try:
+                for message in self._collect(first):
+                    self._send(message)
+            except Exception as e:
+                self.logger.debug(e, exc_info=True, stack_info=True)
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout: float = 15, logger: logging.Logger = None) -> bool:
+        """等待队列中的消息发送完, 在预约结束和进程退出时调用
+
+        Args:
+            logger (`logging.Logger`, optional): 超时时记录警告的 logger. Defaults to 分发器的 logger.
+
+        Returns:
+            bool: 是否在 timeout 内全部发送完
+        """
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    (logger or self.logger).warn("仍有 %d 条微信通知没有发送" % self._queue.unfinished_tasks)
+                    return False
+                self._queue.all_tasks_done.wait(remain)
+        return True
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> NotificationDispatcher:
+    """当前进程共用的推送线程, 第一次调用时启动, 进程退出时会等待消息发送完
+
+    按序预约时多个账号共用这个线程, 各自的 logger 在 notify 时传入
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = NotificationDispatcher()
+            atexit.register(_dispatcher.flush)
+    return _dispatcher
 
 if __name__ == '__main__':
     # wechat_notification('', "羽毛球场测试",
@@ -8,7 +8,6 @@ import datetime
 import warnings
 import random
 
-from sqlalchemy import true
 from utils import verify, get_size
 warnings.filterwarnings('ignore')
 
@@ -0,0 +1,171 @@
+"""按服务器时间触发放场时刻
+
+原先的 __spin_wait_until_12 只看本机时间, 本机和场馆服务器的时钟偏差会直接变成抢场的延迟。
+ServerClock 通过 HTTP 响应的 Date 头估计本机和服务器的时钟偏差, ReleaseTrigger 按修正后的时间
+先粗粒度地 sleep, 最后几毫秒再自旋, 尽量准确地在放场时刻返回。
+"""
+import datetime
+import logging
+import math
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+# 放场时间, 提前 3 天的中午 12 点
+RELEASE_TIME = datetime.time(12, 0)
+
+# 最后多少秒使用自旋等待, time.sleep 在 Windows 上的精度只有十几毫秒
+SPIN_SECONDS = 0.02
+
+# 放场前至少留出多少秒, 时钟同步不能拖到放场之后
+SYNC_MARGIN = 0.5
+
+
+class ServerClock:
+    """估计本机时钟与服务器时钟的偏差
+
+    Date 头只精确到秒, 单次请求只能知道偏差落在 [D - t1, D + 1 - t0] 区间内,
+    其中 t0, t1 是请求的发出和返回时间。每次采样都把请求安排在预计的服务器整秒附近发出,
+    多次采样的区间取交集, 偏差的不确定度大约每次减半, 最终受限于网络往返的抖动。
+
+    Args:
+        url (`str`): 用于采样的地址, 应与场馆服务器为同一台机器
+
+        samples (`int`): 采样次数, 每次采样大约需要 1 秒. Defaults to 6.
+
+        timeout (`float`): 单次请求的超时时间. Defaults to 2.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+    """
+
+    def __init__(self, url: str, samples: int = 6, timeout: float = 2, logger: logging.Logger = None) -> None:
+        self.url = url
+        self.samples = samples
+        self.timeout = timeout
+        self.logger = logger if logger is not None else logging.getLogger()
+
+        # 服务器时间 = 本机时间 + offset
+        self.offset = 0.0
+        # offset 的不确定度, 即区间的半宽
+        self.error = math.inf
+        self.synced = False
+
+    def _sample(self, session: requests.Session) -> tuple:
+        t0 = time.time()
+        resp = session.head(self.url, timeout=self.timeout, allow_redirects=False)
+        t1 = time.time()
+        server_time = parsedate_to_datetime(resp.headers['Date']).timestamp()
+        return server_time - t1, server_time + 1 - t0, t1 - t0
+
+    def sync(self, deadline: float = None) -> float:
+        """采样并估计时钟偏差
+
+        Args:
+            deadline (`float`, optional): 本机时间戳, 下一次采样可能超过它时提前结束. Defaults to 不限制.
+
+        Returns:
+            float: 服务器时间减去本机时间, 单位为秒
+        """
+        with requests.Session() as session:
+            lo, hi, rtt = self._sample(session)
+            for _ in range(self.samples - 1):
+                # 每次采样要等到下一个整秒, 最多再加上一次请求的超时
+                if deadline is not None and time.time() + 1 + self.timeout > deadline:
+                    self.logger.info("距离截止时间不足, 提前结束时钟同步")
+                    break
+                # 让请求到达服务器时恰好是预计的下一个服务器整秒
+                mid = (lo + hi) / 2
+                boundary = math.ceil(time.time() + mid + rtt + 0.1)
+                send_at = boundary - mid - rtt / 2
+                time.sleep(max(0.0, send_at - time.time()))
+
+                sample_lo, sample_hi, rtt = self._sample(session)
+                if max(lo, sample_lo) <= min(hi, sample_hi):
+                    lo, hi = max(lo, sample_lo), min(hi, sample_hi)
+                else:
+                    # 网络抖动导致区间没有交集, 以最新的采样为准
+                    lo, hi = sample_lo, sample_hi
+
+        self.offset = (lo + hi) / 2
+        self.error = (hi - lo) / 2
+        self.synced = True
+        self.logger.info("服务器时钟偏差 %+.1f ms (±%.1f ms, 往返 %.1f ms)" % (
+            self.offset * 1000, self.error * 1000, rtt * 1000))
+        return self.offset
+
+    def now(self) -> float:
+        """估计的服务器当前时间戳"""
+        return time.time() + self.offset
+
+
+class ReleaseTrigger:
+    """在服务器时间的放场时刻返回
+
+    Args:
+        clock (`ServerClock`): 服务器时钟
+
+        release_time (`datetime.time`): 放场时间. Defaults to `RELEASE_TIME`.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+    """
+
+    def __init__(self, clock: ServerClock, release_time: datetime.time = RELEASE_TIME,
+                 logger: logging.Logger = None) -> None:
+        self.clock = clock
+        self.release_time = release_time
+        self.logger = logger if logger is not None else logging.getLogger()
+
+    def release_timestamp(self) -> float:
+        """今天放场时刻的时间戳"""
+        return datetime.datetime.combine(datetime.date.today(), self.release_time).timestamp()
+
+    def released(self) -> bool:
+        """按服务器时间是否已经放场"""
+        return self.clock.now() >= self.release_timestamp()
+
+    def wait(self) -> float:
+        """等待到放场时刻
+
+        Returns:
+            float: 实际返回时刻比修正后的放场时刻晚了多少秒
+        """
+        if not self.clock.synced:
+            # 一般在待命或预热时已经同步过, 这里是临近放场才启动的情况, 同步不能拖过放场时刻
+            deadline = self.release_timestamp() - SYNC_MARGIN
+            try:
+                if deadline - time.time() > self.clock.timeout:
+                    self.clock.sync(deadline)
+                else:
+                    self.logger.warn("距离放场时间太短, 跳过服务器时钟同步, 使用本机时间")
+            except Exception as e:
+                self.logger.warn("服务器时钟同步失败, 使用本机时间")
+                self.logger.debug(e, exc_info=True, stack_info=True)
+
+        # 本机时间到达 target 时, 服务器时间恰好到达放场时刻
+        target = self.release_timestamp() - self.clock.offset
+        remain = target - time.time()
+        if remain <= 0:
+            self.logger.warn("开始等待时已经过了放场时刻 %.3f s" % -remain)
+            return -remain
+        self.logger.info("距离放场还有 %.3f s, 等待中..." % remain)
+
+        # 粗粒度 sleep, 每次最多睡 1 秒, 避免 sleep 过头
+        while True:
+            remain = target - time.time()
+            if remain <= SPIN_SECONDS:
+                break
+            time.sleep(min(remain - SPIN_SECONDS, 1.0))
+        # 最后几毫秒自旋
+        while time.time() < target:
+            pass
+
+        late = time.time() - target
+        self.logger.info("放场触发, 偏差修正 %+.1f ms, 触发晚了 %.3f ms" % (
+            self.clock.offset * 1000, late * 1000))
+        return late
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    ServerClock("https://epe.pku.edu.cn").sync()
@@ -0,0 +1,242 @@
+"""自适应的轮询调度
+
+原先每两次查找之间固定 sleep 2~3 秒: 放场那一刻太慢, 下午没人退订的时候又白白发了很多请求。
+PollScheduler 按距离放场时刻的远近选择基础间隔, 再根据服务器最近的响应耗时和出错比例放慢,
+遇到限流 (429/503 等) 时指数退避。每个账号还有一个按小时计的请求预算 (令牌桶),
+同一个账号的多个 config 共用同一个预算。每次决策和实际的轮询频率都会记录到 metrics 中。
+
+    python scheduler.py
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+# 放场前后多少秒内使用最短间隔
+BURST_BEFORE = 5
+BURST_AFTER = 120
+# 放场前后多少秒内使用普通间隔, 之外都算空闲时段
+ACTIVE_WINDOW = 1800
+
+# 被认为是限流的 HTTP 状态码
+THROTTLE_STATUS = (429, 503)
+
+
+class RequestBudget:
+    """令牌桶, 限制一个账号每小时的请求数
+
+    Args:
+        per_hour (`float`): 每小时允许的请求数, 不大于 0 时不限制
+
+        burst (`int`): 桶的容量, 即允许连续发出的请求数. Defaults to 30.
+    """
+
+    def __init__(self, per_hour: float, burst: int = 30) -> None:
+        self.per_hour = per_hour
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def limited(self) -> bool:
+        return self.per_hour > 0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.per_hour / 3600)
+        self.updated = now
+
+    def reserve(self, count: int = 1) -> float:
+        """预约 count 个请求
+
+        Returns:
+            float: 需要再等待多少秒才能发出请求, 0 表示可以立即发出
+        """
+        if not self.limited:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= count
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens * 3600 / self.per_hour
+
+    def remaining(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def get_budget(account: str, per_hour: float, burst: int = 30) -> RequestBudget:
+    """同一个账号共用一个请求预算, 第一次获取时的参数生效"""
+    with _budgets_lock:
+        if account not in _budgets:
+            _budgets[account] = RequestBudget(per_hour, burst)
+        return _budgets[account]
+
+
+def is_throttled(e: Exception) -> bool:
+    """异常是否表示被服务器限流"""
+    response = getattr(e, 'response', None)
+    if response is not None and getattr(response, 'status_code', None) in THROTTLE_STATUS:
+        return True
+    message = str(e)
+    return '频繁' in message or 'Too Many Requests' in message
+
+
+class PollScheduler:
+    """决定下一次查找之前等待多久
+
+    Args:
+        release_trigger (`ReleaseTrigger`, optional): 用来计算距离放场的时间, 为 None 时一直使用普通间隔. Defaults to None.
+
+        min_interval (`float`): 放场前后的间隔, 单位为秒. Defaults to 0.5.
+
+        base_interval (`float`): 放场前后半小时内的间隔. Defaults to 2.5.
+
+        quiet_interval (`float`): 其他时段的间隔. Defaults to 10.
+
+        max_interval (`float`): 退避后的最长间隔. Defaults to 60.
+
+        budget (`RequestBudget`, optional): 请求预算. Defaults to 不限制.
+
+        jitter (`float`): 间隔随机浮动的比例, 避免请求过于规律. Defaults to 0.2.
+
+        name (`str`): metrics 中的 poller 标签. Defaults to 'browser'.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+
+        metrics (`MetricsRegistry`, optional): 记录调度决策和轮询频率. Defaults to None.
+    """
+
+    def __init__(self, release_trigger=None, min_interval: float = 0.5, base_interval: float = 2.5,
+                 quiet_interval: float = 10, max_interval: float = 60, budget: RequestBudget = None,
+                 jitter: float = 0.2, name: str = 'browser', logger: logging.Logger = None, metrics=None) -> None:
+        self.release_trigger = release_trigger
+        self.min_interval = min_interval
+        self.base_interval = base_interval
+        self.quiet_interval = quiet_interval
+        self.max_interval = max_interval
+        self.budget = budget if budget is not None else RequestBudget(0)
+        self.jitter = jitter
+        self.name = name
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.metrics = metrics
+
+        # 响应耗时和出错比例的指数滑动平均
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.alpha = 0.3
+        # 限流时的退避倍数, 每次限流翻倍, 每次成功减半
+        self.backoff = 1.0
+        self.last_phase = None
+        self._polls = deque(maxlen=20)
+
+    def phase(self) -> str:
+        """当前处于放场前后 (burst), 放场前后半小时内 (active) 还是空闲时段 (quiet)"""
+        if self.release_trigger is None:
+            return 'active'
+        since = self.release_trigger.clock.now() - self.release_trigger.release_timestamp()
+        if -BURST_BEFORE <= since <= BURST_AFTER:
+            return 'burst'
+        if abs(since) <= ACTIVE_WINDOW:
+            return 'active'
+        return 'quiet'
+
+    def record(self, latency: float, ok: bool = True, throttled: bool = False) -> None:
+        """记录一次查找的结果
+
+        Args:
+            latency (`float`): 这次查找的耗时, 单位为秒
+
+            ok (`bool`): 是否成功. Defaults to True.
+
+            throttled (`bool`): 是否被限流. Defaults to False.
+        """
+        self._polls.append(time.monotonic())
+        self.latency = latency if self.latency == 0 else (1 - self.alpha) * self.latency + self.alpha * latency
+        self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha * (0 if ok else 1)
+        if throttled:
+            self.backoff = min(self.backoff * 2, self.max_interval / max(self.min_interval, 0.01))
+            self.logger.warn("查询被限流, 轮询间隔放慢到 %.0f 倍" % self.backoff)
+        elif ok:
+            self.backoff = max(1.0, self.backoff / 2)
+        if self.metrics is not None:
+            outcome = 'throttled' if throttled else 'success' if ok else 'error'
+            self.metrics.inc('booker_poll_total', poller=self.name, outcome=outcome)
+            if len(self._polls) > 1:
+                rate = (len(self._polls) - 1) / max(self._polls[-1] - self._polls[0], 1e-6)
+                self.metrics.set('booker_poll_rate_per_second', rate, poller=self.name)
+
+    def next_delay(self, cost: int = 1) -> tuple:
+        """计算下一次查找前需要等待的时间
+
+        Args:
+            cost (`int`): 下一次查找要发出的请求数, 从预算中扣除. Defaults to 1.
+
+        Returns:
+            tuple: (等待秒数, 阶段, 决定间隔的主要原因)
+        """
+        phase = self.phase()
+        interval = {'burst': self.min_interval, 'active': self.base_interval,
+                    'quiet': self.quiet_interval}[phase]
+        reason = phase
+        # 不要比服务器的响应更快, 否则请求只会堆积
+        if self.latency > interval:
+            interval, reason = self.latency, 'latency'
+        if self.error_rate > 0.1:
+            interval, reason = interval * (1 + 4 * self.error_rate), 'errors'
+        if self.backoff > 1:
+            interval, reason = interval * self.backoff, 'throttled'
+        interval *= 1 + self.jitter * (2 * random.random() - 1)
+        interval = min(interval, self.max_interval)
+
+        wait_budget = self.budget.reserve(cost)
+        if wait_budget > interval:
+            interval, reason = wait_budget, 'budget'
+        return interval, phase, reason
+
+    def sleep(self, cost: int = 1, stop: threading.Event = None) -> float:
+        """按 next_delay 等待
+
+        Args:
+            cost (`int`): 下一次查找要发出的请求数. Defaults to 1.
+
+            stop (`threading.Event`, optional): 提前结束等待. Defaults to None.
+
+        Returns:
+            float: 实际计划等待的秒数
+        """
+        delay, phase, reason = self.next_delay(cost)
+        if phase != self.last_phase:
+            self.logger.info("轮询进入 %s 阶段, 间隔约 %.1f s" % (phase, delay))
+            self.last_phase = phase
+        if self.metrics is not None:
+            self.metrics.inc('booker_poll_decisions_total', poller=self.name, phase=phase, reason=reason)
+            self.metrics.set('booker_poll_interval_seconds', delay, poller=self.name)
+            if self.budget.limited:
+                self.metrics.set('booker_poll_budget_remaining', self.budget.remaining(), poller=self.name)
+        if stop is not None:
+            stop.wait(delay)
+        else:
+            time.sleep(delay)
+        return delay
+
+
+if __name__ == '__main__':
+    # 模拟一段时间的轮询, 打印每次的决策
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    scheduler = PollScheduler(min_interval=0.05, base_interval=0.2, quiet_interval=1, max_interval=2,
+                              budget=RequestBudget(per_hour=7200, burst=5))
+    for i in range(30):
+        throttled = 12 <= i < 15
+        scheduler.record(0.02, ok=not throttled, throttled=throttled)
+        delay, phase, reason = scheduler.next_delay()
+        print("%2d  %-6s %-9s %.3f s" % (i, phase, reason, delay))
+        time.sleep(delay)
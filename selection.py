@@ -0,0 +1,200 @@
+"""候选场地的全局排序
+
+原先的做法是把当前这一页的场地打乱, 点击第一个在目标时间段内有空闲格子的场地:
+可能选中只空了一个小时的场地, 也不会比较其他页和其他备选时间段。
+这里把所有页、所有备选时间段的表格都变成候选, 按下面的顺序排序, 再点击最好的那个:
+
+1. 覆盖的目标时间段越完整越好 (只取连续的空闲格子)
+2. 备选时间段越靠前越好
+3. 越靠前的偏好场地号越好, 不在偏好列表中的场地之间随机, 避免多个账号总是点同一列
+
+时间段的解析结果会被缓存, 排序只是比较元组, 一次选择只需要几十微秒。
+
+    python selection.py
+"""
+import random
+import time
+
+from court_table import CourtTable, label_minutes
+
+# 学校规定每人每天最多预约 2 个时段
+MAX_SLOTS_PER_DAY = 2
+
+
+class Window:
+    """一个备选时间段
+
+    Args:
+        index (`int`): 在 [time] 中的先后顺序, 越小越优先
+
+        delta_day (`int`): 距离今天的天数
+
+        start (`int`): 开始时间, 从 0 点开始的分钟数
+
+        end (`int`): 结束时间, 从 0 点开始的分钟数
+    """
+
+    __slots__ = ('index', 'delta_day', 'start', 'end', '_rows')
+
+    def __init__(self, index: int, delta_day: int, start: int, end: int) -> None:
+        self.index = index
+        self.delta_day = delta_day
+        self.start = start
+        self.end = end
+        # 同一组 labels 只计算一次目标行
+        self._rows = (None, None)
+
+    def rows(self, labels: list) -> list:
+        """labels 中落在这个时间段内的行"""
+        if self._rows[0] is not labels:
+            rows = []
+            for i, label in enumerate(labels):
+                start, end = label_minutes(label)
+                if self.start <= start and end <= self.end:
+                    rows.append(i)
+            self._rows = (labels, rows)
+        return self._rows[1]
+
+
+class Candidate:
+    """某个备选时间段在某一页某个场地上的一组连续空闲格子
+
+    Attributes:
+        window (`Window`): 备选时间段
+
+        table_num (`int`): 场地所在的页
+
+        court (`int`): 场地号
+
+        rows (`list`): 要点击的行
+
+        missing (`int`): 目标时间段中没有覆盖到的格子数, 0 表示完整覆盖
+
+        score (`tuple`): 排序用的键, 越小越好
+    """
+
+    __slots__ = ('window', 'table_num', 'court', 'rows', 'missing', 'score')
+
+    def __init__(self, window: Window, table_num: int, court: int, rows: list, missing: int, court_rank: int) -> None:
+        self.window = window
+        self.table_num = table_num
+        self.court = court
+        self.rows = rows
+        self.missing = missing
+        self.score = (missing, window.index, court_rank, random.random())
+
+    @property
+    def full(self) -> bool:
+        return self.missing == 0
+
+    def __repr__(self) -> str:
+        return "Candidate(备选 %d, 第 %d 页, %d号, 行 %s, 缺 %d)" % (
+            self.window.index, self.table_num, self.court, self.rows, self.missing)
+
+
+def _longest_run(rows: list) -> list:
+    """最长的一段连续行"""
+    best, run = [], []
+    for row in rows:
+        if run and row != run[-1] + 1:
+            run = []
+        run.append(row)
+        if len(run) > len(best):
+            best = list(run)
+    return best
+
+
+def court_ranks(preferred_courts: list) -> dict:
+    return {court: rank for rank, court in enumerate(preferred_courts)}
+
+
+def candidates_in_table(window: Window, table: CourtTable, venue_num: int = -1, ranks: dict = None) -> list:
+    """一页表格中这个时间段的所有候选
+
+    Args:
+        venue_num (`int`): 只要这个场地, -1 表示任意场地. Defaults to -1.
+
+        ranks (`dict`, optional): 偏好场地号到名次的映射, 由 court_ranks 生成. Defaults to 没有偏好.
+    """
+    rows = window.rows(table.labels)
+    if not rows:
+        return []
+    ranks = ranks or {}
+    unranked = len(ranks)
+    candidates = []
+    for col_index in table.col_index_list:
+        court = table.court_num(col_index)
+        if venue_num != -1 and court != venue_num:
+            continue
+        free = table.free_rows(rows, col_index)
+        if not free:
+            continue
+        run = free if len(free) == len(rows) else _longest_run(free)
+        candidates.append(Candidate(window, table.table_num, court, run, len(rows) - len(run),
+                                    ranks.get(court, unranked)))
+    return candidates
+
+
+def best_candidate(candidates: list) -> Candidate:
+    """最好的候选, 没有候选时返回 None"""
+    return min(candidates, key=lambda c: c.score) if candidates else None
+
+
+def is_unbeatable(candidate: Candidate, window: Window) -> bool:
+    """从 window 开始往后找不可能再有更好的候选, 可以停止翻页了
+
+    完整覆盖、来自 window 或更靠前的时间段, 并且是最偏好的场地 (没有偏好时任意场地都是)
+    """
+    return candidate is not None and candidate.full and candidate.window.index <= window.index and \
+        candidate.score[2] == 0
+
+
+def backup_candidates(best: Candidate, candidates: list, count: int, max_slots: int = MAX_SLOTS_PER_DAY) -> list:
+    """推测模式下和 best 一起提交订单的后备候选, 从好到差
+
+    每个场地只取一个候选, 与已经选中的候选有重叠格子的跳过。
+    同一天所有选中候选的格子数加起来不超过 max_slots, 即使每个候选最后都生成了订单也不会超过学校的限制
+
+    Args:
+        count (`int`): 最多同时提交几个候选, 包括 best
+
+        max_slots (`int`): 同一天最多预约几个时段. Defaults to `MAX_SLOTS_PER_DAY`.
+    """
+    if best is None:
+        return []
+    slots = {best.window.delta_day: len(best.rows)}
+    courts = {(best.window.delta_day, best.court)}
+    backups = []
+    for candidate in sorted(candidates, key=lambda c: c.score):
+        if len(backups) + 1 >= count:
+            break
+        delta_day = candidate.window.delta_day
+        if candidate is best or (delta_day, candidate.court) in courts:
+            continue
+        if slots.get(delta_day, 0) + len(candidate.rows) > max_slots:
+            continue
+        slots[delta_day] = slots.get(delta_day, 0) + len(candidate.rows)
+        courts.add((delta_day, candidate.court))
+        backups.append(candidate)
+    return backups
+
+
+if __name__ == '__main__':
+    # 三页场地, 两个备选时间段, 测一下选择的耗时
+    labels = ["%02d:00-%02d:00" % (h, h + 1) for h in range(8, 22)]
+    rng = random.Random(0)
+    tables = [CourtTable(labels, list(range(1, 15)), [[rng.random() < 0.3 for _ in range(5)] for _ in labels], n)
+              for n in range(3)]
+    windows = [Window(0, 3, 19 * 60, 21 * 60), Window(1, 3, 17 * 60, 19 * 60)]
+    ranks = court_ranks([7, 8])
+
+    times = 10000
+    start = time.perf_counter()
+    for _ in range(times):
+        best = best_candidate([c for w in windows for t in tables for c in candidates_in_table(w, t, ranks=ranks)])
+    print("最好的候选: %s, 每次选择 %.1f µs" % (best, (time.perf_counter() - start) / times * 1e6))
+
+    # 一小时的时间段, 同一天还能再提交一个后备候选
+    hour = Window(0, 3, 19 * 60, 20 * 60)
+    hourly = [c for t in tables for c in candidates_in_table(hour, t, ranks=ranks)]
+    print("推测模式的后备候选: %s" % backup_candidates(best_candidate(hourly), hourly, 3))
@@ -0,0 +1,116 @@
+"""登录状态的本地缓存
+
+每次 page_init 都要完整地走一遍门户登录和进入场馆的流程, 崩溃重启后 keep_run 又要从头再来。
+这里把场馆页面的 cookie 和 localStorage 按账号保存到本地, 重启后直接恢复并打开场馆页面,
+只有缓存过期或被服务器拒绝时才重新登录。
+"""
+import json
+import logging
+import os
+import time
+from urllib.parse import urlparse
+
+CACHE_DIR = './cache'
+
+# 缓存的最长有效期, 单位为秒, cookie 自身的过期时间更早时以 cookie 为准
+DEFAULT_MAX_AGE = 2 * 60 * 60
+
+# add_cookie 只接受这些字段
+COOKIE_KEYS = ('name', 'value', 'path', 'domain', 'secure', 'httpOnly', 'expiry', 'sameSite')
+
+
+class SessionCache:
+    """某个账号的登录状态缓存
+
+    Args:
+        user_name (`str`): 账号, 每个账号一个缓存文件
+
+        cache_dir (`str`): 缓存目录. Defaults to `CACHE_DIR`.
+
+        max_age (`int`): 缓存的最长有效期, 单位为秒. Defaults to `DEFAULT_MAX_AGE`.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+    """
+
+    def __init__(self, user_name: str, cache_dir: str = CACHE_DIR, max_age: int = DEFAULT_MAX_AGE,
+                 logger: logging.Logger = None) -> None:
+        self.path = os.path.join(cache_dir, 'session_%s.json' % user_name)
+        self.max_age = max_age
+        self.logger = logger if logger is not None else logging.getLogger()
+
+    def save(self, driver) -> None:
+        """保存当前窗口 (场馆页面) 的 cookie, localStorage 和地址"""
+        cookies = driver.get_cookies()
+        local_storage = driver.execute_script(
+            "var items = {};"
+            "for (var i = 0; i < window.localStorage.length; i++) {"
+            "    var key = window.localStorage.key(i); items[key] = window.localStorage.getItem(key);"
+            "}"
+            "return items;")
+
+        now = time.time()
+        expires = now + self.max_age
+        for cookie in cookies:
+            if 'expiry' in cookie:
+                expires = min(expires, cookie['expiry'])
+
+        data = {
+            'url': driver.current_url,
+            'cookies': cookies,
+            'local_storage': local_storage,
+            'saved_at': now,
+            'expires_at': expires,
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # 缓存中有登录凭据, 只允许当前用户读写
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        self.logger.info("登录状态已缓存, 有效期至 %s" % time.strftime("%H:%M:%S", time.localtime(expires)))
+
+    def load(self) -> dict:
+        """读取未过期的缓存, 没有缓存或已过期时返回 None"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            self.clear()
+            return None
+        if data['expires_at'] <= time.time():
+            self.logger.info("缓存的登录状态已过期")
+            self.clear()
+            return None
+        return data
+
+    def restore(self, driver) -> bool:
+        """把缓存的登录状态恢复到浏览器中, 并打开缓存时的场馆页面
+
+        Returns:
+            bool: 是否有可用的缓存. 恢复之后页面是否真的处于登录状态需要调用方再检查
+        """
+        data = self.load()
+        if data is None:
+            return False
+
+        # cookie 和 localStorage 只能写到当前域名下, 所以要先打开对应的域名
+        url = urlparse(data['url'])
+        driver.get("%s://%s/" % (url.scheme, url.netloc))
+        for cookie in data['cookies']:
+            cookie = {k: v for k, v in cookie.items() if k in COOKIE_KEYS}
+            try:
+                driver.add_cookie(cookie)
+            except Exception:
+                # 部分浏览器不接受以 . 开头的 domain, 去掉后默认为当前域名
+                cookie.pop('domain', None)
+                driver.add_cookie(cookie)
+        driver.execute_script(
+            "for (var key in arguments[0]) { window.localStorage.setItem(key, arguments[0][key]); }",
+            data['local_storage'])
+        driver.get(data['url'])
+        return True
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,114 @@
+"""回收的浏览器不能留下上一个账号的登录状态"""
+from browser import reset_driver, _origin
+from driver_pool import DriverPool
+
+
+class FakeSwitchTo:
+    def __init__(self, driver) -> None:
+        self.driver = driver
+
+    def window(self, handle) -> None:
+        self.driver.current = handle
+
+
+class FakeDriver:
+    """按域名保存 cookie、localStorage 和 sessionStorage 的假浏览器, 没有 CDP"""
+
+    def __init__(self) -> None:
+        self.windows = {'main': 'https://epe.pku.edu.cn/venue/home', 'tab': 'http://127.0.0.1:8000/venue'}
+        self.current = 'main'
+        self.switch_to = FakeSwitchTo(self)
+        self.storage = {}
+        self.cookies = {}
+        for url in self.windows.values():
+            origin = _origin(url)
+            self.storage[origin] = {'local': {'token': 'previous-account'}, 'session': {'user': 'previous'}}
+            self.cookies[origin] = {'JSESSIONID': 'x'}
+
+    @property
+    def window_handles(self) -> list:
+        return list(self.windows)
+
+    @property
+    def current_url(self) -> str:
+        return self.windows[self.current]
+
+    def close(self) -> None:
+        del self.windows[self.current]
+
+    def get(self, url: str) -> None:
+        self.windows[self.current] = url
+
+    def delete_all_cookies(self) -> None:
+        self.cookies.pop(_origin(self.current_url), None)
+
+    def execute_script(self, script: str, *args):
+        origin = _origin(self.current_url)
+        if 'localStorage.clear()' in script:
+            self.storage.get(origin, {}).get('local', {}).clear()
+        if 'sessionStorage.clear()' in script:
+            self.storage.get(origin, {}).get('session', {}).clear()
+        if "getItem('token')" in script:
+            return self.storage.get(origin, {}).get('local', {}).get('token')
+
+    def leftover(self) -> dict:
+        return {origin: data for origin, data in self.storage.items() if data['local'] or data['session']}
+
+
+class FakeChromiumDriver(FakeDriver):
+    """支持 CDP 的假浏览器"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.cdp = []
+
+    def execute_cdp_cmd(self, cmd: str, params: dict) -> dict:
+        self.cdp.append((cmd, params))
+        if cmd == 'Network.clearBrowserCookies':
+            self.cookies.clear()
+        elif cmd == 'Storage.clearDataForOrigin' and params['storageTypes'] == 'all':
+            self.storage.pop(params['origin'], None)
+        return {}
+
+
+class FakeBooker:
+    def __init__(self, driver) -> None:
+        self.driver = driver
+
+    def detach_driver(self):
+        driver, self.driver = self.driver, None
+        return driver
+
+
+def release(driver):
+    pool = DriverPool('chrome', size=1)
+    booker = FakeBooker(driver)
+    pool._slots.acquire()
+    pool._leases.add(id(booker))
+    pool.release(booker)
+    return pool._idle.get_nowait()
+
+
+def test_released_chromium_driver_has_no_token():
+    driver = release(FakeChromiumDriver())
+    assert driver.window_handles == ['main']
+    assert driver.current_url == 'about:blank'
+    assert driver.leftover() == {}
+    assert not driver.cookies
+    cleared = {params['origin'] for cmd, params in driver.cdp if cmd == 'Storage.clearDataForOrigin'}
+    assert {'https://epe.pku.edu.cn', 'https://portal.pku.edu.cn', 'http://127.0.0.1:8000'} <= cleared
+
+
+def test_released_driver_without_cdp_has_no_token():
+    driver = release(FakeDriver())
+    assert driver.current_url == 'about:blank'
+    assert driver.leftover() == {}
+    for origin in ('https://epe.pku.edu.cn', 'http://127.0.0.1:8000'):
+        driver.get(origin)
+        assert driver.execute_script("return window.localStorage.getItem('token');") is None
+
+
+def test_reset_driver_keeps_first_window():
+    driver = FakeChromiumDriver()
+    reset_driver(driver)
+    assert driver.window_handles == ['main']
@@ -0,0 +1,56 @@
+"""验证码识别服务"""
+import threading
+import time
+
+from captcha import CaptchaBackend, CaptchaResult, CaptchaSolver
+
+POINTS = [[10, 10], [20, 20], [30, 30]]
+
+
+class ScriptedBackend(CaptchaBackend):
+    """按调用次序依次执行 steps 中的函数"""
+
+    def __init__(self, name: str, steps: list) -> None:
+        self.name = name
+        self.steps = list(steps)
+        self.lock = threading.Lock()
+
+    def solve(self, image: str, content: str, timeout: float) -> CaptchaResult:
+        with self.lock:
+            step = self.steps.pop(0)
+        return step(self.name)
+
+
+def answer(delay: float = 0):
+    def step(name: str) -> CaptchaResult:
+        time.sleep(delay)
+        return CaptchaResult(POINTS, name, 0)
+    return step
+
+
+def fail(delay: float = 0):
+    def step(name: str) -> CaptchaResult:
+        time.sleep(delay)
+        raise RuntimeError("识别失败")
+    return step
+
+
+def test_retry_is_not_delayed_by_stale_loser():
+    # 第一次 fast 胜出, slow 的请求还要 1 秒才返回; 验证码点错后立即重试,
+    # 这次 fast 过一会儿才失败, 只能用 slow 的结果, slow 的请求不能排在上一次的慢请求后面
+    fast = ScriptedBackend('fast', [answer(), fail(0.8)])
+    slow = ScriptedBackend('slow', [answer(1.0), answer()])
+    solver = CaptchaSolver([fast, slow], deadline=3)
+
+    assert solver.solve('image', 'content').backend == 'fast'
+    start = time.perf_counter()
+    result = solver.solve('image', 'content')
+    assert result.backend == 'slow'
+    assert time.perf_counter() - start < 0.5
+
+
+def test_first_valid_result_wins():
+    invalid = ScriptedBackend('invalid', [lambda name: CaptchaResult([[1, 2]], name, 0)])
+    valid = ScriptedBackend('valid', [answer(0.05)])
+    result = CaptchaSolver([invalid, valid], deadline=3).solve('image', 'content')
+    assert result.backend == 'valid' and result.points == POINTS
@@ -0,0 +1,48 @@
+"""空闲情况的历史记录"""
+import datetime
+import sqlite3
+import time
+
+from history import HistoryStore, analyze
+
+SLOT = '19:00-20:00'
+
+
+def test_record_does_not_wait_for_locked_database(tmp_path):
+    path = str(tmp_path / 'history.db')
+    store = HistoryStore(path, batch_size=1)
+    store.record('羽毛球馆', datetime.date.today(), [(1, SLOT, True)])
+    store.close()
+
+    # 另一个进程拿着写锁, 放场时第一次出现的日期也不能卡住扫描的线程
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN EXCLUSIVE")
+    store = HistoryStore(path, batch_size=1)
+    start = time.perf_counter()
+    store.record('羽毛球馆', datetime.date.today() + datetime.timedelta(days=3), [(1, SLOT, True)])
+    store.flush()
+    assert time.perf_counter() - start < 0.1
+    other.execute("COMMIT")
+    other.close()
+    store.close()
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT count(*) FROM scans").fetchone()[0] == 2
+    conn.close()
+
+
+def test_parallel_workers_record_each_change_once(tmp_path):
+    path = str(tmp_path / 'history.db')
+    first, second = HistoryStore(path), HistoryStore(path)
+    today = datetime.date.today()
+    start = time.time()
+    for i, free in enumerate([False, True, True, False]):
+        first.record('羽毛球馆', today, [(1, SLOT, free)], ts=start + i)
+        second.record('羽毛球馆', today, [(1, SLOT, free)], ts=start + i + 0.5)
+    first.close()
+    second.close()
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT free, first FROM cells ORDER BY ts").fetchall() == [(0, 1), (1, 0), (0, 0)]
+    assert analyze(conn)['freed'] == 1
+    conn.close()
@@ -0,0 +1,36 @@
+"""微信推送的后台发送"""
+import logging
+
+from notice import NotificationDispatcher
+
+
+class ListHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+
+
+def make_logger(name: str):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    handler = ListHandler()
+    logger.addHandler(handler)
+    return logger, handler
+
+
+def test_errors_are_logged_to_each_accounts_logger():
+    def push(sckey, title, content, logger, timeout=None):
+        raise RuntimeError("%s 推送失败" % sckey)
+
+    dispatcher = NotificationDispatcher(max_retry=0, coalesce_delay=0, push=push)
+    first, first_log = make_logger('test_notice_first')
+    second, second_log = make_logger('test_notice_second')
+    dispatcher.notify('key1', 'title', 'content', logger=first)
+    dispatcher.notify('key2', 'title', 'content', logger=second)
+    assert dispatcher.flush(timeout=5)
+    assert any('key1' in m for m in first_log.messages)
+    assert not any('key2' in m for m in first_log.messages)
+    assert any('key2' in m for m in second_log.messages)
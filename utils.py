@@ -1,37 +1,33 @@
 import base64
-import json
-import requests
-from configparser import ConfigParser
-from PIL import Image
+from contextlib import contextmanager
 from io import BytesIO
 
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
+from captcha import TTShituBackend, CaptchaError, is_valid_points
+from waits import wait_for
+
+# 单次识别请求的超时时间, 单位为秒
+VERIFY_TIMEOUT = 8
 
 
 def get_size(img):
+    # PIL 只有识别验证码时才用到, 不拖慢启动
+    from PIL import Image
     return Image.open(BytesIO(base64.b64decode(img))).size
 
 def verify(base, content, username, password, retry=0):
-    # print(base, slide)
-    if retry == 3:
-        raise Exception('retry 3 times in captcha')
-    data = {"username": username, "password": password,
-            "typeid": 43, "image": base, "content": content}
-    resp = requests.post("http://api.ttshitu.com/predict", json=data).text
-    result = json.loads(resp)
-    if result['success']:
-        result_str = result['data']['result'].split('|')
-        points = [list(map(int, p.split(','))) for p in result_str]
-        if len(points) == 3:
+    """使用 tt识图 识别点选验证码
+
+    识别失败或结果不是 3 个点时重试, 重试 3 次仍失败则抛出异常
+    """
+    backend = TTShituBackend(username, password)
+    for _ in range(retry, 3):
+        try:
+            points = backend.solve(base, content, timeout=VERIFY_TIMEOUT).points
+        except CaptchaError:
+            continue
+        if is_valid_points(points):
             return points
-        else:
-            return verify(base, content, username, password, retry+1)
-        # return map(int, result["data"]["result"].split(','))
-    else:
-        return result["message"]
+    raise CaptchaError('retry 3 times in captcha')
 
 def check_element_exist(driver, condition, element):
     """_summary_: 检查元素是否存在且可见
@@ -50,20 +46,16 @@ def check_element_exist(driver, condition, element):
     except:
         return False
 
-def wait_loading_complete(driver, locator=None, wait_seconds=10) -> None:
+def wait_loading_complete(driver, locator=None, wait_seconds=10, metrics=None) -> None:
     """等待加载完成
-    locator 中的要素会被执行一个 util 的等待，条件为 visibility_of_element_located
+    加载动画消失并且 locator 中的要素可见时返回, 由页面中的 MutationObserver 触发, 不再轮询
 
     Args:
         driver (WebDriver): webdriver
         locator (tuple): 定位器, 为(By, value)的元组, Defaults to None.
+        metrics (MetricsRegistry): 记录等待耗时, Defaults to None.
     """
-
-    WebDriverWait(driver, wait_seconds).until_not(
-        EC.visibility_of_element_located((By.CLASS_NAME, "loading.ivu-spin.ivu-spin-large.ivu-spin-fix")))
-    if (locator):
-        WebDriverWait(driver, wait_seconds).until(
-            EC.visibility_of_element_located(locator))
+    wait_for(driver, locator, wait_seconds, metrics)
 
 def element_click(driver, element):
     """解决selenium的click无效的问题
@@ -76,5 +68,47 @@ def element_click(driver, element):
     except:
         driver.execute_script("arguments[0].click();", element)
 
+class CommandCounter:
+    """记录 webdriver 指令的次数"""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.commands = {}
+
+    def record(self, command: str) -> None:
+        self.count += 1
+        self.commands[command] = self.commands.get(command, 0) + 1
+
+
+@contextmanager
+def count_webdriver_commands(driver):
+    """统计 with 块中发往 webdriver 的指令数
+
+    WebElement 的所有操作最终都会调用 driver.execute, 每次调用就是一次 HTTP 往返,
+    所以这里直接在实例上包一层 execute 来计数
+
+    Args:
+        driver (WebDriver): webdriver
+
+    Yields:
+        CommandCounter: 计数器
+    """
+    counter = CommandCounter()
+    execute = driver.execute
+    wrapped = 'execute' in vars(driver)
+
+    def counted_execute(driver_command, params=None):
+        counter.record(driver_command)
+        return execute(driver_command, params)
+
+    driver.execute = counted_execute
+    try:
+        yield counter
+    finally:
+        if wrapped:
+            driver.execute = execute
+        else:
+            del driver.execute
+
 # if __name__ == '__main__':
 	# result = verify(base, slide)
\ No newline at end of file
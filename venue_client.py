@@ -0,0 +1,132 @@
+"""绕过浏览器直接查询场地空闲情况的 HTTP 客户端
+
+智慧场馆的前端是一个 SPA, 表格里的数据都来自后端的 day/info 接口。
+轮询时没有必要刷新整个页面再解析 DOM, 直接复用浏览器里已经登录的会话请求这个接口即可,
+浏览器只负责最后的点击和确认。
+"""
+import datetime
+import json
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from court_table import CourtTable
+
+DEFAULT_BASE_URL = "https://epe.pku.edu.cn"
+DAY_INFO_PATH = "/venue-server/api/reservation/day/info"
+
+# 后端返回的场地状态, 1 表示可以预约
+FREE_STATUS = 1
+
+
+class VenueClientError(Exception):
+    """场地接口返回了错误"""
+
+
+class VenueClient:
+    """使用连接池的场地空闲查询客户端
+
+    Args:
+        base_url (`str`): 场馆后端的地址. Defaults to `DEFAULT_BASE_URL`.
+
+        venue_site_id (`str`): 场地的 venueSiteId, 可以在浏览器开发者工具的 day/info 请求中看到
+
+        timeout (`float`): 单次请求的超时时间, 单位为秒. Defaults to 2.
+
+        pool_size (`int`): 连接池大小. Defaults to 4.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+    """
+
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, venue_site_id: str = '', timeout: float = 2,
+                 pool_size: int = 4, logger: logging.Logger = None) -> None:
+        self.base_url = base_url.rstrip('/')
+        self.venue_site_id = venue_site_id
+        self.timeout = timeout
+        self.logger = logger if logger is not None else logging.getLogger()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # 最近一次请求的耗时, 单位为秒
+        self.last_latency = 0.0
+
+    def load_driver_session(self, driver) -> None:
+        """从已经登录并进入场馆页面的 webdriver 中复制 cookie 和 token
+
+        Args:
+            driver (WebDriver): 当前窗口为智慧场馆页面的 webdriver
+        """
+        for cookie in driver.get_cookies():
+            self.session.cookies.set(cookie['name'], cookie['value'],
+                                     domain=cookie.get('domain', ''), path=cookie.get('path', '/'))
+        # 场馆前端把登录后的 token 放在 localStorage 里, 请求时带在 cgAuthorization 头上
+        token = driver.execute_script("return window.localStorage.getItem('token');")
+        if token:
+            self.session.headers['cgAuthorization'] = token
+        self.session.headers['User-Agent'] = driver.execute_script("return navigator.userAgent;")
+        self.logger.debug("HTTP 客户端已复制 %d 个 cookie" % len(self.session.cookies))
+
+    def fetch_day_info(self, date: datetime.date, venue_site_id: str = None) -> dict:
+        """请求某一天的场地信息, 返回后端原始的 data 字段
+
+        Args:
+            venue_site_id (`str`, optional): 查询其他场馆时指定. Defaults to 构造时的 venue_site_id.
+        """
+        params = {
+            'venueSiteId': venue_site_id or self.venue_site_id,
+            'searchDate': date.strftime("%Y-%m-%d"),
+            'nocache': int(time.time() * 1000),
+        }
+        start = time.perf_counter()
+        resp = self.session.get(self.base_url + DAY_INFO_PATH, params=params, timeout=self.timeout)
+        self.last_latency = time.perf_counter() - start
+        resp.raise_for_status()
+
+        result = resp.json()
+        if result.get('code') != 200:
+            raise VenueClientError("查询场地失败: %s" % result.get('message'))
+        return result['data']
+
+    def fetch_table(self, date: datetime.date) -> CourtTable:
+        """查询某一天的空闲情况, 返回包含所有场地的表格快照"""
+        return parse_day_info(self.fetch_day_info(date), date)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def parse_day_info(data: dict, date: datetime.date) -> CourtTable:
+    """把 day/info 的 data 字段转换成 CourtTable
+
+    data 的结构为:
+        spaceTimeInfo: [{"id": 时间段id, "beginTime": "15:00", "endTime": "16:00"}, ...]
+
+        reservationDateSpaceInfo: {"2023-10-20": [{"spaceName": "1号", "<时间段id>": {"reservationStatus": 1}, ...}, ...]}
+
+    每个场地是一列, 每个时间段是一行, 与页面上的表格保持一致。
+    由于后端一次返回所有场地, 这里得到的表格 table_num 为 0, 列号直接就是场地号
+    """
+    time_info = data['spaceTimeInfo']
+    spaces = data['reservationDateSpaceInfo'].get(date.strftime("%Y-%m-%d"), [])
+
+    labels = ["%s-%s" % (t['beginTime'], t['endTime']) for t in time_info]
+    free = []
+    for t in time_info:
+        key = str(t['id'])
+        free.append([(space.get(key) or {}).get('reservationStatus') == FREE_STATUS for space in spaces])
+    # 与页面上的表格保持一致, 第 0 行是表头
+    row_index = list(range(1, len(labels) + 1))
+    return CourtTable(labels, row_index, free, table_num=0, first_label=labels[0] if labels else '')
+
+
+if __name__ == "__main__":
+    # 对本地的 venue_stub 做一次查询
+    client = VenueClient(base_url="http://127.0.0.1:8765", venue_site_id='60')
+    table = client.fetch_table(datetime.date.today())
+    print(json.dumps({'labels': table.labels, 'free': table.free}, ensure_ascii=False))
+    print("耗时 %.1f ms" % (client.last_latency * 1000))
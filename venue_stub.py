@@ -0,0 +1,120 @@
+"""场地接口的本地桩服务
+
+把录制下来的 day/info 响应原样返回, 用于离线调试和测试 VenueClient 的延迟。
+
+    python venue_stub.py serve --port 8765
+    python venue_stub.py bench --times 200
+"""
+import argparse
+import datetime
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from venue_client import VenueClient, DAY_INFO_PATH
+
+RECORD_DIR = 'recorded'
+
+
+def load_recorded(record_dir: str = RECORD_DIR) -> dict:
+    """读取录制的响应, 文件名为 day_info.json 或 day_info_<venueSiteId>.json"""
+    responses = {}
+    for file_name in os.listdir(record_dir):
+        if file_name.startswith('day_info') and file_name.endswith('.json'):
+            key = file_name[len('day_info'):-len('.json')].lstrip('_')
+            with open(os.path.join(record_dir, file_name), encoding='utf-8') as f:
+                responses[key] = json.load(f)
+    return responses
+
+
+def make_handler(responses: dict, delay: float = 0):
+    """生成请求处理类
+
+    Args:
+        responses (`dict`): venueSiteId 到录制响应的映射, 键为 '' 的响应是默认响应
+
+        delay (`float`): 每次响应前额外等待的时间, 单位为秒
+    """
+
+    class StubHandler(BaseHTTPRequestHandler):
+        # 使用 keep-alive, 和真实服务器的行为保持一致
+        protocol_version = 'HTTP/1.1'
+        # 响应头和响应体分两次写出, 不关掉 Nagle 的话每次请求都会多等一个 delayed ACK
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != DAY_INFO_PATH:
+                self.send_error(404)
+                return
+            query = parse_qs(url.query)
+            site_id = query.get('venueSiteId', [''])[0]
+            search_date = query.get('searchDate', [datetime.date.today().strftime("%Y-%m-%d")])[0]
+
+            recorded = responses.get(site_id, responses.get(''))
+            if recorded is None:
+                self.send_error(404)
+                return
+            # 录制的响应只包含录制当天的数据, 这里换成请求的日期
+            data = dict(recorded['data'])
+            data['reservationDateSpaceInfo'] = {
+                search_date: next(iter(recorded['data']['reservationDateSpaceInfo'].values()), [])}
+            body = json.dumps(dict(recorded, data=data), ensure_ascii=False).encode('utf-8')
+
+            if delay:
+                time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json;charset=UTF-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def start_stub_server(port: int = 0, record_dir: str = RECORD_DIR, delay: float = 0) -> ThreadingHTTPServer:
+    """在后台线程中启动桩服务, port 为 0 时随机选择端口"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(load_recorded(record_dir), delay))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench(times: int, delay: float = 0) -> None:
+    """测量 VenueClient 对桩服务的轮询延迟"""
+    server = start_stub_server(delay=delay)
+    client = VenueClient(base_url="http://127.0.0.1:%d" % server.server_address[1])
+    date = datetime.date.today()
+    latencies = []
+    for _ in range(times):
+        start = time.perf_counter()
+        client.fetch_table(date)
+        latencies.append(time.perf_counter() - start)
+    server.shutdown()
+    client.close()
+
+    latencies.sort()
+    print("请求 %d 次, p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+        times, latencies[len(latencies) // 2] * 1000,
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='场地接口的本地桩服务')
+    parser.add_argument('command', choices=['serve', 'bench'])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=0, help='每次响应的额外延迟, 单位为秒')
+    parser.add_argument('--times', type=int, default=200, help='bench 的请求次数')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(load_recorded(), args.delay))
+        print("桩服务运行在 http://127.0.0.1:%d" % args.port)
+        server.serve_forever()
+    else:
+        bench(args.times, args.delay)
@@ -0,0 +1,245 @@
+"""事件驱动的页面等待
+
+WebDriverWait 每隔 0.5 s 向浏览器查询一次, 加上流程里各处固定的 sleep, 每一步都白白多等几百毫秒。
+这里把等待条件放进浏览器里执行: execute_async_script 注册一个 MutationObserver,
+DOM 每次变化时检查 ivu 的加载动画是否消失、目标元素是否出现, 条件满足的那一刻就返回。
+每次等待的实际耗时会记录到 metrics 的 booker_wait_seconds 中。
+"""
+import logging
+import time
+
+from selenium.common.exceptions import TimeoutException, WebDriverException, StaleElementReferenceException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+
+# ivu 的全屏加载动画
+SPINNER_SELECTOR = '.loading.ivu-spin.ivu-spin-large.ivu-spin-fix'
+
+# 公共部分: 定位元素和判断可见, 与 visibility_of_element_located 的判断方式一致
+_COMMON_SCRIPT = """
+var spinnerSelector = '%s';
+var visible = function (el) {
+    if (!el) { return false; }
+    var style = window.getComputedStyle(el);
+    return style.display !== 'none' && style.visibility !== 'hidden' &&
+        !!(el.offsetWidth || el.offsetHeight || el.getClientRects().length);
+};
+var find = function (target) {
+    if (!target) { return null; }
+    if (target[0] === 'xpath') {
+        return document.evaluate(target[1], document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    }
+    return document.querySelector(target[1]);
+};
+var ready = function (target) {
+    // reload_nowait 之后旧页面还没有卸载, 不能把旧页面当成加载完成
+    if (window.__bookerStale) { return false; }
+    var spinners = document.querySelectorAll(spinnerSelector);
+    for (var i = 0; i < spinners.length; i++) {
+        if (visible(spinners[i])) { return false; }
+    }
+    return !target || visible(find(target));
+};
+// 被监听的节点可能整个被替换掉, 所以监听整个页面, 再筛选与它有关的变化
+var touchesFor = function (watchSelector) {
+    var contains = function (node) {
+        return node.nodeType === 1 && (node.matches(watchSelector) || !!node.querySelector(watchSelector));
+    };
+    return function (record) {
+        if (!watchSelector) { return true; }
+        var node = record.target.nodeType === 1 ? record.target : record.target.parentNode;
+        if (node && node.closest && node.closest(watchSelector)) { return true; }
+        var nodes = Array.prototype.slice.call(record.addedNodes).concat(Array.prototype.slice.call(record.removedNodes));
+        return nodes.some(contains);
+    };
+};
+var observeAll = function (observer) {
+    observer.observe(document.documentElement, {childList: true, subtree: true, attributes: true, characterData: true});
+};
+""" % SPINNER_SELECTOR
+
+# arguments: 目标 [kind, value] 或 null, 超时毫秒数, 是否必须先发生一次变化, 监听的节点选择器, 要点击的元素
+# 是否必须先发生一次变化为 'pending' 时, click_nowait 之后已经发生的变化也算数
+WAIT_SCRIPT = _COMMON_SCRIPT + """
+var target = arguments[0], timeoutMs = arguments[1], needChange = arguments[2];
+var watchSelector = arguments[3], clickElement = arguments[4], done = arguments[arguments.length - 1];
+var start = performance.now(), finished = false, observer = null, timer = null;
+var changed = needChange === 'pending' && !!window.__bookerClick && window.__bookerClick.changed;
+var finish = function (ok) {
+    if (finished) { return; }
+    finished = true;
+    if (observer) { observer.disconnect(); }
+    clearTimeout(timer);
+    done({ok: ok, elapsed: performance.now() - start});
+};
+var check = function () {
+    if ((changed || !needChange) && ready(target)) { finish(true); }
+};
+var touches = touchesFor(watchSelector);
+observer = new MutationObserver(function (records) {
+    if (!changed) { changed = records.some(touches); }
+    check();
+});
+observeAll(observer);
+timer = setTimeout(function () { finish(false); }, timeoutMs);
+if (clickElement) { clickElement.click(); }
+check();
+"""
+
+# 点击后立即返回, 只在 window.__bookerClick 中记下之后是否发生了变化, 由 wait_clicked 等待结果
+CLICK_NOWAIT_SCRIPT = _COMMON_SCRIPT + """
+var clickElement = arguments[0], touches = touchesFor(arguments[1]);
+var state = {changed: false};
+window.__bookerClick = state;
+var observer = new MutationObserver(function (records) {
+    if (records.some(touches)) { state.changed = true; observer.disconnect(); }
+});
+observeAll(observer);
+clickElement.click();
+"""
+
+RELOAD_NOWAIT_SCRIPT = """
+window.__bookerStale = true;
+setTimeout(function () { location.reload(); }, 0);
+"""
+
+
+def to_target(locator: tuple):
+    """把 (By, value) 转换成页面脚本中使用的 [kind, value]"""
+    if locator is None:
+        return None
+    by, value = locator
+    if by == By.XPATH:
+        return ['xpath', value]
+    if by == By.CLASS_NAME:
+        # 与 selenium 一致, 'a.b' 表示同时具有 a 和 b 两个 class
+        return ['css', '.' + value]
+    if by == By.ID:
+        return ['css', '#' + value]
+    if by == By.TAG_NAME:
+        return ['css', value]
+    if by == By.CSS_SELECTOR:
+        return ['css', value]
+    raise ValueError("不支持的定位方式: %s" % by)
+
+
+def _describe(locator: tuple) -> str:
+    return locator[1] if locator is not None else 'loading'
+
+
+def _observe(metrics, name: str, elapsed: float, ok: bool) -> None:
+    if metrics is not None:
+        metrics.observe('booker_wait_seconds', elapsed, target=name, outcome='success' if ok else 'timeout')
+
+
+def _run(driver, locator, timeout: float, need_change: bool = False, watch: str = None,
+         element=None, metrics=None, name: str = None) -> None:
+    name = name or _describe(locator)
+    target = to_target(locator)
+    start = time.perf_counter()
+    deadline = start + timeout
+    while True:
+        remain = deadline - time.perf_counter()
+        if remain <= 0:
+            break
+        try:
+            result = driver.execute_async_script(
+                WAIT_SCRIPT, target, int(remain * 1000), need_change, watch, element)
+        except TimeoutException:
+            break
+        except StaleElementReferenceException:
+            # 要点击的元素已经不在页面上了, 交给调用者重新查找
+            raise
+        except WebDriverException as e:
+            # 等待过程中页面跳转了, 在新页面上重新等待, 点击已经发生过了
+            element = None
+            need_change = False
+            logging.getLogger().debug("等待 %s 时页面发生跳转: %s" % (name, e.msg))
+            time.sleep(0.02)
+            continue
+        if result and result.get('ok'):
+            _observe(metrics, name, time.perf_counter() - start, True)
+            return
+        break
+    _observe(metrics, name, time.perf_counter() - start, False)
+    raise TimeoutException("等待 %s 超时 (%.1f s)" % (name, timeout))
+
+
+def wait_for(driver, locator: tuple = None, timeout: float = 10, metrics=None) -> None:
+    """等待加载动画消失并且 locator 对应的元素可见
+
+    Args:
+        driver (WebDriver): webdriver
+
+        locator (`tuple`, optional): (By, value), 为 None 时只等待加载动画消失. Defaults to None.
+
+        timeout (`float`): 超时时间, 单位为秒. Defaults to 10.
+
+        metrics (`MetricsRegistry`, optional): 记录等待耗时. Defaults to None.
+
+    Raises:
+        TimeoutException: 超时
+    """
+    _run(driver, locator, timeout, metrics=metrics)
+
+
+def click_and_wait(driver, element, locator: tuple = None, watch: str = None, timeout: float = 10,
+                   metrics=None) -> None:
+    """在页面中点击 element, 等到 DOM 发生变化后再等待加载完成
+
+    点击之后加载动画可能还没来得及出现, 直接等待会立刻返回, 所以要求先观察到一次变化。
+
+    Args:
+        element (WebElement): 要点击的元素
+
+        locator (`tuple`, optional): 变化后需要可见的元素. Defaults to None.
+
+        watch (`str`, optional): 只监听这个 css 选择器对应节点内部的变化, 例如 '.tableWrap'. Defaults to 整个页面.
+    """
+    _run(driver, locator, timeout, need_change=True, watch=watch, element=element, metrics=metrics,
+         name='click:' + _describe(locator))
+
+
+def wait_for_change(driver, watch: str = None, timeout: float = 1, metrics=None) -> bool:
+    """等待 watch 对应的节点内部发生变化, 并且加载动画不可见
+
+    Returns:
+        bool: 是否在 timeout 内发生了变化
+    """
+    try:
+        _run(driver, None, timeout, need_change=True, watch=watch, metrics=metrics,
+             name='change:' + (watch or 'document'))
+        return True
+    except TimeoutException:
+        return False
+
+
+def click_nowait(driver, element, watch: str = None) -> None:
+    """点击 element 后立即返回, 可以先去处理其他标签页, 回来后再用 wait_clicked 等待点击的结果"""
+    driver.execute_script(CLICK_NOWAIT_SCRIPT, element, watch)
+
+
+def wait_clicked(driver, locator: tuple = None, timeout: float = 10, metrics=None) -> None:
+    """等待当前标签页中上一次 click_nowait 引起的变化和加载完成"""
+    _run(driver, locator, timeout, need_change='pending', metrics=metrics,
+         name='clicked:' + _describe(locator))
+
+
+def reload_nowait(driver) -> None:
+    """让当前标签页重新加载并立即返回, 之后的等待会等到新页面加载完成"""
+    driver.execute_script(RELOAD_NOWAIT_SCRIPT)
+
+
+def wait_for_windows(driver, count: int, timeout: float = 10, metrics=None) -> None:
+    """等待窗口数量达到 count
+
+    新窗口不是 DOM 的变化, 只能轮询, 这里用比默认的 0.5 s 小得多的间隔
+    """
+    start = time.perf_counter()
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=0.02).until(
+            lambda d: len(d.window_handles) >= count)
+    except TimeoutException:
+        _observe(metrics, 'windows', time.perf_counter() - start, False)
+        raise
+    _observe(metrics, 'windows', time.perf_counter() - start, True)
@@ -0,0 +1,323 @@
+"""退订监视
+
+12 点放场之后, 空出来的场地基本都来自退订。原先的做法是每隔 2~3 秒刷新一次页面并重新解析整张表格,
+这里改为通过 day/info 接口轮询, 把每一天的空闲情况压缩成一个整数位图 (每个格子一位) 保存在内存中,
+每次轮询只和上一次的位图做一次异或, 只有出现新空出来的格子并且落在目标时间段上时才去匹配目标。
+内存只与监视的日期数有关, 每次轮询消耗的 CPU 时间会被统计, 超过 cpu_budget 时自动拉长轮询间隔,
+这样一个进程可以同时监视多个日期和场馆几个小时。
+
+    python watcher.py
+"""
+import argparse
+import datetime
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from court_table import label_minutes, format_minutes
+from venue_client import FREE_STATUS
+
+
+class AvailabilityGrid:
+    """某一天所有场地的空闲情况
+
+    第 row 个时间段第 court 号场地对应第 row * courts + court - 1 位, 1 表示空闲
+
+    Attributes:
+        labels (`tuple`): 每个时间段, 例如 "15:00-16:00", 相同的 labels 在多次轮询之间共用一个对象
+
+        courts (`int`): 场地数
+
+        bits (`int`): 空闲情况的位图
+    """
+
+    __slots__ = ('labels', 'courts', 'bits')
+
+    def __init__(self, labels: tuple, courts: int, bits: int) -> None:
+        self.labels = labels
+        self.courts = courts
+        self.bits = bits
+
+    @classmethod
+    def from_day_info(cls, data: dict, date: datetime.date, labels: tuple = None) -> 'AvailabilityGrid':
+        """从 day/info 的 data 字段构造, 与 parse_day_info 的解析方式相同
+
+        Args:
+            labels (`tuple`, optional): 上一次的 labels, 没有变化时直接复用. Defaults to None.
+        """
+        time_info = data['spaceTimeInfo']
+        spaces = data['reservationDateSpaceInfo'].get(date.strftime("%Y-%m-%d"), [])
+        new_labels = tuple("%s-%s" % (t['beginTime'], t['endTime']) for t in time_info)
+        if labels is not None and labels == new_labels:
+            new_labels = labels
+
+        courts = len(spaces)
+        bits = 0
+        for row, t in enumerate(time_info):
+            key = str(t['id'])
+            for col, space in enumerate(spaces):
+                if (space.get(key) or {}).get('reservationStatus') == FREE_STATUS:
+                    bits |= 1 << (row * courts + col)
+        return cls(new_labels, courts, bits)
+
+    def same_shape(self, other: 'AvailabilityGrid') -> bool:
+        return other is not None and self.courts == other.courts and self.labels == other.labels
+
+    def diff(self, old: 'AvailabilityGrid') -> tuple:
+        """与上一次的空闲情况比较
+
+        Returns:
+            tuple: (新空出来的格子, 新被占用的格子), 均为位图; 表格的形状变了时把所有空闲格子都当作新空出来的
+        """
+        if not self.same_shape(old):
+            return self.bits, 0
+        return self.bits & ~old.bits, old.bits & ~self.bits
+
+    def cells(self, mask: int) -> list:
+        """位图中所有为 1 的格子, 返回 [(时间段, 场地号), ...]"""
+        cells = []
+        while mask:
+            low = mask & -mask
+            index = low.bit_length() - 1
+            cells.append((self.labels[index // self.courts], index % self.courts + 1))
+            mask ^= low
+        return cells
+
+
+class WatchTarget:
+    """需要监视的一个时间段, 同一个场地上从 start 到 end 的所有时间段都空闲才算命中
+
+    Args:
+        date (`datetime.date`): 日期
+
+        start (`int`): 开始时间, 从 0 点开始的分钟数
+
+        end (`int`): 结束时间, 从 0 点开始的分钟数
+
+        venue_num (`int`): 指定的场地号, -1 表示任意场地. Defaults to -1.
+
+        venue_site_id (`str`, optional): 场馆的 venueSiteId, 默认使用 VenueClient 的. Defaults to None.
+    """
+
+    def __init__(self, date: datetime.date, start: int, end: int, venue_num: int = -1,
+                 venue_site_id: str = None) -> None:
+        self.date = date
+        self.start = start
+        self.end = end
+        self.venue_num = venue_num
+        self.venue_site_id = venue_site_id
+        # (labels, courts) -> (所有目标格子的并集, [(场地号, 该场地的目标格子)])
+        self._shape = None
+        self._masks = None
+
+    @property
+    def key(self) -> tuple:
+        return self.venue_site_id, self.date
+
+    def __str__(self) -> str:
+        return "%s %s-%s" % (self.date, format_minutes(self.start), format_minutes(self.end))
+
+    @property
+    def starts_at(self) -> datetime.datetime:
+        return datetime.datetime.combine(self.date, datetime.time(self.start // 60, self.start % 60))
+
+    def masks(self, grid: AvailabilityGrid) -> tuple:
+        """目标格子的位图, labels 不变时只计算一次"""
+        shape = (grid.labels, grid.courts)
+        if self._shape is None or self._shape[0] is not grid.labels or self._shape[1] != grid.courts:
+            rows = []
+            for i, label in enumerate(grid.labels):
+                start, end = label_minutes(label)
+                if self.start <= start and end <= self.end:
+                    rows.append(i)
+            courts = range(1, grid.courts + 1) if self.venue_num == -1 else \
+                [self.venue_num] if 1 <= self.venue_num <= grid.courts else []
+            per_court = []
+            for court in courts:
+                mask = 0
+                for row in rows:
+                    mask |= 1 << (row * grid.courts + court - 1)
+                if mask:
+                    per_court.append((court, mask))
+            union = 0
+            for _, mask in per_court:
+                union |= mask
+            self._shape = shape
+            self._masks = (union, per_court)
+        return self._masks
+
+    def match(self, grid: AvailabilityGrid, freed: int = None) -> int:
+        """返回命中的场地号, 没有命中返回 None
+
+        Args:
+            freed (`int`, optional): 新空出来的格子, 没有落在目标格子上时直接返回. Defaults to None.
+        """
+        union, per_court = self.masks(grid)
+        if freed is not None and not freed & union:
+            return None
+        for court, mask in per_court:
+            if grid.bits & mask == mask:
+                return court
+        return None
+
+
+class CancellationWatcher:
+    """轮询 day/info 接口, 等待目标时间段因为退订空出来
+
+    Args:
+        client (`VenueClient`): 已经复制了登录状态的场地查询客户端
+
+        targets (`list`): WatchTarget 列表, 按优先顺序排列
+
+        interval (`float`): 轮询间隔, 单位为秒. Defaults to 3.
+
+        cpu_budget (`float`): 允许占用的单核 CPU 比例, 超过时拉长轮询间隔. Defaults to 0.05.
+
+        max_grids (`int`): 内存中最多保留多少天的位图. Defaults to 64.
+
+        logger (`logging.Logger`, optional): logger. Defaults to `logging.getLogger()`.
+
+        metrics (`MetricsRegistry`, optional): 记录轮询耗时和变化次数. Defaults to None.
+
+        history (`HistoryStore`, optional): 把每次查到的空闲情况写入历史记录. Defaults to None.
+
+        venue (`str`): 写入历史记录时的场馆名, 为空时使用 venueSiteId. Defaults to ''.
+    """
+
+    def __init__(self, client, targets: list, interval: float = 3, cpu_budget: float = 0.05,
+                 max_grids: int = 64, logger: logging.Logger = None, metrics=None, history=None,
+                 venue: str = '') -> None:
+        self.client = client
+        self.targets = list(targets)
+        self.interval = interval
+        self.cpu_budget = cpu_budget
+        self.max_grids = max_grids
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.metrics = metrics
+        self.history = history
+        self.venue = venue
+        self.grids = OrderedDict()
+        self.polls = 0
+
+    def _drop_expired(self) -> None:
+        """已经开始的时间段不再监视"""
+        now = datetime.datetime.now()
+        self.targets = [t for t in self.targets if t.starts_at > now]
+
+    def poll(self) -> list:
+        """查询一次所有目标日期
+
+        Returns:
+            list: 命中的 [(WatchTarget, 场地号), ...], 按 targets 的顺序排列
+        """
+        self.polls += 1
+        keys = list(OrderedDict.fromkeys(t.key for t in self.targets))
+        freed_by_key = {}
+        for key in keys:
+            venue_site_id, date = key
+            data = self.client.fetch_day_info(date, venue_site_id=venue_site_id)
+            old = self.grids.get(key)
+            grid = AvailabilityGrid.from_day_info(data, date, old.labels if old is not None else None)
+            freed, taken = grid.diff(old)
+            if old is not None and (freed or taken):
+                self.logger.info("%s 空出 %s, 被占用 %s" % (date, grid.cells(freed), grid.cells(taken)))
+                if self.metrics is not None:
+                    self.metrics.inc('booker_watch_changes_total', bin(freed).count('1'), kind='freed')
+                    self.metrics.inc('booker_watch_changes_total', bin(taken).count('1'), kind='taken')
+            self.grids[key] = grid
+            if self.history is not None:
+                self.history.record_grid(self.venue or venue_site_id or self.client.venue_site_id, date, grid)
+            self.grids.move_to_end(key)
+            while len(self.grids) > self.max_grids:
+                self.grids.popitem(last=False)
+            # 第一次轮询时检查所有目标, 之后只在有格子空出来时检查
+            freed_by_key[key] = None if old is None else freed
+
+        hits = []
+        for target in self.targets:
+            freed = freed_by_key.get(target.key, 0)
+            if freed == 0:
+                continue
+            court = target.match(self.grids[target.key], freed)
+            if court is not None:
+                hits.append((target, court))
+        return hits
+
+    def watch(self, stop: threading.Event = None, max_errors: int = 3) -> list:
+        """一直轮询直到有目标命中
+
+        Args:
+            stop (`threading.Event`, optional): 外部停止监视. Defaults to None.
+
+            max_errors (`int`): 连续失败多少次后放弃, 一般说明登录状态已失效. Defaults to 3.
+
+        Returns:
+            list: 命中的 [(WatchTarget, 场地号), ...]; 没有可监视的目标, 被停止或连续失败时返回空列表
+        """
+        stop = stop if stop is not None else threading.Event()
+        errors = 0
+        while not stop.is_set():
+            self._drop_expired()
+            if not self.targets:
+                self.logger.info("没有需要监视的时间段")
+                return []
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            try:
+                hits = self.poll()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                self.logger.warn("查询场地失败 (%d/%d): %s" % (errors, max_errors, e))
+                self.logger.debug(e, exc_info=True, stack_info=True)
+                if errors >= max_errors:
+                    return []
+                hits = []
+            elapsed = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            if self.metrics is not None:
+                self.metrics.observe('booker_watch_poll_seconds', elapsed)
+            if hits:
+                self.logger.info("监视到空闲场地: %s" % ', '.join(
+                    "%s %d号" % (target, court) for target, court in hits))
+                return hits
+
+            # 一轮的总时长至少为 cpu / cpu_budget, CPU 占用就不会超过预算
+            wait = max(self.interval, cpu / self.cpu_budget if self.cpu_budget > 0 else 0) - elapsed
+            if self.metrics is not None:
+                self.metrics.set('booker_watch_interval_seconds', max(0, wait) + elapsed)
+            stop.wait(max(0, wait))
+        return []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='在本地模拟站点上演示退订监视')
+    parser.add_argument('--interval', type=float, default=0.2)
+    args = parser.parse_args()
+
+    from mock_site import MockSite, MockVenue
+    from venue_client import VenueClient
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    # 所有场地都已被预约, 2 秒后 3 号场地 19:00-21:00 被退订
+    site = MockSite(venue=MockVenue(courts=10, free_ratio=0)).start()
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    target = WatchTarget(tomorrow, 19 * 60, 21 * 60)
+    client = VenueClient(site.url, site.SITE_ID)
+
+    def cancel():
+        time.sleep(2)
+        site.venue.free_ratio = 1
+        for court in range(1, 11):
+            for slot in range(1, 15):
+                if not (court == 3 and slot in (12, 13)):
+                    site.venue.locked[(tomorrow.strftime("%Y-%m-%d"), court, slot)] = 'demo'
+
+    threading.Thread(target=cancel, daemon=True).start()
+    watcher = CancellationWatcher(client, [target], interval=args.interval)
+    start = time.perf_counter()
+    hits = watcher.watch()
+    print("命中 %s, 轮询 %d 次, 耗时 %.1f s, CPU %.3f s" % (
+        [(str(t), c) for t, c in hits], watcher.polls, time.perf_counter() - start, time.process_time()))
+    site.stop()